@@ -0,0 +1,89 @@
+'''Generates a reproducible MiniSigma dataset of a given size and loads it into a database file.
+
+Messages are spread over the last `days` days with snowflake ids matching their timestamps, so the
+sliding window stats and the archive see realistic ages. Every user is a member of every guild.
+'''
+import random
+from dataclasses import dataclass
+from typing import Iterator
+from datetime import datetime, timedelta, timezone
+import discord
+from utility.database import Database
+from utility.message_cache import MessageInfo
+
+UPVOTE = "⬆️"
+DOWNVOTE = "⬇️"
+CHANNELS_PER_GUILD = 5
+WORDS = "lol nice based cringe the a of to and is this that meme bot vote gacha cat dog when you me".split()
+
+@dataclass
+class Dataset:
+    guilds: list[int]
+    channels: dict[int, list[int]]
+    users: list[int]
+    messages: list[MessageInfo]
+    reactions: int
+    transactions: int
+    seed: int
+
+    def generate_reactions(self, batch: int = 10000) -> Iterator[list[tuple[MessageInfo, int, int]]]:
+        '''Yields the dataset's (message, voter_id, vote_type) reactions in batches. They are drawn at random,
+        so a few repeat and are dropped by the ingest, which keeps memory flat at any size.'''
+        rng = random.Random(self.seed + 1)
+        remaining = self.reactions
+        while remaining > 0 and len(self.users) > 1:
+            reactions = []
+            while len(reactions) < min(batch, remaining):
+                # Votes favour recent messages, like they do on a live server
+                message = self.messages[len(self.messages) - 1 - int(len(self.messages) * rng.random() ** 2)]
+                voter_id = rng.choice(self.users)
+                if voter_id != message.author_id:
+                    reactions.append((message, voter_id, 1 if rng.random() < 0.75 else -1))
+            remaining -= len(reactions)
+            yield reactions
+
+    def generate_transactions(self) -> list[tuple[int, int, str, str]]:
+        '''Returns the dataset's gambling (user_id, amount, game, timestamp) transactions'''
+        rng = random.Random(self.seed + 2)
+        now = datetime.now(timezone.utc)
+        return [
+            (rng.choice(self.users), rng.choice((-1, 1)) * rng.randint(1, 500), rng.choice(("blackjack", "roulette", "slots")), (now - timedelta(seconds=rng.uniform(0, 30 * 86400))).isoformat())
+            for _ in range(self.transactions)
+        ]
+
+def generate_dataset(users: int, messages: int, reactions: int, guilds: int, transactions: int = 0, days: int = 30, seed: int = 0) -> Dataset:
+    '''Returns a dataset with the given number of users, messages, reactions, guilds and gambling transactions'''
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    guild_ids = [10**17 + i for i in range(guilds)]
+    channels = {guild_id: [guild_id + 1000 * (i + 1) for i in range(CHANNELS_PER_GUILD)] for guild_id in guild_ids}
+    user_ids = [2 * 10**17 + i for i in range(users)]
+
+    message_list = []
+    for i in range(messages):
+        posted = now - timedelta(seconds=rng.uniform(0, days * 86400))
+        guild_id = rng.choice(guild_ids)
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.choice((0, 1, 3, 8, 20, 60))))
+        message_list.append(MessageInfo(discord.utils.time_snowflake(posted) + i % 2**22, rng.choice(channels[guild_id]), guild_id, rng.choice(user_ids), content, posted.isoformat()))
+    message_list.sort()
+
+    return Dataset(guild_ids, channels, user_ids, message_list, reactions, transactions, seed)
+
+def build_database(dataset: Dataset, path: str, profile: str = "performance", batch: int = 10000):
+    '''Creates the database file at path holding dataset'''
+    db = Database(path, profile=profile, commit_interval=3600, commit_batch=batch)
+    for guild_id in dataset.guilds:
+        db.set_emojis(guild_id, UPVOTE, DOWNVOTE)
+        db.set_guild_members(guild_id, dataset.users)
+
+    for reactions in dataset.generate_reactions(batch):
+        db.ingest_reactions(reactions)
+    # Messages nobody voted on still get looked up by the vote path
+    db.add_messages(dataset.messages)
+    for user_id in dataset.users:
+        db.add_user(user_id, f"user{user_id}")
+    db.update_usernames([(user_id, f"user{user_id}") for user_id in dataset.users])
+
+    # Transactions are only bulk loaded here, the bot adds them one at a time through add_transaction
+    db.cursor().executemany("INSERT INTO Transactions (user_id, amount, game, timestamp) VALUES (?, ?, ?, ?)", dataset.generate_transactions())
+    db.close()
@@ -0,0 +1,111 @@
+'''Stand-ins for the discord.py objects the cogs touch, so they can be driven without a gateway connection.
+
+Only the attributes and coroutines the vote pipeline uses are implemented. Channels serve messages from
+a dict and count how often they had to "fetch" one, the nickname scheduler only counts its calls.
+'''
+import importlib.util
+import os
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from utility.message_cache import MessageInfo
+
+def import_config():
+    '''Makes `from config import *` work in a checkout without a config.py by loading config.example.py in its place'''
+    try:
+        import config
+    except ModuleNotFoundError:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.example.py")
+        spec = importlib.util.spec_from_file_location("config", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules["config"] = module
+
+class FakeGuild:
+    def __init__(self, id: int):
+        self.id = id
+        self.members: dict[int, FakeMember] = {}
+
+    def get_member(self, id: int) -> Optional["FakeMember"]:
+        return self.members.get(id)
+
+class FakeMember:
+    def __init__(self, id: int, name: str, guild: FakeGuild):
+        self.id = id
+        self.name = name
+        self.nick: Optional[str] = None
+        self.guild = guild
+
+    def __str__(self) -> str:
+        return self.name
+
+class FakeMessage:
+    '''The fields MessageInfo.from_message reads'''
+
+    def __init__(self, info: MessageInfo, guild: FakeGuild, channel: "FakeChannel"):
+        self.id = info.id
+        self.guild = guild
+        self.channel = channel
+        self.author = guild.get_member(info.author_id) or FakeMember(info.author_id, f"user{info.author_id}", guild)
+        self.clean_content = info.content
+        self.created_at = datetime.fromisoformat(info.timestamp)
+
+class FakeChannel:
+    def __init__(self, id: int, guild: FakeGuild):
+        self.id = id
+        self.name = f"channel{id}"
+        self.guild = guild
+        self.messages: dict[int, MessageInfo] = {}
+        self.fetches = 0
+
+    async def fetch_message(self, id: int) -> FakeMessage:
+        self.fetches += 1
+        return FakeMessage(self.messages[id], self.guild, self)
+
+class FakeNicknames:
+    '''Takes the place of NicknameScheduler, fake members can't be edited'''
+
+    def __init__(self):
+        self.scheduled = 0
+
+    def schedule(self, member: FakeMember, score: int):
+        self.scheduled += 1
+
+    def close(self):
+        pass
+
+class FakeClient:
+    '''The parts of MiniSigma the cogs use: the database, the nickname scheduler and the guild and channel caches'''
+
+    def __init__(self, db, guilds: list[FakeGuild], channels: list[FakeChannel]):
+        self.db = db
+        self.nicknames = FakeNicknames()
+        self.guilds = guilds
+        self.guild_map = {guild.id: guild for guild in guilds}
+        self.channel_map = {channel.id: channel for channel in channels}
+
+    def get_guild(self, id: int) -> Optional[FakeGuild]:
+        return self.guild_map.get(id)
+
+    def get_channel(self, id: int) -> Optional[FakeChannel]:
+        return self.channel_map.get(id)
+
+    def get_user(self, id: int) -> Optional[FakeMember]:
+        for guild in self.guilds:
+            member = guild.get_member(id)
+            if member is not None:
+                return member
+        return None
+
+@dataclass
+class FakeReactionEvent:
+    '''The fields of discord.RawReactionActionEvent that Voting.process_reaction reads'''
+    message_id: int
+    channel_id: int
+    guild_id: int
+    user_id: int
+    emoji: str
+    event_type: str
+    member: Optional[FakeMember] = None
+    message_author_id: Optional[int] = None
@@ -0,0 +1,134 @@
+'''Times the statistics read methods of Database against generated datasets of increasing size.
+
+Each scale is a number of reactions. Messages, users and gambling transactions grow along with it
+(see dataset_size), over three guilds. Every query runs --repeat times on a read-only connection after
+one warm-up call, and its median and p95 latency are reported per scale, giving a scaling curve.
+
+Building the larger datasets takes minutes, --keep stores them in a directory and reuses them on later
+runs. The --json report has stable keys, so reports of two commits can be diffed or passed to --compare:
+
+    python -m benchmarks.query_latency --scales 10000 100000 1000000 --keep /tmp/datasets --json after.json --compare before.json
+'''
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import Counter
+from typing import Callable
+from benchmarks.dataset import Dataset, build_database, generate_dataset
+from utility.database import Database
+
+def dataset_size(reactions: int) -> dict[str, int]:
+    '''Returns the generate_dataset arguments for a scale of reactions'''
+    return {
+        "users": max(50, reactions // 500),
+        "messages": max(100, reactions // 5),
+        "reactions": reactions,
+        "guilds": 3,
+        "transactions": reactions // 20,
+    }
+
+def queries(dataset: Dataset) -> dict[str, Callable[[Database], object]]:
+    '''Returns the queries to time as {label: call}, per-user queries ask about the author with the most messages'''
+    guild_id = dataset.guilds[0]
+    (user_id, _) = Counter(message.author_id for message in dataset.messages).most_common(1)[0]
+    return {
+        "leaderboard(10)": lambda db: db.leaderboard(10),
+        "leaderboard(10, guild)": lambda db: db.leaderboard(10, guild_id),
+        "loserboard(10)": lambda db: db.loserboard(10),
+        "loserboard(10, guild)": lambda db: db.loserboard(10, guild_id),
+        "fans(user, 5)": lambda db: db.fans(user_id, 5),
+        "haters(user, 5)": lambda db: db.haters(user_id, 5),
+        "best_of(user, 5)": lambda db: db.best_of(user_id, 5),
+        "top_messages(None, 5)": lambda db: db.top_messages(None, 5),
+        "top_messages(guild, 5)": lambda db: db.top_messages(guild_id, 5),
+        "get_controversial(guild, 5)": lambda db: db.get_controversial(guild_id, 5),
+        "get_memberotw(guild, week)": lambda db: db.get_memberotw(guild_id, "week"),
+        "get_memberotw(guild, month)": lambda db: db.get_memberotw(guild_id, "month"),
+        "get_messageotw(guild, week)": lambda db: db.get_messageotw(guild_id, "week"),
+        "get_messageotw(guild, month)": lambda db: db.get_messageotw(guild_id, "month"),
+        "gambling_stats(user)": lambda db: db.gambling_stats(user_id),
+        "pull()": lambda db: db.pull(),
+    }
+
+def time_query(db: Database, call: Callable[[Database], object], repeat: int) -> dict:
+    result = call(db)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call(db)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "rows": len(result) if isinstance(result, list) else int(result is not None),
+    }
+
+def run_scale(reactions: int, directory: str, profile: str, repeat: int, seed: int) -> dict:
+    size = dataset_size(reactions)
+    dataset = generate_dataset(**size, seed=seed)
+    path = os.path.join(directory, f"reactions_{reactions}_seed{seed}.db")
+
+    build_seconds = None
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        build_database(dataset, path, profile)
+        build_seconds = time.perf_counter() - start
+    # Opening a writer first brings a kept dataset up to the current schema
+    Database(path, profile=profile).close()
+
+    db = Database(path, read_only=True, profile=profile)
+    c = db.cursor()
+    c.execute("SELECT COUNT(*) FROM AllReactions")
+    size["stored_reactions"] = c.fetchone()[0]
+    results = {label: time_query(db, call, repeat) for (label, call) in queries(dataset).items()}
+    db.close()
+
+    return {"dataset": size, "build_seconds": build_seconds, "file_mb": os.path.getsize(path) / 2**20, "queries": results}
+
+def print_report(report: dict, baseline: dict | None):
+    for (scale, result) in report["scales"].items():
+        print(f"\n{int(scale):,} reactions ({result['file_mb']:.1f} MB)")
+        previous = (baseline or {}).get("scales", {}).get(scale, {}).get("queries", {})
+        for (label, timing) in result["queries"].items():
+            line = f"  {label:<30} {timing['median_ms']:>9.3f} ms  p95 {timing['p95_ms']:>9.3f} ms"
+            if label in previous:
+                line += f"  ({timing['median_ms'] / previous[label]['median_ms']:.2f}x baseline)"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000], help="reactions per dataset, e.g. 10000 100000 1000000 10000000")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--profile", default="performance")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="directory to store generated datasets in and reuse them from")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="report of an earlier run to show ratios against")
+    args = parser.parse_args()
+
+    report = {"sqlite_version": sqlite3.sqlite_version, "python": platform.python_version(), "repeat": args.repeat, "scales": {}}
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = args.keep or scratch
+        os.makedirs(directory, exist_ok=True)
+        for reactions in args.scales:
+            print(f"Running {reactions:,} reactions...")
+            report["scales"][str(reactions)] = run_scale(reactions, directory, args.profile, args.repeat, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+'''Checks that a database created by the original, unversioned bot upgrades to the current schema intact.
+
+A file with the baseline schema (the tables the bot created before schema_version existed) is filled with a
+generated dataset, with its vote counters computed the way the baseline bot kept them. Opening it with Database
+runs every migration, after which the scores, counters, messages and reactions must all be unchanged:
+
+    python -m benchmarks.upgrade_check --messages 2000 --reactions 10000
+
+With --interrupt, each migration in turn is aborted halfway through, as if the bot was killed mid-upgrade, and
+the next start has to finish the upgrade just the same.
+'''
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from collections import Counter
+from benchmarks.dataset import DOWNVOTE, UPVOTE, Dataset, generate_dataset
+from utility.database import Database
+from utility.migrations import MIGRATIONS, schema_version
+
+BASELINE_SCHEMA = """
+CREATE TABLE Users (id INTEGER PRIMARY KEY, username TEXT NOT NULL, upvotes INTEGER, downvotes INTEGER, offset INTEGER);
+CREATE TABLE FansAndHaters (user_id INTEGER, fan_or_hater_id INTEGER, upvotes INTEGER, downvotes INTEGER, PRIMARY KEY (user_id, fan_or_hater_id), FOREIGN KEY (user_id) REFERENCES Users(id), FOREIGN KEY (fan_or_hater_id) REFERENCES Users(id));
+CREATE TABLE Emojis (guild_id INTEGER PRIMARY KEY, upvote TEXT, downvote TEXT);
+CREATE TABLE Messages (id INTEGER PRIMARY KEY, channel_id INTEGER, guild_id INTEGER, author_id INTEGER, content TEXT, timestamp TEXT, FOREIGN KEY (author_id) REFERENCES Users(id), FOREIGN KEY (guild_id) REFERENCES Emojis(guild_id));
+CREATE TABLE Reactions (voter_id INTEGER, message_id INTEGER, vote_type INTEGER, timestamp TEXT, PRIMARY KEY (voter_id, message_id, vote_type), FOREIGN KEY (voter_id) REFERENCES Users(id), FOREIGN KEY (message_id) REFERENCES Messages(id));
+CREATE TABLE Transactions (user_id INTEGER NOT NULL, amount INTEGER NOT NULL, game TEXT NOT NULL, timestamp TEXT NOT NULL);
+"""
+# SQLite VM instructions between calls of the progress handler --interrupt aborts migrations with
+PROGRESS_STEPS = 1000
+
+def build_baseline(dataset: Dataset, path: str) -> tuple[dict[int, int], Counter]:
+    '''Writes dataset to a baseline-schema database at path, returns the expected {user_id: score} and the
+    expected (message_id, vote_type) vote counts'''
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO Emojis (guild_id, upvote, downvote) VALUES (?, ?, ?)", [(guild_id, UPVOTE, DOWNVOTE) for guild_id in dataset.guilds])
+    conn.executemany("INSERT INTO Messages (id, channel_id, guild_id, author_id, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)", dataset.messages)
+
+    reactions = {(voter_id, message.id, vote_type): message for batch in dataset.generate_reactions() for (message, voter_id, vote_type) in batch}
+    conn.executemany("INSERT INTO Reactions (voter_id, message_id, vote_type, timestamp) VALUES (?, ?, ?, ?)", [(*key, message.timestamp) for (key, message) in reactions.items()])
+
+    # The baseline bot kept these counters itself, one vote at a time
+    users = Counter()
+    fans = Counter()
+    votes = Counter()
+    for ((voter_id, message_id, vote_type), message) in reactions.items():
+        users[(message.author_id, vote_type)] += 1
+        fans[(message.author_id, voter_id, vote_type)] += 1
+        votes[(message_id, vote_type)] += 1
+    conn.executemany("INSERT INTO Users (id, username, upvotes, downvotes, offset) VALUES (?, ?, ?, ?, 100)",
+                     [(user_id, f"user{user_id}", users[(user_id, 1)], users[(user_id, -1)]) for user_id in dataset.users])
+    conn.executemany("INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes) VALUES (?, ?, ?, ?)",
+                     [(user_id, voter_id, fans[(user_id, voter_id, 1)], fans[(user_id, voter_id, -1)]) for (user_id, voter_id) in {key[:2] for key in fans}])
+    conn.commit()
+    conn.close()
+    return ({user_id: 100 + users[(user_id, 1)] - users[(user_id, -1)] for user_id in dataset.users}, votes)
+
+def abort_with(method: str, callback) -> dict:
+    '''Returns a Database method running method under a progress handler, a true return from callback aborts
+    the statement that is running with sqlite3.OperationalError'''
+    def run(self):
+        self.conn.set_progress_handler(callback, PROGRESS_STEPS)
+        try:
+            getattr(Database, method)(self)
+        finally:
+            self.conn.set_progress_handler(None, 0)
+    return {method: run}
+
+def migration_steps(path: str) -> Counter:
+    '''Upgrades a copy of path, returns how many progress callbacks each migration took'''
+    steps = Counter()
+    methods = {}
+    for (version, _, method) in MIGRATIONS:
+        methods.update(abort_with(method, lambda version=version: steps.update((version,))))
+    copy = f"{path}.steps"
+    shutil.copy(path, copy)
+    type("Counted", (Database,), methods)(copy, archive=f"{copy}_archive.db").close()
+    return steps
+
+def interrupt(path: str, version: int, steps: int):
+    '''Opens path with a Database that aborts the migration to version halfway through, like a bot killed mid-upgrade.
+    A migration too short for the progress handler to be called fails after its method returns instead.'''
+    method = next(method for (number, _, method) in MIGRATIONS if number == version)
+    remaining = [steps // 2]
+
+    def abort() -> bool:
+        remaining[0] -= 1
+        return remaining[0] < 0
+
+    opened = []
+
+    def fail(self):
+        opened.append(self)
+        abort_with(method, abort)[method](self)
+        raise RuntimeError(f"interrupted migration {version}")
+
+    try:
+        type("Interrupted", (Database,), {method: fail})(path)
+    except (sqlite3.OperationalError, RuntimeError):
+        # Closing without a commit is what a killed process leaves behind
+        opened[0].conn.close()
+        return
+    raise AssertionError(f"migration {version} didn't run")
+
+def check(dataset: Dataset, path: str, scores: dict[int, int], votes: Counter) -> list[str]:
+    '''Returns a description of everything that differs from the baseline after opening path with Database'''
+    failures = []
+    db = Database(path)
+    if schema_version(db) != MIGRATIONS[-1][0]:
+        failures.append(f"schema version {schema_version(db)}, latest is {MIGRATIONS[-1][0]}")
+
+    (users, fans, messages) = db.aggregate_drift()
+    if users or fans or messages:
+        failures.append(f"drifted counters: {len(users)} users, {len(fans)} fans/haters, {len(messages)} message scores")
+
+    changed = [user_id for (user_id, score) in scores.items() if db.get_score(user_id) != score]
+    if changed:
+        failures.append(f"{len(changed)} scores changed, e.g. user {changed[0]}")
+
+    stored = {row[0]: row for row in db.list_messages()}
+    lost = [message.id for message in dataset.messages if stored.get(message.id) != tuple(message)]
+    if lost:
+        failures.append(f"{len(lost)} messages lost or changed, e.g. {lost[0]}")
+
+    c = db.cursor()
+    c.execute("SELECT message_id, up, down FROM MessageScores")
+    rows = c.fetchall()
+    wrong = [message_id for (message_id, up, down) in rows if (up, down) != (votes[(message_id, 1)], votes[(message_id, -1)])]
+    if len(rows) != len(dataset.messages) or wrong:
+        failures.append(f"{len(rows)} message scores for {len(dataset.messages)} messages, {len(wrong)} with wrong totals")
+    db.close()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--reactions", type=int, default=10000)
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--days", type=int, default=500, help="age of the oldest message")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--interrupt", action="store_true", help="also check an upgrade resumed after each migration fails")
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.users, args.messages, args.reactions, args.guilds, days=args.days, seed=args.seed)
+    failures = []
+    for version in [None, *(number for (number, _, _) in MIGRATIONS)] if args.interrupt else [None]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "database.db")
+            (scores, votes) = build_baseline(dataset, path)
+            if version is not None:
+                interrupt(path, version, migration_steps(path)[version])
+            failures.extend(failure if version is None else f"after interrupting migration {version}, {failure}" for failure in check(dataset, path, scores, votes))
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"Upgraded a baseline database with {len(dataset.messages)} messages to schema version {MIGRATIONS[-1][0]} intact")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+'''Measures Database.process_vote throughput for each connection profile in utility/database.py.
+
+Every profile gets a fresh database file seeded with the same messages, then replays the same
+random stream of vote adds and removes through the vote path the Voting cog uses.
+
+    python -m benchmarks.vote_path --votes 20000 --commit-batch 1
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from utility.database import Database, PROFILES
+from utility.message_cache import MessageInfo
+
+def generate_votes(num_votes: int, num_messages: int, num_users: int, seed: int) -> tuple[list[MessageInfo], list[tuple[int, MessageInfo, int, bool]]]:
+    '''Returns seed messages and a stream of (voter_id, message, vote_type, added) events'''
+    rng = random.Random(seed)
+    messages = [MessageInfo(10**12 + i, i % 20, i % 3, rng.randrange(num_users), "benchmark message " * 4, "2024-01-01T00:00:00+00:00") for i in range(num_messages)]
+
+    votes = []
+    cast = []
+    for _ in range(num_votes):
+        # About one in five events takes back an earlier vote
+        if cast and rng.random() < 0.2:
+            votes.append((*cast.pop(rng.randrange(len(cast))), False))
+            continue
+        message = rng.choice(messages)
+        voter_id = rng.randrange(num_users)
+        if voter_id != message.author_id:
+            vote = (voter_id, message, rng.choice((1, -1)))
+            cast.append(vote)
+            votes.append((*vote, True))
+
+    return messages, votes
+
+def run(profile: str, messages: list[MessageInfo], votes: list[tuple[int, MessageInfo, int, bool]], commit_batch: int) -> float:
+    '''Replays votes against a fresh database using profile and returns votes per second'''
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, "benchmark.db"), commit_interval=0.25, commit_batch=commit_batch, profile=profile)
+        for message in messages:
+            db.add_message(message)
+        db.flush()
+
+        start = time.perf_counter()
+        for (voter_id, message, vote_type, added) in votes:
+            db.process_vote(message.author_id, f"user{message.author_id}", voter_id, f"user{voter_id}", message, vote_type, added)
+        db.flush()
+        elapsed = time.perf_counter() - start
+
+        db.close()
+    return len(votes) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--votes", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--commit-batch", type=int, default=1, help="queued writes per commit, 1 commits every write")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    messages, votes = generate_votes(args.votes, args.messages, args.users, args.seed)
+    print(f"{len(votes)} vote events, {args.messages} messages, {args.users} users, commit batch {args.commit_batch}")
+
+    baseline = None
+    for profile in PROFILES:
+        throughput = run(profile, messages, votes, args.commit_batch)
+        baseline = baseline or throughput
+        print(f"{profile:<12} {throughput:>10.0f} votes/s  ({throughput / baseline:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+'''Replays synthetic reaction events through Voting.process_reaction, the way the gateway would deliver them.
+
+A generated dataset is loaded into a fresh database, then a stream of fake reaction adds and removes is
+dispatched to the Voting cog with up to --concurrency events in flight, through the real AsyncDatabase.
+Discord itself is replaced by the stand-ins in benchmarks/fakes.py, so nothing touches the network.
+
+Reports events/s, per-event latency percentiles and SQLite commits per event. Saving the report with
+--json and passing it as --baseline to a later run fails that run if it got slower than --tolerance allows:
+
+    python -m benchmarks.vote_pipeline --events 20000 --json before.json
+    python -m benchmarks.vote_pipeline --events 20000 --baseline before.json
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks.dataset import DOWNVOTE, UPVOTE, Dataset, build_database, generate_dataset
+from benchmarks.fakes import FakeChannel, FakeClient, FakeGuild, FakeMember, FakeReactionEvent, import_config
+from utility.database import PROFILES
+
+import_config()
+from cogs.voting import Voting
+from utility.async_database import AsyncDatabase
+
+def build_fakes(dataset: Dataset) -> tuple[list[FakeGuild], list[FakeChannel]]:
+    guilds = []
+    channels = []
+    for guild_id in dataset.guilds:
+        guild = FakeGuild(guild_id)
+        guild.members = {user_id: FakeMember(user_id, f"user{user_id}", guild) for user_id in dataset.users}
+        guilds.append(guild)
+        channels.extend(FakeChannel(channel_id, guild) for channel_id in dataset.channels[guild_id])
+    return guilds, channels
+
+def generate_events(dataset: Dataset, guilds: list[FakeGuild], channels: list[FakeChannel], num_events: int, fetch_rate: float, other_rate: float, seed: int) -> list[FakeReactionEvent]:
+    '''Returns a stream of reaction events on the dataset's messages. About one in five takes back an earlier vote,
+    fetch_rate of them are on messages the database hasn't seen and other_rate use an emoji that isn't a vote'''
+    rng = random.Random(seed)
+    guild_map = {guild.id: guild for guild in guilds}
+    channel_map = {channel.id: channel for channel in channels}
+    messages = dataset.messages
+    cast = []
+    events = []
+    while len(events) < num_events:
+        if cast and rng.random() < 0.2:
+            (message, voter_id, emoji) = cast.pop(rng.randrange(len(cast)))
+            events.append(FakeReactionEvent(message.id, message.channel_id, message.guild_id, voter_id, emoji, "REACTION_REMOVE"))
+            continue
+
+        if rng.random() < fetch_rate:
+            # A message the bot never stored, the cog has to fetch it from the channel
+            template = rng.choice(messages)
+            message = template._replace(id=template.id + 2**21 + len(events))
+            channel_map[message.channel_id].messages[message.id] = message
+        else:
+            message = messages[len(messages) - 1 - int(len(messages) * rng.random() ** 3)]
+
+        voter_id = rng.choice(dataset.users)
+        if voter_id == message.author_id:
+            continue
+        emoji = "👍" if rng.random() < other_rate else (UPVOTE if rng.random() < 0.75 else DOWNVOTE)
+        member = guild_map[message.guild_id].get_member(voter_id)
+        events.append(FakeReactionEvent(message.id, message.channel_id, message.guild_id, voter_id, emoji, "REACTION_ADD", member, message.author_id))
+        cast.append((message, voter_id, emoji))
+
+    return events
+
+async def replay(cog: Voting, events: list[FakeReactionEvent], concurrency: int) -> list[float]:
+    '''Dispatches each event as a task of its own, like discord.py does, and returns their latencies in seconds'''
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def dispatch(event: FakeReactionEvent):
+        try:
+            start = time.perf_counter()
+            await cog.process_reaction(event)
+            latencies.append(time.perf_counter() - start)
+        finally:
+            slots.release()
+
+    tasks = []
+    for event in events:
+        await slots.acquire()
+        tasks.append(asyncio.create_task(dispatch(event)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+async def run(args: argparse.Namespace) -> dict:
+    dataset = generate_dataset(args.users, args.messages, args.reactions, args.guilds, seed=args.seed)
+    guilds, channels = build_fakes(dataset)
+    events = generate_events(dataset, guilds, channels, args.events, args.fetch_rate, args.other_rate, args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        build_database(dataset, path, args.profile)
+
+        db = AsyncDatabase(path, readers=args.readers, commit_interval=args.commit_interval, commit_batch=args.commit_batch, profile=args.profile)
+        await db.load_guild_configs()
+        client = FakeClient(db, guilds, channels)
+        cog = Voting(client)
+        for message in dataset.messages[max(0, len(dataset.messages) - args.cached):]:
+            cog.messages.put(message)
+
+        commits = 0
+        def count_commits(sql: str):
+            nonlocal commits
+            if sql.startswith("COMMIT"):
+                commits += 1
+        await db.trace_statements(count_commits)
+
+        start = time.perf_counter()
+        latencies = await replay(cog, events, args.concurrency)
+        await db.flush()
+        elapsed = time.perf_counter() - start
+
+        await db.trace_statements(None)
+        await db.close()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    lookups = cog.messages.hits + cog.messages.misses
+    return {
+        "events": len(events),
+        "seconds": elapsed,
+        "events_per_sec": len(events) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "commits": commits,
+        "commits_per_event": commits / len(events),
+        "fetches": sum(channel.fetches for channel in channels),
+        "nickname_updates": client.nicknames.scheduled,
+        "message_cache_hit_rate": cog.messages.hits / lookups if lookups else 0.0,
+        "settings": {key: value for (key, value) in vars(args).items() if key not in ("json", "baseline", "tolerance")},
+    }
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    '''Returns a description of every metric in report that is worse than baseline by more than tolerance'''
+    failures = []
+    if report["events_per_sec"] < baseline["events_per_sec"] * (1 - tolerance):
+        failures.append(f"throughput {report['events_per_sec']:.0f} events/s, baseline {baseline['events_per_sec']:.0f}")
+    for metric in ("p50_ms", "p99_ms", "commits_per_event"):
+        if report[metric] > baseline[metric] * (1 + tolerance):
+            failures.append(f"{metric} {report[metric]:.3f}, baseline {baseline[metric]:.3f}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--reactions", type=int, default=200000, help="reactions already in the database")
+    parser.add_argument("--guilds", type=int, default=3)
+    parser.add_argument("--events", type=int, default=20000, help="reaction events to replay")
+    parser.add_argument("--cached", type=int, default=5000, help="most recent messages primed into the cog's message cache")
+    parser.add_argument("--fetch-rate", type=float, default=0.02, help="share of events on messages that have to be fetched")
+    parser.add_argument("--other-rate", type=float, default=0.1, help="share of events with an emoji that isn't a vote")
+    parser.add_argument("--concurrency", type=int, default=32, help="events in flight at once")
+    parser.add_argument("--profile", choices=PROFILES, default="performance")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--commit-interval", type=float, default=0.25)
+    parser.add_argument("--commit-batch", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare against, exits with status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression against --baseline")
+    args = parser.parse_args()
+
+    print(f"Dataset: {args.users} users, {args.messages} messages, {args.reactions} reactions, {args.guilds} guilds")
+    report = asyncio.run(run(args))
+    print(f"{report['events']} events in {report['seconds']:.2f}s: {report['events_per_sec']:.0f} events/s")
+    print(f"latency p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms")
+    print(f"{report['commits']} commits ({report['commits_per_event']:.4f} per event), {report['fetches']} message fetches, "
+          f"{report['nickname_updates']} nickname updates, message cache hit rate {report['message_cache_hit_rate']:.1%}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = regressions(report, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of the baseline")
+
+if __name__ == "__main__":
+    main()
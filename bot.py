@@ -1,7 +1,12 @@
+import asyncio
 import discord
 import logging
 from discord.ext import commands
-from utility.database import Database
+from utility.async_database import AsyncDatabase
+from utility.metrics import InstrumentedTree, instrument_cog, metrics, record_app_command, rest_trace
+from utility.nicknames import NicknameScheduler
+from utility.profiler import LoopMonitor
+import config
 from config import TOKEN, EXTENSIONS
 import os
 import colorama
@@ -10,13 +15,44 @@ import json
 colorama.init()
 logger = logging.getLogger("client")
 
+# Settings newer than the first config.py, a config.py without them gets the defaults from config.example.py
+DB_PROFILE: str = getattr(config, "DB_PROFILE", "performance")
+DB_MAINTENANCE_INTERVAL: float = getattr(config, "DB_MAINTENANCE_INTERVAL", 3600)
+RETENTION_DAYS: int | None = getattr(config, "RETENTION_DAYS", None)
+MESSAGE_CONTENT_LIMIT: int | None = getattr(config, "MESSAGE_CONTENT_LIMIT", None)
+SLOW_QUERY_THRESHOLD: float | None = getattr(config, "SLOW_QUERY_THRESHOLD", 0.1)
+LOOP_LAG_THRESHOLD: float | None = getattr(config, "LOOP_LAG_THRESHOLD", 0.25)
+DB_COMMIT_INTERVAL: float = getattr(config, "DB_COMMIT_INTERVAL", 0.25)
+DB_COMMIT_BATCH: int = getattr(config, "DB_COMMIT_BATCH", 200)
+NICK_UPDATE_DELAY: float = getattr(config, "NICK_UPDATE_DELAY", 2.0)
+NICK_UPDATE_INTERVAL: float = getattr(config, "NICK_UPDATE_INTERVAL", 1.0)
+NICK_QUEUE_SIZE: int = getattr(config, "NICK_QUEUE_SIZE", 10000)
+METRICS_FILE: str | None = getattr(config, "METRICS_FILE", None)
+METRICS_INTERVAL: float = getattr(config, "METRICS_INTERVAL", 60)
+
 class MiniSigma(commands.Bot):
 
     def __init__(self):
-        super().__init__(command_prefix="!", intents=discord.Intents.all())
-        self.db = Database()
+        super().__init__(command_prefix="!", intents=discord.Intents.all(), tree_cls=InstrumentedTree, http_trace=rest_trace())
+        self.db = AsyncDatabase(commit_interval=DB_COMMIT_INTERVAL, commit_batch=DB_COMMIT_BATCH, profile=DB_PROFILE, content_limit=MESSAGE_CONTENT_LIMIT, slow_query_threshold=SLOW_QUERY_THRESHOLD)
+        self.nicknames = NicknameScheduler(NICK_UPDATE_DELAY, NICK_UPDATE_INTERVAL, NICK_QUEUE_SIZE)
+        self.metrics_dump = None
+        self.loop_monitor = LoopMonitor(LOOP_LAG_THRESHOLD) if LOOP_LAG_THRESHOLD is not None else None
+
+        metrics.export("nickname_queue_depth", lambda: self.nicknames.queue_depth)
+        for counter in ("scheduled", "merged", "skipped", "edited", "failed", "dropped"):
+            metrics.export(f"nickname_{counter}_total", lambda counter=counter: getattr(self.nicknames, counter), "counter")
+        metrics.export("config_cache_hits_total", lambda: self.db.config_hits, "counter")
+        metrics.export("config_cache_misses_total", lambda: self.db.config_misses, "counter")
+
+    async def add_cog(self, cog: commands.Cog, **kwargs):
+        instrument_cog(cog)
+        await super().add_cog(cog, **kwargs)
 
     async def setup_hook(self):
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
+
         for ext in EXTENSIONS:
             try:
                 await self.load_extension('cogs.' + ext)
@@ -25,11 +61,28 @@ class MiniSigma(commands.Bot):
                 pass
                 logger.info(f"Failed to load extension: {e}")
 
+        await self.db.load_guild_configs()
+        self.db.start_maintenance(DB_MAINTENANCE_INTERVAL, RETENTION_DAYS)
+        if METRICS_FILE:
+            self.metrics_dump = asyncio.create_task(metrics.write_periodically(METRICS_FILE, METRICS_INTERVAL))
+
     async def on_ready(self):
         synced = await self.tree.sync()
         logger.info(f"Synced {len(synced)} app commands")
         logger.info(f"{self.user} is now running!")
 
+    async def on_app_command_completion(self, interaction: discord.Interaction, command: discord.app_commands.Command):
+        record_app_command(interaction)
+
+    async def close(self):
+        if self.metrics_dump is not None:
+            self.metrics_dump.cancel()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+        self.nicknames.close()
+        await super().close()
+        await self.db.close()
+
 if __name__ == '__main__':
     file_handler = logging.FileHandler("bot.log", encoding="utf-8")
     file_handler.setFormatter(logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', '%Y-%m-%d %H:%M:%S', style='{'))
@@ -1,7 +1,7 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-from bot import MiniSigma
+from bot import MiniSigma, RETENTION_DAYS, SLOW_QUERY_THRESHOLD
 from utility.utils import create_message_embed
 import subprocess
 import sys
@@ -10,9 +10,16 @@ import time
 import datetime
 import logging
 from zoneinfo import ZoneInfo
-import utility.database as DB
+from utility.async_database import AsyncDatabase
+from utility.database import WINDOWS
 from config import *
 import csv
+import io
+import asyncio
+import threading
+from utility.metrics import metrics
+from utility.database import slow_queries
+from utility.profiler import collapsed_lines, idle_share, sample_stacks
 
 logger = logging.getLogger("client.debug")
 
@@ -22,7 +29,8 @@ class Debug(commands.Cog):
     def __init__(self, client: MiniSigma):
         self.client = client
         self.start_time = datetime.datetime.now(tz=ZoneInfo('US/Eastern'))
-        self.db: DB.Database = client.db
+        self.db: AsyncDatabase = client.db
+        self.profiling = False
 
     @app_commands.command(name="pfp", description="Displays the profile pic of target user. Target defaults to command user if empty")
     @app_commands.describe(target="The server member you would like an image of")
@@ -81,6 +89,10 @@ class Debug(commands.Cog):
         embed.set_author(name=f"{self.client.user.name} Uptime", icon_url=self.client.user.display_avatar.url)
         embed.add_field(name="Start Time:", value=self.start_time.strftime('%Y-%m-%d, %H:%M:%S'), inline=False)
         embed.add_field(name="Time Since Start:", value=f"{days} days, {hours} hr, {minutes} min, {seconds}s", inline=False)
+        monitor = self.client.loop_monitor
+        if monitor is not None:
+            worst = f", worst {monitor.worst.seconds * 1000:.0f} ms in {monitor.worst.handler}" if monitor.worst else ""
+            embed.add_field(name="Event Loop Stalls:", value=f"{len(monitor.stalls)} over {monitor.threshold * 1000:.0f} ms{worst}", inline=False)
         await interaction.response.send_message(embed=embed)
 
     @commands.command()
@@ -99,41 +111,41 @@ class Debug(commands.Cog):
         emoji = emoji.replace("`", "")
         await ctx.reply(f"```{emoji}```")
     
-    async def send_txt(self, ctx: commands.Context, list: list):
+    async def send_txt(self, ctx: commands.Context, list: list, filename: str = "temp.txt"):
         '''Creates a txt file with the string, sends it to a channel, and deletes it'''
-        with open("temp.txt", "w", encoding='utf-8') as f:
+        with open(filename, "w", encoding='utf-8') as f:
             # create string, where each element is a new line
             string = "\n".join([str(x) for x in list])
             f.write(string)
-        with open("temp.txt", "rb") as f:
-            file = discord.File(f, "temp.txt")
+        with open(filename, "rb") as f:
+            file = discord.File(f, filename)
             await ctx.reply(file=file)
-        os.remove("temp.txt")
+        os.remove(filename)
 
     @commands.command()
     async def dump_users(self, ctx: commands.Context):
         '''Replies with the user database'''
-        await self.send_txt(ctx, self.db.list_users())
+        await self.send_txt(ctx, await self.db.list_users())
 
     @commands.command()
     async def dump_fans(self, ctx: commands.Context):
         '''Replies with the fan database'''
-        await self.send_txt(ctx, self.db.list_fans())
+        await self.send_txt(ctx, await self.db.list_fans())
 
     @commands.command()
     async def dump_emojis(self, ctx: commands.Context):
         '''Replies with the emoji database'''
-        await self.send_txt(ctx, self.db.list_emojis())
+        await self.send_txt(ctx, await self.db.list_emojis())
 
     @commands.command()
     async def dump_reactions(self, ctx: commands.Context):
         '''Replies with the reaction database'''
-        await self.send_txt(ctx, self.db.list_reactions())
+        await self.send_txt(ctx, await self.db.list_reactions())
 
     @commands.command()
     async def users_to_csv(self, ctx: commands.Context):
         '''Replies with the user database in CSV format'''
-        users = self.db.list_users() # list of tuples (id, username, upvotes, downvotes, offset)
+        users = await self.db.list_users() # list of tuples (id, username, upvotes, downvotes, offset)
         filename = "users.csv"
 
         with open(filename, "w", newline="", encoding="utf-8") as file:
@@ -146,18 +158,172 @@ class Debug(commands.Cog):
         os.remove(filename)
 
     @commands.command()
-    async def memberotw(self, ctx: commands.Context):
-        '''Replies with the member of the week'''
-        motw = self.db.get_memberotw(ctx.guild.id)
+    @commands.is_owner()
+    async def check_aggregates(self, ctx: commands.Context, fix: bool = False):
+        '''Compares stored vote counters against the Reactions table, rebuilds them if fix is set'''
+        users, fans, messages = await self.db.aggregate_drift()
+        await ctx.reply(f"Drifted counters: {len(users)} users, {len(fans)} fans/haters, {len(messages)} message scores")
+
+        if users or fans or messages:
+            await self.send_txt(ctx, ["(user_id, username, upvotes, downvotes, expected upvotes, expected downvotes)", *users,
+                                      "(user_id, fan_or_hater_id, upvotes, downvotes, expected upvotes, expected downvotes)", *fans,
+                                      "(message_id, up, down, expected up, expected down)", *messages])
+
+        if fix:
+            await self.db.rebuild_aggregates()
+            await ctx.reply("Vote counters rebuilt from Reactions")
+
+    @commands.command()
+    @commands.is_owner()
+    async def explain_queries(self, ctx: commands.Context):
+        '''Replies with the query plan of every statistics query, flagging full table scans'''
+        plans = await self.db.query_plans()
+
+        lines = []
+        full_scans = set()
+        for name, sql, steps in plans:
+            lines.append(f"{name}: {sql}")
+            for step in steps:
+                # "SCAN x USING INDEX" still walks the index in order, a bare "SCAN x" reads the whole table
+                if step.startswith("SCAN") and "INDEX" not in step:
+                    full_scans.add(name)
+                    lines.append(f"    !! {step}")
+                else:
+                    lines.append(f"       {step}")
+            lines.append("")
+
+        summary = ", ".join(sorted(full_scans)) or "none"
+        await ctx.reply(f"Queries with full table scans: {summary}")
+        await self.send_txt(ctx, lines)
+
+    @commands.command()
+    @commands.is_owner()
+    async def config_cache(self, ctx: commands.Context):
+        '''Replies with the guild settings cache hit/miss counters'''
+        hits, misses = self.db.config_hits, self.db.config_misses
+        ratio = hits / (hits + misses) if hits + misses else 0
+        await ctx.reply(f"Guild config cache: {len(self.db.guild_configs)} guilds cached, {hits} hits, {misses} misses ({ratio:.1%} hit rate)")
+
+    @commands.command()
+    @commands.is_owner()
+    async def nick_queue(self, ctx: commands.Context):
+        '''Replies with the nickname scheduler's queue depth and counters'''
+        n = self.client.nicknames
+        await ctx.reply(
+            f"Nickname queue: {n.queue_depth} pending in {len(n.workers)} guilds, {n.scheduled} scheduled, "
+            f"{n.merged} merged, {n.skipped} unchanged, {n.edited} edited, {n.failed} failed, {n.dropped} dropped"
+        )
+
+    @app_commands.command(name="metrics", description="Shows call counts and latencies of the bot's database calls, commands, listeners and REST requests")
+    @app_commands.describe(family="Only show one kind of call", limit="Number of rows to show")
+    @app_commands.choices(family=[app_commands.Choice(name=name, value=name) for name in ("db", "db_wait", "command", "listener", "rest")])
+    async def show_metrics(self, interaction: discord.Interaction, family: str = None, limit: app_commands.Range[int, 1, 30] = 15):
+        '''Replies with the calls that took the most total time, and every metric as a Prometheus text file'''
+        if not await self.client.is_owner(interaction.user):
+            await interaction.response.send_message("Only the bot owner can use this command", ephemeral=True)
+            return
+
+        rows = metrics.summary(family)[:limit]
+        lines = [f"{'name':<40} {'calls':>8} {'total s':>9} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8}"]
+        for (row_family, name, calls, total, p50, p99) in rows:
+            lines.append(f"{(row_family + ':' + name)[:40]:<40} {calls:>8} {total:>9.2f} {total / calls * 1000:>9.2f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+        text = "\n".join(lines)[:1900]
+
+        file = discord.File(io.BytesIO(metrics.prometheus().encode()), "metrics.prom")
+        await interaction.response.send_message(f"```\n{text}\n```", file=file, ephemeral=True)
+
+    @commands.command()
+    @commands.is_owner()
+    async def slow_queries(self, ctx: commands.Context):
+        '''Replies with the statements that took longer than SLOW_QUERY_THRESHOLD, most recent first'''
+        if SLOW_QUERY_THRESHOLD is None:
+            await ctx.reply("Slow query logging is off, set SLOW_QUERY_THRESHOLD in config.py")
+            return
+        if not slow_queries:
+            await ctx.reply(f"No statement took longer than {SLOW_QUERY_THRESHOLD * 1000:.0f} ms yet")
+            return
+
+        queries = list(reversed(slow_queries))
+        await ctx.reply(f"{len(queries)} slow statements, the slowest took {max(q.seconds for q in queries) * 1000:.1f} ms")
+        await self.send_txt(ctx, [
+            f"{q.timestamp:%Y-%m-%d %H:%M:%S} {q.seconds * 1000:.1f} ms in {q.method} for {q.caller or 'no handler'}\n  {q.sql}\n  {q.parameters}"
+            for q in queries
+        ])
+
+    @commands.command()
+    @commands.is_owner()
+    async def profile(self, ctx: commands.Context, seconds: float = 10.0, interval_ms: float = 5.0):
+        '''Samples the event loop's stack for up to a minute and replies with a collapsed stack file for flamegraph.pl or speedscope'''
+        if self.profiling:
+            await ctx.reply("A profile is already running")
+            return
+        seconds = min(max(seconds, 1.0), 60.0)
+        interval = min(max(interval_ms, 1.0), 100.0) / 1000
+
+        self.profiling = True
+        try:
+            await ctx.reply(f"Profiling the event loop for {seconds:.0f} seconds...")
+            loop = asyncio.get_running_loop()
+            samples = await loop.run_in_executor(None, sample_stacks, threading.get_ident(), seconds, interval)
+        finally:
+            self.profiling = False
+
+        await ctx.reply(f"{sum(samples.values())} samples, the loop was idle in {idle_share(samples):.1%} of them")
+        await self.send_txt(ctx, collapsed_lines(samples), "profile.txt")
+
+    @commands.command()
+    @commands.is_owner()
+    async def loop_lag(self, ctx: commands.Context):
+        '''Replies with the handlers that blocked the event loop the longest, and the stack of every recent stall'''
+        monitor = self.client.loop_monitor
+        if monitor is None:
+            await ctx.reply("The loop lag monitor is off, set LOOP_LAG_THRESHOLD in config.py")
+            return
+        if not monitor.stalls:
+            await ctx.reply(f"The event loop hasn't been blocked for {monitor.threshold * 1000:.0f} ms since startup")
+            return
+
+        lines = [f"{stalls}x {total * 1000:.0f} ms total, worst {worst * 1000:.0f} ms: {handler} in {location}" for (handler, location, stalls, total, worst) in monitor.offenders()[:10]]
+        await ctx.reply("\n".join(lines)[:2000])
+        await self.send_txt(ctx, [f"{stall.timestamp:%Y-%m-%d %H:%M:%S} {stall.seconds * 1000:.0f} ms {stall.handler}\n  {stall.stack}" for stall in reversed(monitor.stalls)], "stalls.txt")
+
+    @commands.command()
+    @commands.is_owner()
+    async def archive(self, ctx: commands.Context, days: int = RETENTION_DAYS or 365):
+        '''Moves messages older than days and their reactions to the archive database'''
+        if days <= 7:
+            await ctx.reply("Only messages older than a week can be archived")
+            return
+
+        start = time.perf_counter()
+        (messages, reactions) = await self.db.archive_older_than(days)
+        await ctx.reply(f"Archived {messages} messages and {reactions} reactions older than {days} days in {time.perf_counter() - start:.2f}s")
+
+    @commands.command()
+    async def memberotw(self, ctx: commands.Context, window: str = "week"):
+        '''Replies with the member of the week, or of the day or month'''
+        if window not in WINDOWS:
+            await ctx.reply(f"Window must be one of: {', '.join(WINDOWS)}")
+            return
+
+        motw = await self.db.get_memberotw(ctx.guild.id, window)
         if motw:
-            await ctx.reply(f"Member of the week: <@{motw[0]}>, with {motw[2]} score gained!")
+            await ctx.reply(f"Member of the {window}: <@{motw[0]}>, with {motw[2]} score gained!")
         else:
-            await ctx.reply("No member of the week found")
+            await ctx.reply(f"No member of the {window} found")
 
     @commands.command()
-    async def messageotw(self, ctx: commands.Context):
-        '''Replies with the message of the week'''
-        message_id, channel_id, score = self.db.get_messageotw(ctx.guild.id)
+    async def messageotw(self, ctx: commands.Context, window: str = "week"):
+        '''Replies with the message of the week, or of the day or month'''
+        if window not in WINDOWS:
+            await ctx.reply(f"Window must be one of: {', '.join(WINDOWS)}")
+            return
+
+        motw = await self.db.get_messageotw(ctx.guild.id, window)
+        if motw is None:
+            await ctx.reply(f"No message of the {window} found")
+            return
+        message_id, channel_id, score = motw
 
         channel: discord.TextChannel = self.client.get_channel(channel_id)
         try:
@@ -168,14 +334,14 @@ class Debug(commands.Cog):
         
         embed = create_message_embed(message, EMBED_COLOR)
 
-        await ctx.reply(f"Top message of this week:\n{message.channel.mention}, Score: {score}", embed=embed)
+        await ctx.reply(f"Top message of this {window}:\n{message.channel.mention}, Score: {score}", embed=embed)
     
     @commands.command()
     @commands.is_owner()
     async def give_score(self, ctx: commands.Context, user: discord.Member, score: int):
         '''Gives a user a specified amount of bonus points'''
         # Add to user's offset
-        self.db.c.execute("UPDATE Users SET offset = offset + ? WHERE id = ?", (score, user.id))
+        await self.db.add_offset(user.id, score)
         await ctx.send(f"{score} points have been given to {user.mention}")
 
     @commands.command()
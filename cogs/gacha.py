@@ -8,7 +8,7 @@ from bot import MiniSigma
 from enum import Enum
 import PIL
 import io
-import utility.database as DB
+from utility.async_database import AsyncDatabase
 
 class Rarity(Enum):
     COMMON = ('Common', discord.Colour.greyple())
@@ -23,7 +23,7 @@ class Rarity(Enum):
 class Gacha(commands.Cog):
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db: DB.Database = client.db
+        self.db: AsyncDatabase = client.db
 
     def get_rarity(self, id: int) -> Rarity:
         # Use the last two digits of the user's ID to determine the rarity
@@ -53,7 +53,7 @@ class Gacha(commands.Cog):
     @commands.command()
     async def count_all_rarities(self, ctx: commands.Context):
         '''Count the number of characters of each rarity for all users'''
-        users = self.db.list_users() # Copilot thinks that this should be called get_all_users()
+        users = await self.db.list_users() # Copilot thinks that this should be called get_all_users()
         rarities = self.count_rarities([user[0] for user in users])
         rarity_counts = '\n'.join([f'{rarity}: {count}' for rarity, count in rarities.items()])
         await ctx.send(f'All rarities:\n{rarity_counts}')
@@ -79,7 +79,7 @@ class Gacha(commands.Cog):
 
     @app_commands.command(name="pull", description="Pull a character from the gacha")
     async def pull(self, interaction: discord.Interaction):
-        pulled_card: tuple[int, str, int, int, int] = self.db.pull()
+        pulled_card: tuple[int, str, int, int, int] = await self.db.pull()
         card_id, card_name, card_atk, card_def, _ = pulled_card
         rarity = self.get_rarity(card_id)
 
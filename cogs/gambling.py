@@ -2,12 +2,11 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 from bot import MiniSigma
-import utility.database as DB
+from utility.async_database import AsyncDatabase
 from config import *
 from datetime import datetime
 import logging
 import random
-from utility.utils import nick_update
 
 logger = logging.getLogger("client.gambling")
 
@@ -83,7 +82,7 @@ class BlackjackHand:
 
 class BlackjackInactiveView(discord.ui.View):
     '''View for when the game has ended.'''
-    def __init__(self, db: DB.Database, user: discord.User, bet: int):
+    def __init__(self, db: AsyncDatabase, user: discord.User, bet: int):
         super().__init__(timeout=None)
         self.db = db
         self.active_user = user
@@ -101,13 +100,13 @@ class BlackjackInactiveView(discord.ui.View):
         if not await self.is_correct_user(interaction):
             return
 
-        if not self.db.is_valid_bet(self.active_user.id, self.bet):
+        view = BlackjackView(db=self.db, user=self.active_user, bet=self.bet)
+        if not await view.place_bet():
             logger.info(f"{self.active_user.name} tried to bet {self.bet} points on blackjack, but had insufficient funds")
             await interaction.response.send_message(f"Invalid bet amount: {self.bet}! You need more points!", ephemeral=True)
             return
         
         self.stop()
-        view = BlackjackView(db=self.db, user=self.active_user, bet=self.bet)
         await view.update(interaction)
 
     @discord.ui.button(label="Change bet", style=discord.ButtonStyle.secondary, emoji="💵")
@@ -143,7 +142,7 @@ class BlackjackBetModal(discord.ui.Modal):
 
 
 class BlackjackView(discord.ui.View):
-    def __init__(self, db: DB.Database, user: discord.Member, bet: int = 0):
+    def __init__(self, db: AsyncDatabase, user: discord.Member, bet: int = 0):
         '''View for the blackjack game.'''
         super().__init__(timeout=None)
         self.db = db
@@ -155,12 +154,17 @@ class BlackjackView(discord.ui.View):
         self.dealerHand.cards[1].down = True
 
         self.embed = self.create_embed()
+        self.is_doubled_down = False
 
-        self.db.place_bet(user.id, bet, "blackjack")
+    async def place_bet(self) -> bool:
+        '''Takes the initial bet, must be awaited before the view is shown. Returns False if the user can't cover it'''
+        if not await self.db.place_bet(self.user.id, self.bet, "blackjack"):
+            return False
         logger.info(f"{self.user.name} -{self.bet} points on blackjack")
-        
-        self.is_doubled_down = False
-        self.double_down.disabled = not self.db.is_valid_bet(self.user.id, self.bet)
+
+        # Only a hint, double_down places its bet with the same check
+        self.double_down.disabled = await self.db.get_score(self.user.id) < self.bet
+        return True
 
     def create_embed(self):
         embed = discord.Embed(title=f"Stakes: {self.bet}", color=EMBED_COLOR)
@@ -207,7 +211,7 @@ class BlackjackView(discord.ui.View):
             win_str, win_amount = "Dealer wins!", 0
         
         if win_amount != 0:
-            self.db.win_bet(self.user.id, win_amount, "blackjack")
+            await self.db.win_bet(self.user.id, win_amount, "blackjack")
             self.embed.set_footer(text=f"Winnings: {win_amount-self.bet} points")
             if win_amount > self.bet:
                 self.embed.color = discord.Color.green()
@@ -218,7 +222,7 @@ class BlackjackView(discord.ui.View):
             self.embed.set_footer(text=f"Loss: {self.bet} points")
             self.embed.color = discord.Color.red()
 
-        await nick_update(self.user, self.db.get_score(self.user.id))
+        interaction.client.nicknames.schedule(self.user, await self.db.get_score(self.user.id))
         self.embed.add_field(name="Result:", value=win_str, inline=False)
 
         if self.is_doubled_down:
@@ -263,7 +267,10 @@ class BlackjackView(discord.ui.View):
         if not await self.is_correct_user(interaction):
             return
 
-        self.db.place_bet(self.user.id, self.bet, "blackjack double down")
+        if not await self.db.place_bet(self.user.id, self.bet, "blackjack double down"):
+            logger.info(f"{self.user.name} tried to double down on blackjack, but had insufficient funds")
+            await interaction.response.send_message("You need more points to double down!", ephemeral=True)
+            return
         logger.info(f"{self.user.name} -{self.bet} points on BJ double down")
         
         self.is_doubled_down = True
@@ -280,15 +287,15 @@ class BlackjackView(discord.ui.View):
 class Gambling(commands.Cog):
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db: DB.Database = client.db
+        self.db: AsyncDatabase = client.db
 
     @app_commands.command(name="blackjack", description="Play a game of blackjack")
     @app_commands.describe(bet="The amount of money you want to bet")
     @app_commands.guild_only()
     async def blackjack(self, interaction: discord.Interaction, bet: int = 0):
-        if self.db.is_valid_bet(interaction.user.id, bet):
+        view = BlackjackView(self.db, interaction.user, bet)
+        if await view.place_bet():
             logger.info(f"{interaction.user.name} issued /blackjack {bet}, ({interaction.channel})")
-            view = BlackjackView(self.db, interaction.user, bet)
             await view.send(interaction)
         else:
             logger.info(f"{interaction.user.name} issued /blackjack {bet}, but had insufficient funds ({interaction.channel})")
@@ -303,7 +310,7 @@ class Gambling(commands.Cog):
         if member is None:
             member = interaction.user
 
-        won, lost = self.db.gambling_stats(member.id)
+        won, lost = await self.db.gambling_stats(member.id)
         total = won - lost
 
         embed = discord.Embed(color=EMBED_COLOR)
@@ -5,17 +5,16 @@ from discord.ext import commands
 from discord import app_commands
 from bot import MiniSigma
 from config import EMBED_COLOR
-from utility.database import Database
-from utility.utils import nick_update
+from utility.async_database import AsyncDatabase
 
 class Ticket(discord.ui.View):
     '''Represents a scratch ticket.'''
-    def __init__(self, user: discord.User, db: Database):
+    def __init__(self, user: discord.User, db: AsyncDatabase):
         super().__init__(timeout=None)
         self.user = user
         self.db = db
 
-    def get_lottery_result(self) -> tuple[str, str]:
+    async def get_lottery_result(self) -> tuple[str, str]:
         '''Randomly selects a result for a lottery ticket and returns the text and reward to display.'''
 
         # Possible outcomes are emojis with a message to display
@@ -37,7 +36,7 @@ class Ticket(discord.ui.View):
         result = random.choices(results, weights=weights, k=1)[0]
 
         result_text, reward_text, reward, _ = result        
-        self.db.give_lottery_reward(self.user.id, reward)
+        await self.db.give_lottery_reward(self.user.id, reward)
 
         return result_text, reward_text
 
@@ -54,10 +53,10 @@ class Ticket(discord.ui.View):
         embed = interaction.message.embeds[0]
         embed.description = None
 
-        result_text, reward_text = self.get_lottery_result()
+        result_text, reward_text = await self.get_lottery_result()
         embed.add_field(name=result_text, value=reward_text)
 
-        await nick_update(self.user, self.db.get_score(self.user.id))
+        interaction.client.nicknames.schedule(self.user, await self.db.get_score(self.user.id))
 
         await interaction.message.edit(embed=embed, view=self)
         await interaction.response.defer()
@@ -65,16 +64,15 @@ class Ticket(discord.ui.View):
 class Lottery(commands.Cog):
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db = client.db
-        self.db.create_lottery_tables()
+        self.db: AsyncDatabase = client.db
 
     def create_embed(self) -> discord.Embed:
         '''Creates an embed with three blank spots to be "scratched" later'''
         return discord.Embed(title="Scratch Ticket", description=":grey_question: Scratch to claim!", color=EMBED_COLOR)
     
-    def get_cooldown(self, user_id: int) -> timedelta:
+    async def get_cooldown(self, user_id: int) -> timedelta:
         '''Returns time until the user can do /daily again, 0 if they can play now.'''
-        time_last_played: datetime = self.db.get_lottery_cooldown(user_id) 
+        time_last_played: datetime = await self.db.get_lottery_cooldown(user_id) 
 
         # If we don't have a record, there is no cooldown
         if time_last_played is None:
@@ -93,7 +91,7 @@ class Lottery(commands.Cog):
     @app_commands.command(name="daily", description="Redeem your daily reward!")
     async def daily(self, interaction: discord.Interaction):
         '''Allows the user to play the lottery once per day.'''
-        cooldown = self.get_cooldown(interaction.user.id)
+        cooldown = await self.get_cooldown(interaction.user.id)
         if cooldown.total_seconds() > 0:
            cooldown_str = str(cooldown).split('.')[0]
            await interaction.response.send_message(f"Please wait {cooldown_str} before playing again!", ephemeral=True)
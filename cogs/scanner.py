@@ -1,61 +1,160 @@
+import asyncio
 import datetime
+from dataclasses import dataclass
+from typing import Optional
 import discord
 from discord.ext import commands
-import utility.database as DB
+from utility.async_database import AsyncDatabase
+from utility.message_cache import MessageInfo
 from bot import MiniSigma
+import config
 import logging
 import time
 
 logger = logging.getLogger("client.scanner")
 
+# Settings newer than the first config.py, a config.py without them gets the defaults from config.example.py
+SCAN_CONCURRENCY: int = getattr(config, "SCAN_CONCURRENCY", 4)
+SCAN_CHECKPOINT: int = getattr(config, "SCAN_CHECKPOINT", 100)
+NAME_FETCH_CONCURRENCY: int = getattr(config, "NAME_FETCH_CONCURRENCY", 5)
+
+@dataclass
+class ChannelProgress:
+    '''How far the current scan has got through one channel'''
+    guild: str
+    channel: str
+    start: datetime.datetime
+    stop: datetime.datetime
+    position: Optional[datetime.datetime] = None
+    scanned: int = 0
+    done: bool = False
+
+    @property
+    def span(self) -> float:
+        return (self.stop - self.start).total_seconds()
+
+    @property
+    def covered(self) -> float:
+        if self.done:
+            return self.span
+        if self.position is None:
+            return 0.0
+        return min((self.position - self.start).total_seconds(), self.span)
+
 class Scanner(commands.Cog):
     '''Scanner for logging upvotes in message history'''
 
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db: DB.Database = client.db
+        self.db: AsyncDatabase = client.db
+        self.channel_slots = asyncio.Semaphore(SCAN_CONCURRENCY)
+        self.progress: dict[int, ChannelProgress] = {}
+        self.scan_started: Optional[float] = None
+
+    async def fetch_name(self, user_id: int, slots: asyncio.Semaphore) -> Optional[str]:
+        '''Fetches a user's name over REST, returns None if the user no longer exists'''
+        async with slots:
+            try:
+                return (await self.client.fetch_user(user_id)).name
+            except discord.errors.NotFound:
+                return None
 
     async def fill_names(self):
-        '''Go through the database and fill in the names of users'''
-        for user in self.db.list_users():
+        '''Go through the database and fill in the names of users.
+
+        Names come from the member cache of every guild the bot is in, only users missing from it whose
+        name is still unknown are fetched, at most NAME_FETCH_CONCURRENCY at a time.'''
+        names = []
+        missing = []
+        for (user_id, username, _, _, _) in await self.db.list_users():
+            user = self.client.get_user(user_id)
+            if user is not None:
+                if user.name != username:
+                    names.append((user_id, user.name))
+            elif username == "Unknown":
+                missing.append(user_id)
+
+        slots = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+        fetched = await asyncio.gather(*(self.fetch_name(user_id, slots) for user_id in missing))
+        names += [(user_id, name) for (user_id, name) in zip(missing, fetched) if name is not None]
+
+        changed = await self.db.update_usernames(names)
+        logger.info(f"Finished filling names: {changed} updated, {len(missing)} fetched")
+
+    async def scan_message(self, message: discord.Message, upvote: str, downvote: str) -> list[tuple[MessageInfo, int, int]]:
+        '''Returns every vote on a message as (message, voter_id, vote_type) tuples for Database.ingest_reactions'''
+        info = MessageInfo.from_message(message)
+        votes = []
+        for reaction in message.reactions:
+
+            if str(reaction.emoji) not in [upvote, downvote]:
+                continue
+
+            vote_type = 1 if str(reaction.emoji) == upvote else -1
+            async for voter in reaction.users():
+                if voter.id != message.author.id:
+                    votes.append((info, voter.id, vote_type))
+
+        return votes
+
+    async def scan_channel(self, channel: discord.TextChannel, cursor: Optional[int], stop_at: datetime.datetime, rebuild: bool):
+        '''Scans a channel from its cursor (or creation) up to stop_at, saving the cursor every SCAN_CHECKPOINT messages'''
+        progress = self.progress[channel.id]
+        (upvote, downvote) = await self.db.get_emojis(channel.guild.id)
+        ingest = self.db.ingest_rebuild_reactions if rebuild else self.db.ingest_reactions
+
+        async with self.channel_slots:
+            logger.info(f"Scanning channel: {channel.name}, from {progress.start.strftime('%Y-%m-%d')}")
+            after = discord.Object(cursor) if cursor else channel.created_at
+            unsaved = 0
+            votes = []
             try:
-                member = await self.client.fetch_user(user[0])
-                self.db.update_username(user[0], member.name)
-            except discord.errors.NotFound:
-                self.db.update_username(user[0], "Unknown")
-        logger.info("Finished filling names")
+                async for message in channel.history(limit=None, after=after, before=stop_at, oldest_first=True):
+                    votes += await self.scan_message(message, upvote, downvote)
+                    cursor = message.id
+                    unsaved += 1
+                    progress.position = message.created_at
+                    progress.scanned += 1
+
+                    if unsaved == SCAN_CHECKPOINT:
+                        await ingest(votes)
+                        await self.db.save_scan_cursor(channel.id, channel.guild.id, cursor, unsaved)
+                        unsaved = 0
+                        votes = []
+            except discord.errors.Forbidden:
+                logger.warning(f"Missing access to channel: {channel.name}, skipping")
+            finally:
+                if unsaved:
+                    await ingest(votes)
+                    await self.db.save_scan_cursor(channel.id, channel.guild.id, cursor, unsaved)
+                progress.done = True
+
+    async def scan_guilds(self, guilds: list[discord.Guild], stop_at: datetime.datetime = None, rebuild: bool = False):
+        '''Scans the history of guilds for reactions, resuming each channel from its saved cursor.
+        With rebuild set the reactions go to the rebuild started by Database.start_rebuild.'''
+        stop_at = stop_at or discord.utils.utcnow()
+        self.progress.clear()
+        self.scan_started = time.perf_counter()
+
+        scans = []
+        for guild in guilds:
+            cursors = {channel_id: last_message_id for (channel_id, _, last_message_id, _, _) in await self.db.list_scan_progress(guild.id)}
+            for channel in guild.text_channels:
+                cursor = cursors.get(channel.id)
+                start = discord.utils.snowflake_time(cursor) if cursor else channel.created_at
+                self.progress[channel.id] = ChannelProgress(guild.name, channel.name, start, max(start, stop_at))
+                scans.append(self.scan_channel(channel, cursor, stop_at, rebuild))
+
+        await asyncio.gather(*scans)
+        logger.info(f"Finished scanning guilds: {', '.join(guild.name for guild in guilds)}")
 
     async def scan_guild_history(self, guild: discord.Guild, stop_at: datetime.datetime = None):
         '''Scan the history of a guild for reactions and add them to the database'''
-        (upvote, downvote) = self.db.get_emojis(guild.id)
-        for channel in guild.text_channels:
-            logger.info(f"Scanning channel: {channel.name}, from creation date: {channel.created_at.strftime('%Y-%m-%d')}")
-
-            stop_at = stop_at or datetime.datetime.now()
-            async for message in channel.history(limit=None, after=channel.created_at, before=stop_at):
-                for reaction in message.reactions:
-
-                    if str(reaction.emoji) not in [upvote, downvote]:
-                        continue
-
-                    voters = [voter async for voter in reaction.users()]
-                    for voter in voters:
-                        if voter.id == message.author.id:
-                            continue
-
-                        if str(reaction.emoji) == upvote:
-                            self.db.upvote_user(message.author.id, 1, voter.id)
-                            self.db.add_reaction(voter.id, message, 1, message.created_at.isoformat())
-
-                        else:
-                            self.db.downvote_user(message.author.id, 1, voter.id)
-                            self.db.add_reaction(voter.id, message, -1, message.created_at.isoformat())
-
-        logger.info(f"Finished scanning guild: {guild.name}")
+        await self.scan_guilds([guild], stop_at)
 
     @commands.command()
     async def scan_guild(self, ctx: commands.Context):
-        '''Scan the current guild for reactions and add them to the database'''
+        '''Scan the current guild for reactions newer than the last scan and add them to the database'''
         logger.info(f"{ctx.author.name} issued !scan_guild, ({ctx.channel})")
         await ctx.send(f"Entering reactions for guild: {ctx.guild.name}")
 
@@ -67,20 +166,52 @@ class Scanner(commands.Cog):
 
 
     @commands.command()
-    async def scan_all_guilds(self, ctx: commands.Context):
-        '''Scan all guilds for reactions and add them to the database'''
-        logger.info(f"{ctx.author.name} issued !scan_all_guilds, ({ctx.channel})")
-        self.db.reset_for_scan()
-        stop_at = datetime.datetime.now()
-        await ctx.send(f"DB reset! Entering reactions for all guilds")
+    async def scan_all_guilds(self, ctx: commands.Context, resume: bool = False):
+        '''Rebuilds every guild's reactions from a full rescan, swapped in once finished. `!scan_all_guilds resume` continues an interrupted rebuild'''
+        logger.info(f"{ctx.author.name} issued !scan_all_guilds {resume}, ({ctx.channel})")
+        if not resume:
+            await self.db.start_rebuild()
+            await ctx.send(f"Rebuild started! Entering reactions for all guilds")
+        elif await self.db.rebuild_in_progress():
+            await ctx.send(f"Resuming rebuild for all guilds")
+        else:
+            await ctx.reply("There is no rebuild to resume.")
+            return
 
         start_time = time.perf_counter()
-        for guild in self.client.guilds:
-            await self.scan_guild_history(guild, stop_at)
+        await self.scan_guilds(self.client.guilds, rebuild=True)
+        replayed = await self.db.finish_rebuild()
         total_time = time.perf_counter() - start_time
 
         await self.fill_names()
-        await ctx.reply(f"Reactions entered! Total time: {total_time:.2f} seconds.")
+        await ctx.reply(f"Reactions entered! {replayed} live votes replayed. Total time: {total_time:.2f} seconds.")
+
+    @commands.command()
+    async def scan_status(self, ctx: commands.Context):
+        '''Replies with the progress and estimated time left of the current scan'''
+        if not self.progress:
+            await ctx.reply("No scan has been run since startup.")
+            return
+
+        done = sum(progress.done for progress in self.progress.values())
+        scanned = sum(progress.scanned for progress in self.progress.values())
+        total_span = sum(progress.span for progress in self.progress.values())
+        fraction = sum(progress.covered for progress in self.progress.values()) / total_span if total_span else 1.0
+        elapsed = time.perf_counter() - self.scan_started
+
+        if done == len(self.progress):
+            eta = "finished"
+        elif fraction > 0:
+            eta = f"about {datetime.timedelta(seconds=round(elapsed * (1 - fraction) / fraction))} left"
+        else:
+            eta = "unknown"
+
+        active = [f"{progress.guild}/#{progress.channel}" for progress in self.progress.values() if not progress.done and progress.scanned]
+        await ctx.reply(
+            f"Scan: {done}/{len(self.progress)} channels done, {scanned} messages scanned, {fraction:.1%} of history covered, "
+            f"{datetime.timedelta(seconds=round(elapsed))} elapsed, {eta}.\n"
+            f"Scanning: {', '.join(active[:10]) or 'nothing'}"
+        )
 
 
     async def flat_history_list(self, channel: discord.TextChannel) -> list[discord.Message]:
@@ -4,6 +4,7 @@ from discord.ext import commands
 from discord import app_commands
 
 from bot import MiniSigma
+from utility.async_database import AsyncDatabase
 from utility.utils import create_message_embed
 
 logger = logging.getLogger("client.StarBoard")
@@ -11,9 +12,8 @@ logger = logging.getLogger("client.StarBoard")
 class StarBoard(commands.Cog):
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db = client.db
+        self.db: AsyncDatabase = client.db
         self.default_threshold = 4
-        self.db.create_starboard_tables()
 
     def create_embed(self, message: discord.Message) -> discord.Embed:
         '''Creates an embed for displaying a message on the starboard'''
@@ -34,16 +34,16 @@ class StarBoard(commands.Cog):
             embed=self.create_embed(message)
         )
     
-    def is_starboard_server(self, guild_id: int) -> bool:
+    async def is_starboard_server(self, guild_id: int) -> bool:
         '''Checks if a server has a starboard channel set'''
-        return self.db.get_starboard_channel(guild_id) is not None
+        return await self.db.get_starboard_channel(guild_id) is not None
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, event: discord.RawReactionActionEvent):
         if event.emoji.name != "⭐":
             return
         
-        if not self.is_starboard_server(event.guild_id):
+        if not await self.is_starboard_server(event.guild_id):
             return
 
         channel = self.client.get_channel(event.channel_id)
@@ -51,11 +51,11 @@ class StarBoard(commands.Cog):
 
         logger.info(f"Registered star reaction on message '{channel}'")
 
-        if self.num_stars(message) < self.db.get_starboard_threshold(event.guild_id):
+        if self.num_stars(message) < await self.db.get_starboard_threshold(event.guild_id):
             return
         
-        if self.db.message_is_starboarded(message.id):
-            starboard_message_id, starboard_channel_id = self.db.get_starboard_message(message.id)
+        if await self.db.message_is_starboarded(message.id):
+            starboard_message_id, starboard_channel_id = await self.db.get_starboard_message(message.id)
 
             starboard_channel = self.client.get_channel(starboard_channel_id)
             starboard_message = await starboard_channel.fetch_message(starboard_message_id)
@@ -64,12 +64,12 @@ class StarBoard(commands.Cog):
             await starboard_message.edit(content=f"⭐ {self.num_stars(message)} | <#{message.channel.id}>")
 
         else:
-            starboard_channel_id = self.db.get_starboard_channel(channel.guild.id)
+            starboard_channel_id = await self.db.get_starboard_channel(channel.guild.id)
             starboard_channel = self.client.get_channel(starboard_channel_id)
 
             logger.info(f"Sending message to starboard channel '{starboard_channel.name}'...")
             starboard_message = await self.send_starboard_message(starboard_channel, message)
-            self.db.add_starboard_message(message.id, starboard_message.id, starboard_channel.id)
+            await self.db.add_starboard_message(message.id, starboard_message.id, starboard_channel.id)
 
     @app_commands.command(name="starboard", description="Set the starboard channel & threshold for the server")
     @app_commands.describe(threshold="The number of stars required to display a message on the starboard")
@@ -85,7 +85,7 @@ class StarBoard(commands.Cog):
             return
         
         channel = interaction.channel
-        self.db.set_starboard_channel(interaction.guild_id, channel.id, threshold)
+        await self.db.set_starboard_channel(interaction.guild_id, channel.id, threshold)
 
         content = f"Starboard channel set to {channel.mention}!\
             \nAll future messages with more than {threshold} stars will be displayed here."
@@ -98,7 +98,7 @@ class StarBoard(commands.Cog):
     @commands.is_owner()
     async def starboard_reset(self, ctx: commands.Context):
         '''DROPS ALL STARBOARD TABLES'''
-        self.db.reset_starboard_tables()
+        await self.db.reset_starboard_tables()
         await ctx.send("Starboard database reset!")
 
         logger.info(f"Starboard tables reset globally by {ctx.author.name}")
@@ -1,25 +1,43 @@
 from dataclasses import dataclass
 import re
 import logging
-import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
 import discord
 from discord.ext import commands
 from discord import app_commands
-import utility.database as DB
+from utility.async_database import AsyncDatabase
 from config import *
 from bot import MiniSigma
-from datetime import datetime
-from utility.utils import nick_update, strip_score
+from utility.message_cache import MessageCache, MessageInfo
+from utility.metrics import metrics
+from utility.utils import strip_score
 
 logger = logging.getLogger("client")
 
 class ListPaginator(discord.ui.View):
-    def __init__(self, embed: discord.Embed, data: list):
+    '''Paginated embed list that only loads the page being shown.
+
+    fetch_page(after, backwards, limit) returns up to limit rows that come after the key `after` in list
+    order, or before it when backwards is set (still in list order), with after=None meaning an end of the list.
+    sort_key(row) gives the key of a row, and format_row(row) turns it into an embed field (name, value).
+    '''
+
+    PAGE_SIZE = 5
+    CACHE_SIZE = 8
+
+    def __init__(self, embed: discord.Embed, total: int, fetch_page: Callable[[Optional[tuple], bool, int], Awaitable[list]],
+                 sort_key: Callable[[tuple], tuple], format_row: Callable[[tuple], tuple[str, str]]):
         super().__init__(timeout=None)
         self.embed = embed
-        self.data = data
+        self.fetch_page = fetch_page
+        self.sort_key = sort_key
+        self.format_row = format_row
         self.current_page = 1
-        self.max_page = len(data) // 5 + (len(data) % 5 > 0)
+        self.max_page = total // self.PAGE_SIZE + (total % self.PAGE_SIZE > 0)
+        self.last_page_size = total - (self.max_page - 1) * self.PAGE_SIZE
+        self.rows: list[tuple] = []
+        self.pages: OrderedDict[int, list[tuple]] = OrderedDict()
         self.update_buttons()
 
     def update_buttons(self):
@@ -38,47 +56,68 @@ class ListPaginator(discord.ui.View):
             self.next_button.disabled = False
             self.last_button.disabled = False
 
+        # The previous and next pages are fetched relative to the rows shown, so an empty page can't lead anywhere
+        if not self.rows:
+            self.prev_button.disabled = True
+            self.next_button.disabled = True
+
+    async def load_page(self, page: int, after: Optional[tuple], backwards: bool, limit: int = PAGE_SIZE):
+        '''Makes page the current page, fetching it with the given keyset arguments unless it was viewed recently'''
+        if page in self.pages:
+            self.pages.move_to_end(page)
+        else:
+            rows = await self.fetch_page(after, backwards, limit)
+            # Rows deleted or archived since the list was counted can leave nothing past the current page,
+            # which then stays on display
+            if not rows and self.rows:
+                if not backwards:
+                    self.max_page = self.current_page
+                return
+            self.pages[page] = rows
+            if len(self.pages) > self.CACHE_SIZE:
+                self.pages.popitem(last=False)
+
+        self.current_page = page
+        self.rows = self.pages[page]
+
     def update_embed(self):
         '''Updates the embed with the current page of data'''
-        page = self.current_page - 1
-        start = int(page * 5)
-        end = int(start + 5)
-        page_data = self.data[start:end]
         self.update_buttons()
 
         self.embed.clear_fields()
 
-        for(name, value) in page_data:
+        for (name, value) in map(self.format_row, self.rows):
             self.embed.add_field(name=name, value=value, inline=False)
 
         self.embed.set_footer(text=f"Page {self.current_page}/{self.max_page}")
         return self.embed
 
     async def send(self, interaction: discord.Interaction):
+        await self.load_page(1, None, False)
         self.message = await interaction.response.send_message(embed=self.update_embed(), view=self)
 
     @discord.ui.button(label="", emoji="⏮️", row=0)
     async def first_button(self, interaction: discord.Interaction, _: discord.Button):
         '''Go to the first page of the list'''
-        self.current_page = 1
+        await self.load_page(1, None, False)
         await interaction.response.edit_message(embed=self.update_embed(), view=self)
 
     @discord.ui.button(label="", emoji="⬅️", row=0)
     async def prev_button(self, interaction: discord.Interaction, _: discord.Button):
         '''Go to the previous page of the list'''
-        self.current_page -= 1
+        await self.load_page(self.current_page - 1, self.sort_key(self.rows[0]), True)
         await interaction.response.edit_message(embed=self.update_embed(), view=self)
 
     @discord.ui.button(label="", emoji="➡️", row=0)
     async def next_button(self, interaction: discord.Interaction, _: discord.Button):
         '''Go to the next page of the list'''
-        self.current_page += 1
+        await self.load_page(self.current_page + 1, self.sort_key(self.rows[-1]), False)
         await interaction.response.edit_message(embed=self.update_embed(), view=self)
 
     @discord.ui.button(label="", emoji="⏭️", row=0)
     async def last_button(self, interaction: discord.Interaction, _: discord.Button):
         '''Go to the last page of the list'''
-        self.current_page = self.max_page
+        await self.load_page(self.max_page, None, True, self.last_page_size)
         await interaction.response.edit_message(embed=self.update_embed(), view=self)
 
 class Voting(commands.Cog):
@@ -86,7 +125,11 @@ class Voting(commands.Cog):
 
     def __init__(self, client: MiniSigma):
         self.client = client
-        self.db: DB.Database = client.db
+        self.db: AsyncDatabase = client.db
+        self.messages = MessageCache()
+        metrics.export("message_cache_hits_total", lambda: self.messages.hits, "counter")
+        metrics.export("message_cache_misses_total", lambda: self.messages.misses, "counter")
+        metrics.export("message_cache_size", lambda: len(self.messages.messages))
 
     async def get_nick_or_name(self, interaction: discord.Interaction, id: int) -> str:
         try:
@@ -101,38 +144,53 @@ class Voting(commands.Cog):
 
     # ==================== Vote Detection & Processing ====================
     
+    async def get_message_info(self, event: discord.RawReactionActionEvent) -> MessageInfo:
+        '''Looks up a reacted message in the cache, then the database, and only fetches it from Discord if both miss'''
+        message = self.messages.get(event.message_id)
+        if message is not None:
+            return message
+
+        message = await self.db.get_message(event.message_id)
+        if message is None:
+            channel = self.client.get_channel(event.channel_id)
+            message = MessageInfo.from_message(await channel.fetch_message(event.message_id))
+
+        self.messages.put(message)
+        return message
+
     async def process_reaction(self, event: discord.RawReactionActionEvent) -> None:
-        (upvote, downvote) = self.db.get_emojis(event.guild_id)
+        (upvote, downvote) = await self.db.get_emojis(event.guild_id)
         if str(event.emoji) not in (upvote, downvote):
             return
 
-        channel = self.client.get_channel(event.channel_id)
-        message = await channel.fetch_message(event.message_id)
-
-        target: discord.User = message.author
-        voter = message.guild.get_member(event.user_id)
+        # Only reaction adds carry the author, skip self votes before looking anything up
+        if event.message_author_id == event.user_id:
+            return
 
-        if target.id == voter.id:
+        message = await self.get_message_info(event)
+        if message.author_id == event.user_id:
             return
 
-        count_change = 1 if event.event_type == "REACTION_ADD" else -1
+        guild = self.client.get_guild(event.guild_id)
+        target = guild.get_member(message.author_id)
+        voter = event.member or guild.get_member(event.user_id)
+
         vote_value = 1 if str(event.emoji) == upvote else -1
-        
-        if str(event.emoji) == upvote:
-            new_user_score = self.db.upvote_user(target.id, count_change, voter.id)
-        else:
-            new_user_score = self.db.downvote_user(target.id, count_change, voter.id)
+        added = event.event_type == "REACTION_ADD"
 
-        if count_change == 1:
-            self.db.add_reaction(voter.id, message, vote_value, datetime.now().isoformat())
-        else:
-            self.db.remove_reaction(voter.id, message, vote_value)
-            
-        self.db.update_username(target.id, target.name)
-        self.db.update_username(voter.id, voter.name)
+        target_name = target.name if target is not None else None
+        new_user_score = await self.db.process_vote(message.author_id, target_name, voter.id, voter.name, message, vote_value, added)
+
+        if target is not None:
+            self.client.nicknames.schedule(target, new_user_score)
 
-        await nick_update(target, new_user_score)
-        logger.info(f"{target} {event.event_type[9:]} {vote_value} from {voter} ({message.channel.name}), Score: {new_user_score}")
+        channel = self.client.get_channel(event.channel_id)
+        logger.info(f"{target or message.author_id} {event.event_type[9:]} {vote_value} from {voter} ({channel.name}), Score: {new_user_score}")
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild is not None:
+            self.messages.put(MessageInfo.from_message(message))
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, RawReactionActionEvent: discord.RawReactionActionEvent):
@@ -142,6 +200,26 @@ class Voting(commands.Cog):
     async def on_raw_reaction_remove(self, RawReactionActionEvent: discord.RawReactionActionEvent):
         await self.process_reaction(RawReactionActionEvent)
 
+    # ==================== Guild Membership ====================
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild in self.client.guilds:
+            await self.db.set_guild_members(guild.id, [member.id for member in guild.members])
+        logger.info(f"Synced members of {len(self.client.guilds)} guilds")
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        await self.db.set_guild_members(guild.id, [member.id for member in guild.members])
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        await self.db.add_guild_member(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        await self.db.remove_guild_member(member.guild.id, member.id)
+
     # ==================== Commands ====================
     
     @app_commands.command(name=POINTS_NAME.lower(), description=f"Displays current {POINTS_NAME} score")
@@ -150,7 +228,7 @@ class Voting(commands.Cog):
         '''Displays the user's current score'''
         target = interaction.user if target == None else target
         logger.info(f"{interaction.user.name} issued /{POINTS_NAME.lower()} {target}, ({interaction.channel})")
-        score = self.db.get_score(target.id)
+        score = await self.db.get_score(target.id)
         name = strip_score(target.nick or target.name)
         await interaction.response.send_message(f"{name}'s {POINTS_NAME}: {score}")
 
@@ -161,10 +239,10 @@ class Voting(commands.Cog):
         command = interaction.command.name
         if command == "fans":
             vote = "Upvotes:"
-            db_list = self.db.fans(target.id, 5)
+            db_list = await self.db.fans(target.id, 5)
         else:
             vote = "Downvotes:"
-            db_list = self.db.haters(target.id, 5)
+            db_list = await self.db.haters(target.id, 5)
 
         embed = discord.Embed(title=f"{target.nick or target.name}'s {command.capitalize()}:", color=EMBED_COLOR)
         embed.set_thumbnail(url=target.display_avatar.url)
@@ -204,15 +282,21 @@ class Voting(commands.Cog):
         embed = embed = discord.Embed(color=EMBED_COLOR)
         embed.set_author(name=f"{target.nick or target.name}'s Best Posts:", icon_url=target.display_avatar.url)
 
-        data = list()
-        for (m_id, c_id, g_id, score) in self.db.best_of(target.id):
+        def format_row(row: tuple) -> tuple[str, str]:
+            (m_id, c_id, g_id, score) = row
             message_url = f"https://discord.com/channels/{g_id}/{c_id}/{m_id}"
             channel_link = f"<#{c_id}>"
             field_name = f"Score: {score} {channel_link}"
             field_value = f"[Jump to message]({message_url})"
-            data.append(tuple([field_name, field_value]))
-
-        view = ListPaginator(embed, data)
+            return (field_name, field_value)
+
+        view = ListPaginator(
+            embed,
+            await self.db.count_message_scores(author_id=target.id),
+            lambda after, backwards, limit: self.db.best_of(target.id, limit, after, backwards),
+            lambda row: (row[3], row[0]),
+            format_row
+        )
         await view.send(interaction)
 
     @app_commands.command(name="top_messages", description="Shows most popular messages")
@@ -227,27 +311,33 @@ class Voting(commands.Cog):
         else:
             embed.set_author(name="Top Messages:", icon_url=self.client.user.display_avatar.url)
 
-        data = list()
-        for (author_id, m_id, c_id, g_id, score, content) in self.db.top_messages(interaction.guild.id if guild_only else None):
+        def format_row(row: tuple) -> tuple[str, str]:
+            (author_id, m_id, c_id, g_id, score, content) = row
             message_url = f"https://discord.com/channels/{g_id}/{c_id}/{m_id}"
             preview = content[:100] + "..." if len(content) > 100 else content
             field_name = f"Score: {score}"
             field_value = f'"{preview}"\n -<@{author_id}> [Jump to message]({message_url})'
-            data.append(tuple([field_name, field_value]))
-
-        view = ListPaginator(embed, data)
+            return (field_name, field_value)
+
+        guild_id = interaction.guild.id if guild_only else None
+        view = ListPaginator(
+            embed,
+            await self.db.count_message_scores(guild_id=guild_id),
+            lambda after, backwards, limit: self.db.top_messages(guild_id, limit, after, backwards),
+            lambda row: (row[4], row[1]),
+            format_row
+        )
         await view.send(interaction)
 
     @app_commands.command(name="leaderboard", description="Displays top n scoring individuals")
     @app_commands.describe(guild_only="Set to true to only display score from the current server")
     async def leaderboard(self, interact: discord.Interaction, guild_only: bool = False):
         logger.info(f"{interact.user.name} issued /leaderboard guild_only:{guild_only}, ({interact.channel})")
-        top = self.db.leaderboard()
+        top = await self.db.leaderboard(10, interact.guild.id if guild_only else None)
 
         embed = discord.Embed(color=EMBED_COLOR)
 
         if guild_only:
-            top = [user for user in top if interact.guild.get_member(user[0]) is not None]
             embed.set_author(name=f"{interact.guild.name} Leaderboard", icon_url=interact.guild.icon.url)
         else:
             embed.set_author(name="MiniSigma Leaderboard", icon_url=self.client.user.display_avatar.url)
@@ -256,13 +346,10 @@ class Voting(commands.Cog):
         usernames: list[str] = []
         scores: list[str] = []
 
-        for i in range(10):
-            user = top[i]
-            display_name = user[1]
-
+        for i, (_, display_name, score) in enumerate(top):
             ranks.append(str(i+1))
             usernames.append(display_name)
-            scores.append(str(self.db.get_score(user[0])))
+            scores.append(str(score))
 
         embed.add_field(name="Rank", value="\n".join(ranks), inline=True)
         embed.add_field(name="Name", value="\n".join(usernames), inline=True)
@@ -273,10 +360,7 @@ class Voting(commands.Cog):
     @app_commands.describe(guild_only="Set to true to only display score from the current server")
     async def loserboard(self, interact: discord.Interaction, guild_only: bool = False):
         logger.info(f"{interact.user.name} issued /loserboard guild_only:{guild_only}, ({interact.channel})")
-        top = self.db.loserboard()
-
-        if guild_only:
-            top = [user for user in top if interact.guild.get_member(user[0]) is not None]
+        top = await self.db.loserboard(10, interact.guild.id if guild_only else None)
 
         embed = discord.Embed(color=EMBED_COLOR)
         embed.set_author(name=f"{interact.guild.name} Loserboard", icon_url=self.client.user.display_avatar.url)
@@ -296,13 +380,9 @@ class Voting(commands.Cog):
                 ranks.append("")
 
             usernames.append(name)
-            scores.append(str(self.db.get_score(id)))
+            scores.append(str(score))
 
             last_score = score
-
-            if index == 10:
-                break
-            
             index += 1
 
         embed.add_field(name="Rank", value="\n".join(ranks), inline=True)
@@ -313,42 +393,38 @@ class Voting(commands.Cog):
     @app_commands.command(name="controversial", description="Displays the server's most controversial messages")
     async def controversial(self, interaction: discord.Interaction):
         logger.info(f"{interaction.user.name} issued /controversial, ({interaction.channel})")
-        top = self.db.get_controversial(interaction.guild.id)
-
         embed = discord.Embed(color=EMBED_COLOR)
         embed.set_author(name=f"{interaction.guild.name} Controversial Messages", icon_url=interaction.guild.icon.url)
 
-        data = list()
-        for (author_id, m_id, c_id, g_id, positive, negative, content, _) in top:
+        def format_row(row: tuple) -> tuple[str, str]:
+            (author_id, m_id, c_id, g_id, positive, negative, content, _) = row
             message_url = f"https://discord.com/channels/{g_id}/{c_id}/{m_id}"
             preview = content[:100] + "..." if len(content) > 100 else content
             field_name = f"[ {positive} Up / {negative} Down ]"
             field_value = f'"{preview}"\n -<@{author_id}> [Jump to message]({message_url})'
-            data.append(tuple([field_name, field_value]))
-
-        view = ListPaginator(embed, data)
+            return (field_name, field_value)
+
+        guild_id = interaction.guild.id
+        view = ListPaginator(
+            embed,
+            await self.db.count_message_scores(guild_id=guild_id, voted_only=False),
+            lambda after, backwards, limit: self.db.get_controversial(guild_id, limit, after, backwards),
+            lambda row: (row[7], row[1]),
+            format_row
+        )
         await view.send(interaction)
 
     @commands.command()
     async def manual_save(self, ctx: commands.Context):
-        tasklist = []
-        users = self.db.list_users()
+        '''Queues a nickname update for every member of the guild, unchanged nicknames are skipped'''
+        queued = 0
+        for (user_id, _, upvotes, downvotes, offset) in await self.db.list_users():
+            member = ctx.guild.get_member(user_id)
+            if member is not None:
+                self.client.nicknames.schedule(member, upvotes - downvotes + offset)
+                queued += 1
 
-        for user in users:
-            try:
-                member = ctx.guild.get_member(user[0])
-                score = user[2] - user[3] + user[4]
-                if member is not None:
-                    tasklist.append(nick_update(member, score))
-            except:
-                print(f"Couldn't fetch {user(1)}'s member object, skipping...")
-        
-        try:
-            asyncio.gather(*tasklist)
-        except Exception as e:
-            print(f"An error occurred during batch update: {e}")
-    
-        await ctx.send("Saved!")
+        await ctx.send(f"Queued {queued} nickname updates!")
 
     @app_commands.command(name="userinfo", description="Provides statistics and info about a user")
     async def userinfo(self, interaction: discord.Interaction, target: discord.Member):
@@ -364,21 +440,21 @@ class Voting(commands.Cog):
         embed.add_field(name="MiniSigma Guilds:", value="\n".join([guild.name for guild in target.mutual_guilds]))
         embed.add_field(name="Highest Role:", value=target.top_role)
 
-        user: tuple = self.db.get_user(target.id)
+        user: tuple = await self.db.get_user(target.id)
         embed.add_field(name="**MiniSigma Stats:**", value="")
         embed.add_field(name=f"{POINTS_NAME}:", value=user[2] - user[3] + user[4])
         embed.add_field(name="Upvotes:", value=user[2])
         embed.add_field(name="Downvotes:", value=user[3])
-        embed.add_field(name="Biggest Fan:", value=self.db.fans(target.id, 1))
-        embed.add_field(name="Biggest Hater:", value=self.db.haters(target.id, 1))
+        embed.add_field(name="Biggest Fan:", value=await self.db.fans(target.id, 1))
+        embed.add_field(name="Biggest Hater:", value=await self.db.haters(target.id, 1))
 
         await interaction.response.send_message(content="**WORK IN PROGRESS, NOT DONE**",embed=embed)
 
     @app_commands.command(name="guild_onboarding", description="Initializes guild settings")
     async def guild_onboarding(self, interaction: discord.Interaction):
         '''Initializes guild settings in the database, including upvote and downvote emojis. Does not overwrite existing settings'''
-        self.db.add_guild(interaction.guild_id)
-        emojis = self.db.get_emojis(interaction.guild_id)
+        await self.db.add_guild(interaction.guild_id)
+        emojis = await self.db.get_emojis(interaction.guild_id)
         
         await interaction.response.send_message(f"Server settings initialized, upvote emoji: {emojis[0]}, downvote emoji: {emojis[1]}")
         logger.info(f"({interaction.guild.name}) Guild emojis initialized: Upvote - {emojis[0]}, Downvote - {emojis[1]} by {interaction.user.name}")
@@ -386,7 +462,7 @@ class Voting(commands.Cog):
     @app_commands.command(name="set_emojis", description="Changes the upvote and downvote emojis for the guild")
     async def set_emojis(self, interaction: discord.Interaction, upvote_emoji: str, downvote_emoji: str):
         '''Changes the upvote and downvote emojis for the guild'''
-        self.db.set_emojis(interaction.guild_id, upvote_emoji, downvote_emoji)
+        await self.db.set_emojis(interaction.guild_id, upvote_emoji, downvote_emoji)
 
         await interaction.response.send_message(f"Guild emojis set: Upvote - {upvote_emoji}, Downvote - {downvote_emoji}")
         logger.info(f"({interaction.guild.name}) Guild emojis changed: Upvote - {upvote_emoji}, Downvote - {downvote_emoji} by {interaction.user.name}")
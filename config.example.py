@@ -12,4 +12,45 @@ EXTENSIONS = [
     "gacha",
     "starboard",
     "lottery"
-]
\ No newline at end of file
+]
+
+# SQLite connection profile from utility/database.py PROFILES: "performance" enables WAL,
+# synchronous=NORMAL and larger caches, "default" keeps SQLite's own settings
+DB_PROFILE: str = "performance"
+# Seconds between PRAGMA optimize / WAL checkpoint runs
+DB_MAINTENANCE_INTERVAL: float = 3600
+# Messages older than RETENTION_DAYS and their reactions are moved to database_archive.db during
+# maintenance, every stat still counts them. Must be more than 7, None keeps everything hot.
+RETENTION_DAYS: int | None = None
+# Message content is stored compressed. Setting MESSAGE_CONTENT_LIMIT keeps only that many characters
+# of each new message instead, the leaderboards preview the first 100.
+MESSAGE_CONTENT_LIMIT: int | None = None
+# SQL statements taking at least SLOW_QUERY_THRESHOLD seconds are logged to bot.log and kept for !slow_queries,
+# None turns the timing off
+SLOW_QUERY_THRESHOLD: float | None = 0.1
+# When the event loop is blocked for LOOP_LAG_THRESHOLD seconds, the blocking handler and line are logged and
+# listed by !loop_lag. None turns the lag monitor off.
+LOOP_LAG_THRESHOLD: float | None = 0.25
+
+# Vote writes are committed together once DB_COMMIT_BATCH writes are queued or the oldest
+# is DB_COMMIT_INTERVAL seconds old. Votes inside that window can be lost on a crash.
+DB_COMMIT_INTERVAL: float = 0.25
+DB_COMMIT_BATCH: int = 200
+
+# Nickname edits wait NICK_UPDATE_DELAY seconds so a burst of votes becomes one edit per member,
+# then each guild is edited at most once every NICK_UPDATE_INTERVAL seconds.
+NICK_UPDATE_DELAY: float = 2.0
+NICK_UPDATE_INTERVAL: float = 1.0
+NICK_QUEUE_SIZE: int = 10000
+
+# Call counts and latencies of database calls, commands, listeners and REST requests are shown by /metrics.
+# Setting METRICS_FILE also writes them there in Prometheus text format every METRICS_INTERVAL seconds.
+METRICS_FILE: str | None = None
+METRICS_INTERVAL: float = 60
+
+# History scans read up to SCAN_CONCURRENCY channels at once and save each channel's
+# position every SCAN_CHECKPOINT messages, so an interrupted scan can be resumed.
+SCAN_CONCURRENCY: int = 4
+SCAN_CHECKPOINT: int = 100
+# Users missing from the member cache are fetched over REST this many at a time when filling names
+NAME_FETCH_CONCURRENCY: int = 5
\ No newline at end of file
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from typing import Any, Callable, Coroutine, Optional
+import discord
+from utility.database import Database
+from utility.metrics import current_handler, metrics
+
+logger = logging.getLogger("client.database")
+
+# Database methods that never write, these are spread over the read-only connection pool.
+# Everything else (including getters like get_user and get_emojis that insert missing rows)
+# goes through the single writer thread.
+READ_METHODS = frozenset({
+    "version",
+    "query_plans",
+    "list_users",
+    "list_fans",
+    "aggregate_drift",
+    "leaderboard",
+    "loserboard",
+    "ranked_users",
+    "fans",
+    "haters",
+    "get_score",
+    "get_score_in_guild",
+    "get_memberotw",
+    "list_emojis",
+    "list_reactions",
+    "best_of",
+    "top_messages",
+    "get_messageotw",
+    "list_messages",
+    "get_message",
+    "get_controversial",
+    "count_message_scores",
+    "keyset_page",
+    "gambling_stats",
+    "pull",
+    "list_inventory",
+    "get_starboard_channel",
+    "get_starboard_threshold",
+    "get_starboard_message",
+    "message_is_starboarded",
+    "get_lottery_cooldown",
+    "list_guild_configs",
+    "list_scan_progress",
+    "rebuild_in_progress",
+})
+
+class AsyncDatabase:
+    '''Awaitable facade over Database that keeps all SQLite work off the event loop.
+
+    Every public Database method is available as a coroutine with the same name and arguments,
+    e.g. `await db.get_score(user_id)`. Writes are serialized on a dedicated writer thread which
+    owns the only read-write connection, reads run on a small pool of read-only connections.
+
+    Vote writes are committed in groups: a write may sit in the writer's open transaction for up to
+    commit_interval seconds (or until commit_batch writes are queued) before it is flushed to disk.
+    Readers only see a vote once its group is committed, and close() flushes whatever is left.
+
+    Guild settings (vote emojis, starboard channel and threshold) are cached in memory, so the
+    reaction listeners can check them without touching SQLite. The setters below invalidate it.
+    '''
+
+    def __init__(self, path: str = "database.db", readers: int = 4, commit_interval: float = 0.0, commit_batch: int = 1, profile: str = "default", content_limit: Optional[int] = None, slow_query_threshold: Optional[float] = None):
+        self.path = path
+        self.profile = profile
+        self.content_limit = content_limit
+        self.slow_query_threshold = slow_query_threshold
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.readers = readers
+        self._local = threading.local()
+        self._writer_db: Optional[Database] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._maintenance: Optional[asyncio.Task] = None
+        self.guild_configs: dict[int, tuple[str, str, Optional[int], Optional[int]]] = {}
+        self.config_hits = 0
+        self.config_misses = 0
+        self._config_generation = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer", initializer=self._connect, initargs=(False,))
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader", initializer=self._connect, initargs=(True,))
+
+        # Open the writer connection right away so the schema exists before any reader connects
+        self._writer.submit(lambda: None).result()
+
+    def _connect(self, read_only: bool):
+        '''Opens the connection owned by the current worker thread'''
+        if read_only:
+            self._local.db = Database(self.path, read_only=True, profile=self.profile, slow_query_threshold=self.slow_query_threshold)
+        else:
+            self._local.db = self._writer_db = Database(self.path, commit_interval=self.commit_interval, commit_batch=self.commit_batch, profile=self.profile, content_limit=self.content_limit, slow_query_threshold=self.slow_query_threshold)
+
+    def _call(self, caller: Optional[str], name: str, *args, **kwargs) -> Any:
+        '''Runs a Database method on the current worker's connection for caller, the handler that awaited it,
+        recording its time and the rows it touched'''
+        db = self._local.db
+        db.caller = caller
+        changes = db.conn.total_changes
+        start = time.perf_counter()
+        try:
+            result = getattr(db, name)(*args, **kwargs)
+        except Exception:
+            metrics.increment("db_errors", name)
+            raise
+        finally:
+            metrics.observe("db", name, time.perf_counter() - start)
+
+        # total_changes includes rows changed by triggers, so aggregate upkeep is counted as well
+        written = db.conn.total_changes - changes
+        if written:
+            metrics.increment("db_rows_written", name, written)
+        if isinstance(result, list):
+            metrics.increment("db_rows_read", name, len(result))
+        return result
+
+    async def _run(self, executor: ThreadPoolExecutor, name: str, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        # Unlike the "db" family this includes time spent queued behind other calls on the same executor
+        start = time.perf_counter()
+        result = await loop.run_in_executor(executor, partial(self._call, current_handler.get(), name, *args, **kwargs))
+        metrics.observe("db_wait", name, time.perf_counter() - start)
+
+        # Make sure queued writes get committed even if no further writes arrive to trigger it
+        if executor is self._writer and self._writer_db.pending and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.commit_interval, self._flush_queued)
+
+        return result
+
+    def _flush_queued(self):
+        self._flush_handle = None
+        self._writer.submit(self._call, None, "flush")
+
+    def __getattr__(self, name: str) -> Callable[..., Coroutine[Any, Any, Any]]:
+        if name.startswith("_") or not callable(getattr(Database, name, None)):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        executor = self._readers if name in READ_METHODS else self._writer
+
+        async def method(*args, **kwargs):
+            return await self._run(executor, name, *args, **kwargs)
+
+        method.__name__ = name
+        return method
+
+    def start_maintenance(self, interval: float, retention_days: Optional[int] = None):
+        '''Runs Database.maintain on the writer every interval seconds until close(). With retention_days set,
+        messages older than that are moved to the archive database first'''
+        if retention_days is not None and retention_days <= 7:
+            raise ValueError("Retention must be longer than a week, the weekly stats only read the hot tables")
+
+        async def maintain():
+            while True:
+                await asyncio.sleep(interval)
+                if retention_days is not None:
+                    await self.archive_older_than(retention_days)
+                (busy, wal_pages, checkpointed) = await self._run(self._writer, "maintain")
+                logger.debug(f"Database maintenance: checkpointed {checkpointed}/{wal_pages} WAL pages")
+
+        self._maintenance = asyncio.create_task(maintain())
+
+    async def archive_older_than(self, days: int) -> tuple[int, int]:
+        '''Moves messages older than days and their reactions to the archive, returns the number of (messages, reactions) moved'''
+        cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(days=days))
+        (messages, reactions) = await self._run(self._writer, "archive_before", cutoff)
+        if messages:
+            logger.info(f"Archived {messages} messages and {reactions} reactions older than {days} days")
+        return (messages, reactions)
+
+    # ========== GUILD CONFIG CACHE ==========
+
+    async def load_guild_configs(self):
+        '''Fills the guild settings cache with every guild in the database'''
+        generation = self._config_generation
+        rows = await self._run(self._readers, "list_guild_configs")
+        if generation == self._config_generation:
+            self.guild_configs.update((guild_id, tuple(config)) for (guild_id, *config) in rows)
+        logger.info(f"Loaded settings for {len(rows)} guilds")
+
+    async def guild_config(self, guild_id: int) -> tuple[str, str, Optional[int], Optional[int]]:
+        '''Returns a guild's settings as a tuple (upvote, downvote, starboard channel_id, starboard threshold)'''
+        config = self.guild_configs.get(guild_id)
+        if config is not None:
+            self.config_hits += 1
+            return config
+
+        self.config_misses += 1
+        generation = self._config_generation
+        config = await self._run(self._writer, "guild_config", guild_id)
+
+        # Don't cache a result that a setter invalidated while it was being loaded
+        if generation == self._config_generation:
+            self.guild_configs[guild_id] = config
+        return config
+
+    def invalidate_guild_config(self, guild_id: Optional[int] = None):
+        '''Drops one guild's cached settings, or every guild's if guild_id is None'''
+        self._config_generation += 1
+        if guild_id is None:
+            self.guild_configs.clear()
+        else:
+            self.guild_configs.pop(guild_id, None)
+
+    async def get_emojis(self, id: int) -> tuple[str, str]:
+        (upvote, downvote, _, _) = await self.guild_config(id)
+        return (upvote, downvote)
+
+    async def get_starboard_channel(self, guild_id: int) -> Optional[int]:
+        return (await self.guild_config(guild_id))[2]
+
+    async def get_starboard_threshold(self, guild_id: int) -> Optional[int]:
+        return (await self.guild_config(guild_id))[3]
+
+    async def set_emojis(self, id: int, upvote: str, downvote: str):
+        await self._run(self._writer, "set_emojis", id, upvote, downvote)
+        self.invalidate_guild_config(id)
+
+    async def set_starboard_channel(self, guild_id: int, channel_id: int, threshold: int):
+        await self._run(self._writer, "set_starboard_channel", guild_id, channel_id, threshold)
+        self.invalidate_guild_config(guild_id)
+
+    async def reset_starboard_tables(self):
+        await self._run(self._writer, "reset_starboard_tables")
+        self.invalidate_guild_config()
+
+    async def close(self):
+        '''Waits for queued queries to finish, commits queued writes and closes every connection, off the event loop'''
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+        await asyncio.to_thread(self._close)
+        logger.info("Database connections closed")
+
+    def _close(self):
+        # A connection can only be closed by the thread that owns it. The barrier holds each close call until
+        # every reader thread has taken one, so no thread takes two and leaves another connection open.
+        barrier = threading.Barrier(self.readers)
+
+        def close_reader():
+            barrier.wait()
+            self._local.db.close()
+
+        for closed in [self._readers.submit(close_reader) for _ in range(self.readers)]:
+            closed.result()
+        self._readers.shutdown(wait=True)
+        self._writer.submit(lambda: self._local.db.close()).result()
+        self._writer.shutdown(wait=True)
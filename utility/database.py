@@ -1,20 +1,370 @@
-from typing import Optional
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+import hashlib
+import logging
+import os
 import sqlite3
+import sys
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from discord import Message
+from utility.message_cache import MessageInfo
+from utility.migrations import INDEXES, apply_migrations
+
+# Connection settings applied by Database.__init__ as PRAGMAs, selected with DB_PROFILE in config.py.
+# journal_mode is stored in the database file, so only the writer sets it.
+PROFILES = {
+    "default": {},
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+logger = logging.getLogger("client.database")
+
+# Prepared statements kept per connection, sqlite3 defaults to 128
+STATEMENT_CACHE_SIZE = 512
+
+# Columns of a MessageScores row's message, looked up for the returned rows only. Joining the AllMessages
+# view instead would make SQLite materialize it, while a subquery per row is two primary key probes.
+MESSAGE_CHANNEL = "(SELECT channel_id FROM AllMessages WHERE id = MessageScores.message_id)"
+# Message content lives in Contents and is only decompressed for the rows a query returns
+CONTENT = "(SELECT decode_content(data) FROM Contents WHERE Contents.id = {})"
+MESSAGE_CONTENT = CONTENT.format("(SELECT content_id FROM AllMessages WHERE id = MessageScores.message_id)")
+
+# Hot and archived messages and reactions with only the columns every schema version has. The AllMessages and
+# AllReactions views only exist once the schema is current, code that migrations run reads these instead.
+# A vote is counted once even if it is somehow stored in both partitions, so the counters rebuilt from VOTES
+# and the drift check agree with the distinct votes.
+MESSAGE_KEYS = "(SELECT id, guild_id, author_id, timestamp FROM main.Messages UNION ALL SELECT id, guild_id, author_id, timestamp FROM archive.Messages WHERE id NOT IN (SELECT id FROM main.Messages))"
+VOTES = "(SELECT voter_id, message_id, vote_type FROM main.Reactions UNION SELECT voter_id, message_id, vote_type FROM archive.Reactions)"
+
+# Per-row triggers whose work Database.ingest_reactions does set-based for a whole batch instead
+INGEST_TRIGGERS = ("MessageAdded", "ReactionAdded", "MessageScoreAdded", "MemberHourAdded")
+# Per-row triggers that would uncount reactions Database.archive_before only moves
+ARCHIVE_TRIGGERS = ("ReactionRemoved", "MessageScoreRemoved", "MemberHourRemoved")
+# WHEN clause of every trigger above. Suspending one is a row in SuspendedTriggers rather than dropping it,
+# since DDL would invalidate the prepared statements of every connection to the database.
+UNLESS_SUSPENDED = "WHEN NOT EXISTS (SELECT 1 FROM SuspendedTriggers WHERE name = '{}')"
+
+# Sliding windows of the "of the week" stats in hours. MemberHours only keeps the hourly buckets of
+# messages posted within the longest one, older buckets are pruned by Database.maintain.
+WINDOWS = {"day": 24, "week": 168, "month": 720}
+WINDOW_HORIZON = max(WINDOWS.values()) * 3600
+
+# Seconds since the epoch of an ISO 8601 timestamp such as Messages.timestamp, timezone offset included
+EPOCH = "CAST(strftime('%s', {}) AS INTEGER)"
+
+def encode_content(content: str, limit: Optional[int] = None) -> tuple[bytes, str | bytes]:
+    '''Returns the digest Contents deduplicates on and the form content is stored in: raw deflate data,
+    or the text itself when compressing doesn't make it smaller, as with most short chat messages.
+    With limit set only the first limit characters are kept, followed by "..." if anything was cut.'''
+    if limit is not None and len(content) > limit:
+        content = content[:limit] + "..."
+    text = content.encode()
+    compressed = zlib.compress(text, 9, -15)
+    return (hashlib.blake2b(text, digest_size=16).digest(), compressed if len(compressed) < len(text) else content)
+
+def decode_content(data: str | bytes | None) -> Optional[str]:
+    '''Turns a Contents row's data back into text, registered as an SQL function on every connection'''
+    return zlib.decompress(data, -15).decode() if isinstance(data, bytes) else data
+
+class ExplainCursor:
+    '''Handed out by Database.cursor during a query plan audit, running EXPLAIN QUERY PLAN instead of each statement'''
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+        self.plans: list[tuple[str, list[str]]] = []
+        self.rows: list[tuple] = []
+
+    def execute(self, sql: str, parameters: tuple = ()):
+        self.cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        self.rows = self.cursor.fetchall()
+        self.plans.append((" ".join(sql.split()), [row[3] for row in self.rows]))
+        return self
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self) -> list[tuple]:
+        return self.rows
+
+class SlowQuery(NamedTuple):
+    timestamp: datetime
+    seconds: float
+    method: str
+    caller: Optional[str]
+    sql: str
+    parameters: str
+
+# Statements slower than a Database's slow_query_threshold, shared by every connection in the process
+slow_queries: deque[SlowQuery] = deque(maxlen=200)
+
+def parameter_shape(parameters) -> str:
+    '''Describes statement parameters by their types only, e.g. (int, str, NoneType), so no user data is logged'''
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for (key, value) in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+class TimedCursor(sqlite3.Cursor):
+    '''Handed out by Database.cursor when slow statement logging is on. A statement's time covers its execute
+    call and the fetches made from it, it is logged as soon as that crosses the threshold.'''
+
+    def __init__(self, connection: sqlite3.Connection, db: "Database"):
+        super().__init__(connection)
+        self.db = db
+        self.sql = ""
+        self.parameters = ""
+        self.many = False
+        self.elapsed = 0.0
+        self.logged = False
+
+    def timed(self, start: float):
+        self.elapsed += time.perf_counter() - start
+        if self.elapsed >= self.db.slow_query_threshold and not self.logged:
+            self.logged = True
+            self.db.log_slow_query(self.sql, self.parameters, self.elapsed, self.many)
+
+    def execute(self, sql: str, parameters=()):
+        (self.sql, self.parameters, self.many, self.elapsed, self.logged) = (sql, parameters, False, 0.0, False)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.timed(start)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        (self.sql, self.parameters, self.many, self.elapsed, self.logged) = (sql, seq_of_parameters, True, 0.0, False)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.timed(start)
+
+    def executescript(self, sql_script: str):
+        (self.sql, self.parameters, self.many, self.elapsed, self.logged) = (sql_script, (), False, 0.0, False)
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self.timed(start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.timed(start)
+
+    def fetchmany(self, size: int = 1):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(size)
+        finally:
+            self.timed(start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.timed(start)
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect("database.db")
-        self.c = self.conn.cursor()
-        self.create_tables()
+    def __init__(self, path: str = "database.db", read_only: bool = False, commit_interval: float = 0.0, commit_batch: int = 1, profile: str = "default", migrate: bool = True, archive: Optional[str] = None, content_limit: Optional[int] = None, slow_query_threshold: Optional[float] = None):
+        # Vote writes are grouped into one transaction, committed once commit_batch writes are
+        # queued or the oldest queued write is commit_interval seconds old (see queue_commit)
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.pending = 0
+        self.first_pending = 0.0
+
+        self.read_only = read_only
+        self.explain: Optional[ExplainCursor] = None
+        self.archive_path = archive or f"{os.path.splitext(path)[0]}_archive.db"
+        self.content_limit = content_limit
+        # Statements taking at least slow_query_threshold seconds go to slow_queries and the log, caller is
+        # the listener or command the current call was made for, which AsyncDatabase fills in
+        self.slow_query_threshold = slow_query_threshold
+        self.caller: Optional[str] = None
+
+        # A connection belongs to the thread that opened it, sqlite3 refuses calls from any other thread.
+        # AsyncDatabase gives each of its worker threads a Database of its own.
+        if read_only:
+            # Read-only connections never run DDL, the writer is responsible for the schema
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+            self.conn.create_function("decode_content", 1, decode_content, deterministic=True)
+            self.apply_profile(PROFILES[profile])
+            self.attach_archive(PROFILES[profile])
+            self.create_archive_views()
+        else:
+            self.conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+            self.conn.create_function("decode_content", 1, decode_content, deterministic=True)
+            self.apply_profile(PROFILES[profile])
+            self.attach_archive(PROFILES[profile])
+            # The writer brings the schema up to date, which is a single version check once it is current
+            if migrate:
+                self.migrate()
+            else:
+                self.create_archive_views()
+
+    def migrate(self, dry_run: bool = False) -> list[str]:
+        '''Applies pending schema migrations, see utility/migrations.py. The views are created once the schema is
+        current, they select columns older versions don't have and ALTER TABLE is refused while they exist.'''
+        self.drop_archive_views()
+        try:
+            return apply_migrations(self, dry_run)
+        finally:
+            self.create_archive_views()
+
+    def cursor(self) -> sqlite3.Cursor:
+        '''Returns a new cursor for one operation, so its results can't be clobbered by queries made in between'''
+        if self.explain is not None:
+            return self.explain
+        if self.slow_query_threshold is not None:
+            return TimedCursor(self.conn, self)
+        return self.conn.cursor()
+
+    def log_slow_query(self, sql: str, parameters, seconds: float, many: bool = False):
+        '''Records a slow statement in slow_queries and the log, along with the Database method that ran it'''
+        # The nearest frame of this file outside the cursor is the method that issued the statement
+        frame = sys._getframe(1)
+        while frame is not None and (frame.f_code.co_filename != __file__ or frame.f_code.co_name in ("timed", "execute", "executemany", "executescript", "fetchone", "fetchmany", "fetchall")):
+            frame = frame.f_back
+        method = frame.f_code.co_name if frame is not None else "?"
+
+        if not many:
+            shape = parameter_shape(parameters)
+        elif isinstance(parameters, list):
+            shape = f"{len(parameters)} x {parameter_shape(parameters[0])}" if parameters else "0 rows"
+        else:
+            # A generator has been consumed by now, only its type is known
+            shape = f"rows from a {type(parameters).__name__}"
+
+        query = SlowQuery(datetime.now(), seconds, method, self.caller, " ".join(sql.split()), shape)
+        slow_queries.append(query)
+        logger.warning(f"Slow query ({seconds * 1000:.1f} ms) in {method} for {self.caller or 'no handler'}: {query.sql[:500]} {shape}")
+
+    def apply_profile(self, pragmas: dict[str, object]):
+        '''Sets each PRAGMA of a connection profile on this connection'''
+        c = self.cursor()
+        for pragma, value in pragmas.items():
+            if pragma == "journal_mode" and self.read_only:
+                continue
+            c.execute(f"PRAGMA {pragma} = {value}")
+
+    def attach_archive(self, pragmas: dict[str, object]):
+        '''Attaches the archive database that archive_before moves old messages and reactions to'''
+        c = self.cursor()
+        if self.read_only:
+            c.execute("ATTACH DATABASE ? AS archive", (f"file:{self.archive_path}?mode=ro",))
+        else:
+            c.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            if "journal_mode" in pragmas:
+                c.execute(f"PRAGMA archive.journal_mode = {pragmas['journal_mode']}")
+
+            # The archive is a file of its own, so its schema is checked here rather than by a migration
+            c.execute("SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'Reactions'")
+            if c.fetchone() is None:
+                c.execute("CREATE TABLE IF NOT EXISTS archive.Messages (id INTEGER PRIMARY KEY, channel_id INTEGER, guild_id INTEGER, author_id INTEGER, timestamp TEXT, content_id INTEGER)")
+                c.execute("CREATE TABLE IF NOT EXISTS archive.Reactions (voter_id INTEGER, message_id INTEGER, vote_type INTEGER, timestamp TEXT, PRIMARY KEY (voter_id, message_id, vote_type))")
+                self.conn.commit()
+
+    def create_archive_views(self):
+        '''Creates the connection's views over hot and archived rows. A message voted on after being archived is
+        back in the hot table until the next archive run, so the archived copy is skipped then.'''
+        c = self.cursor()
+        c.execute("""
+            CREATE TEMP VIEW IF NOT EXISTS AllMessages AS
+            SELECT id, channel_id, guild_id, author_id, content_id, timestamp FROM main.Messages
+            UNION ALL
+            SELECT id, channel_id, guild_id, author_id, content_id, timestamp FROM archive.Messages WHERE NOT EXISTS (SELECT 1 FROM main.Messages AS Hot WHERE Hot.id = archive.Messages.id)
+        """)
+        c.execute("CREATE TEMP VIEW IF NOT EXISTS AllReactions AS SELECT * FROM main.Reactions UNION ALL SELECT * FROM archive.Reactions")
+
+    def drop_archive_views(self):
+        c = self.cursor()
+        c.execute("DROP VIEW IF EXISTS temp.AllMessages")
+        c.execute("DROP VIEW IF EXISTS temp.AllReactions")
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        '''Runs the body of the with statement in a transaction of its own, committed once the body completes and
+        rolled back if it raises. Writes queued by queue_commit are committed first, so a rollback can't drop them.'''
+        self.flush()
+        self.cursor().execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    @contextmanager
+    def suspended_triggers(self, names: tuple[str, ...]) -> Iterator[None]:
+        '''Switches the named triggers off for the body of the with statement, which must run inside a transaction'''
+        c = self.cursor()
+        c.executemany("INSERT OR IGNORE INTO SuspendedTriggers (name) VALUES (?)", [(name,) for name in names])
+        try:
+            yield
+        finally:
+            c.executemany("DELETE FROM SuspendedTriggers WHERE name = ?", [(name,) for name in names])
+
+    def maintain(self) -> tuple[int, int, int]:
+        '''Lets SQLite refresh its query planner statistics and checkpoints the WAL into the database file.
+        Returns the checkpoint result (busy, WAL pages, pages checkpointed)'''
+        self.prune_member_hours()
+        self.flush()
+        c = self.cursor()
+        c.execute("PRAGMA optimize")
+        c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return c.fetchone()
     
+    def trace_statements(self, callback: Optional[Callable[[str], None]]):
+        '''Calls callback with the SQL of every statement this connection runs, None stops tracing'''
+        self.conn.set_trace_callback(callback)
+
     def version(self):
-        self.c.execute("select sqlite_version();")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("select sqlite_version();")
+        return c.fetchall()
+
+    def close(self):
+        self.flush()
+        if not self.read_only:
+            self.conn.execute("PRAGMA optimize")
+        self.conn.close()
+
+    def queue_commit(self):
+        '''Commits now, or leaves the transaction open so it can be grouped with the writes that follow'''
+        if self.commit_batch <= 1:
+            self.conn.commit()
+            return
+
+        self.pending += 1
+        if self.pending == 1:
+            self.first_pending = time.monotonic()
+
+        if self.pending >= self.commit_batch or time.monotonic() - self.first_pending >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        '''Commits any writes queued by queue_commit'''
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.pending = 0
     
     def create_tables(self):
-        self.c.execute('''
+        '''Creates the baseline schema, the tables the bot had before schema_version existed. Everything added
+        since is created by the migration that introduced it, so this is migration 1 and must not change.'''
+        c = self.cursor()
+        c.execute('''
             CREATE TABLE IF NOT EXISTS Users (
                 id INTEGER PRIMARY KEY,
                 username TEXT NOT NULL,
@@ -23,7 +373,7 @@ class Database:
                 offset INTEGER
             )''')
         
-        self.c.execute('''
+        c.execute('''
             CREATE TABLE IF NOT EXISTS FansAndHaters (
                 user_id INTEGER,
                 fan_or_hater_id INTEGER,
@@ -34,14 +384,14 @@ class Database:
                 FOREIGN KEY (fan_or_hater_id) REFERENCES Users(id)
             )''')
         
-        self.c.execute('''
+        c.execute('''
             CREATE TABLE IF NOT EXISTS Emojis (
                 guild_id INTEGER PRIMARY KEY,
                 upvote TEXT,
                 downvote TEXT
             )''')
         
-        self.c.execute('''
+        c.execute('''
             CREATE TABLE IF NOT EXISTS Messages (
                 id INTEGER PRIMARY KEY,
                 channel_id INTEGER,
@@ -53,7 +403,7 @@ class Database:
                 FOREIGN KEY (guild_id) REFERENCES Emojis(guild_id)
             )''')
         
-        self.c.execute('''
+        c.execute('''
             CREATE TABLE IF NOT EXISTS Reactions (
                 voter_id INTEGER,
                 message_id INTEGER,
@@ -63,256 +413,895 @@ class Database:
                 FOREIGN KEY (voter_id) REFERENCES Users(id),
                 FOREIGN KEY (message_id) REFERENCES Messages(id)
             )''')
-        
-        self.conn.commit()
 
         self.create_gambling()
+        self.create_starboard_tables()
+        self.create_lottery_tables()
+
+    def create_vote_triggers(self):
+        '''Creates the triggers that derive the vote counters from Reactions and the gambling offsets from Transactions'''
+        self.create_suspended_triggers_table()
+        self.create_reaction_triggers()
+        self.create_transaction_trigger()
+
+    def create_suspended_triggers_table(self):
+        c = self.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS SuspendedTriggers (name TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def create_reaction_triggers(self):
+        c = self.cursor()
+        # Users and FansAndHaters vote counters are derived from Reactions, so recording or deleting
+        # a reaction is the only write a vote needs and the counters can never drift from it
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS ReactionAdded AFTER INSERT ON Reactions {UNLESS_SUSPENDED.format("ReactionAdded")}
+            BEGIN
+                INSERT OR IGNORE INTO Users (id, username, upvotes, downvotes, offset)
+                    SELECT author_id, 'Unknown', 0, 0, 100 FROM Messages WHERE id = NEW.message_id;
+
+                UPDATE Users
+                SET upvotes = upvotes + (NEW.vote_type > 0), downvotes = downvotes + (NEW.vote_type < 0)
+                WHERE id = (SELECT author_id FROM Messages WHERE id = NEW.message_id);
+
+                INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes)
+                    SELECT author_id, NEW.voter_id, NEW.vote_type > 0, NEW.vote_type < 0 FROM Messages WHERE id = NEW.message_id
+                    ON CONFLICT (user_id, fan_or_hater_id) DO UPDATE
+                    SET upvotes = upvotes + excluded.upvotes, downvotes = downvotes + excluded.downvotes;
+            END''')
+
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS ReactionRemoved AFTER DELETE ON Reactions {UNLESS_SUSPENDED.format("ReactionRemoved")}
+            BEGIN
+                UPDATE Users
+                SET upvotes = upvotes - (OLD.vote_type > 0), downvotes = downvotes - (OLD.vote_type < 0)
+                WHERE id = (SELECT author_id FROM Messages WHERE id = OLD.message_id);
+
+                UPDATE FansAndHaters
+                SET upvotes = upvotes - (OLD.vote_type > 0), downvotes = downvotes - (OLD.vote_type < 0)
+                WHERE user_id = (SELECT author_id FROM Messages WHERE id = OLD.message_id) AND fan_or_hater_id = OLD.voter_id;
+            END''')
+
+    def create_message_scores(self):
+        '''Creates the MessageScores rollup table and the triggers that keep it current'''
+        c = self.cursor()
+
+        # One row per message holding its vote totals. Controversy matches what get_controversial used
+        # to compute from Reactions on every call (total votes, when a message has both up and down votes)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS MessageScores (
+                message_id INTEGER PRIMARY KEY,
+                guild_id INTEGER,
+                author_id INTEGER,
+                up INTEGER NOT NULL DEFAULT 0,
+                down INTEGER NOT NULL DEFAULT 0,
+                posted INTEGER,
+                net INTEGER GENERATED ALWAYS AS (up - down) VIRTUAL,
+                controversy REAL GENERATED ALWAYS AS (CASE WHEN up > 0 AND down > 0 THEN up + down ELSE 0.0 END) VIRTUAL,
+                FOREIGN KEY (message_id) REFERENCES Messages(id)
+            )''')
+
+        self.create_message_added_trigger()
+        self.create_message_score_triggers()
+
+        # Only migration 4 gets here, so the table is filled whether or not an interrupted run already created it
+        self.backfill_message_scores()
+
+    def create_message_score_triggers(self):
+        c = self.cursor()
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS MessageScoreAdded AFTER INSERT ON Reactions {UNLESS_SUSPENDED.format("MessageScoreAdded")}
+            BEGIN
+                UPDATE MessageScores SET up = up + (NEW.vote_type > 0), down = down + (NEW.vote_type < 0) WHERE message_id = NEW.message_id;
+            END''')
+
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS MessageScoreRemoved AFTER DELETE ON Reactions {UNLESS_SUSPENDED.format("MessageScoreRemoved")}
+            BEGIN
+                UPDATE MessageScores SET up = up - (OLD.vote_type > 0), down = down - (OLD.vote_type < 0) WHERE message_id = OLD.message_id;
+            END''')
+
+    def create_message_added_trigger(self):
+        c = self.cursor()
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS MessageAdded AFTER INSERT ON Messages {UNLESS_SUSPENDED.format("MessageAdded")}
+            BEGIN
+                INSERT OR IGNORE INTO MessageScores (message_id, guild_id, author_id, posted) VALUES (NEW.id, NEW.guild_id, NEW.author_id, {EPOCH.format("NEW.timestamp")});
+            END''')
+
+    def backfill_message_scores(self):
+        '''Fills MessageScores from the hot and archived Messages and Reactions'''
+        c = self.cursor()
+        c.execute(f"""
+            INSERT OR REPLACE INTO MessageScores (message_id, guild_id, author_id, up, down, posted)
+            SELECT Messages.id, Messages.guild_id, Messages.author_id, COALESCE(SUM(Reactions.vote_type > 0), 0), COALESCE(SUM(Reactions.vote_type < 0), 0), {EPOCH.format("Messages.timestamp")}
+            FROM {MESSAGE_KEYS} AS Messages LEFT JOIN {VOTES} AS Reactions ON Messages.id = Reactions.message_id
+            GROUP BY Messages.id
+        """)
+
+    def query_plans(self) -> list[tuple[str, str, list[str]]]:
+        '''Runs EXPLAIN QUERY PLAN for every statistics query, returned as a list of tuples (method, sql, plan steps)'''
+        queries = [
+            ("leaderboard", (10,)),
+            ("leaderboard", (10, 0)),
+            ("loserboard", (10,)),
+            ("loserboard", (10, 0)),
+            ("fans", (0, 5)),
+            ("haters", (0, 5)),
+            ("get_score", (0,)),
+            ("get_score_in_guild", (0, 0)),
+            ("get_memberotw", (0,)),
+            ("best_of", (0,)),
+            ("top_messages", ()),
+            ("top_messages", (0,)),
+            ("get_messageotw", (0,)),
+            ("get_controversial", (0,)),
+            ("gambling_stats", (0,)),
+        ]
+
+        self.explain = ExplainCursor(self.conn.cursor())
+        plans = []
+        try:
+            for name, args in queries:
+                getattr(self, name)(*args)
+                plans.extend((name, sql, plan) for sql, plan in self.explain.plans)
+                self.explain.plans.clear()
+        finally:
+            self.explain = None
+
+        return plans
 
     # ========== USER MANAGEMENT ==========
     
     def add_user(self, id: int, name: str):
-        self.c.execute("INSERT OR IGNORE INTO Users (id, username, upvotes, downvotes, offset) VALUES (?, ?, ?, ?, ?)", (id, name, 0, 0, 100))
-        self.conn.commit()
+        c = self.cursor()
+        c.execute("INSERT OR IGNORE INTO Users (id, username, upvotes, downvotes, offset) VALUES (?, ?, ?, ?, ?)", (id, name, 0, 0, 100))
+        self.queue_commit()
 
     def update_username(self, id: int, new_username: str):
-        self.add_user(id, new_username)
-        self.c.execute("UPDATE Users SET username = ? WHERE id = ?", (new_username, id))
-        self.conn.commit()
+        c = self.cursor()
+        c.execute("INSERT INTO Users (id, username, upvotes, downvotes, offset) VALUES (?, ?, 0, 0, 100) ON CONFLICT (id) DO UPDATE SET username = excluded.username", (id, new_username))
+        self.queue_commit()
+
+    def update_usernames(self, names: list[tuple[int, str]]) -> int:
+        '''Renames many (id, username) users in one transaction and returns how many names changed'''
+        c = self.cursor()
+        c.executemany("UPDATE Users SET username = ?2 WHERE id = ?1 AND username IS NOT ?2", names)
+        changed = c.rowcount
+        self.flush()
+        return changed
 
     def get_user(self, id: int) -> tuple[int, str, int, int, int]:
-        self.c.execute("SELECT * FROM Users WHERE id = ?", (id,))
-        result = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT * FROM Users WHERE id = ?", (id,))
+        result = c.fetchone()
         if result is None:
             self.add_user(id, "Unknown")
             return self.get_user(id)
         return result
     
     def list_users(self) -> list[tuple[int, str, int, int, int]]:
-        self.c.execute("SELECT * FROM Users")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT * FROM Users")
+        return c.fetchall()
     
-    def upvote_user(self, id: int, change: int, voter_id: int) -> int:
-        user = self.get_user(id)
-        self.c.execute("UPDATE Users SET upvotes = ? WHERE id = ?", (user[2] + change, id))
+    def add_offset(self, id: int, amount: int):
+        '''Adds bonus points to a user's offset'''
+        c = self.cursor()
+        c.execute("UPDATE Users SET offset = offset + ? WHERE id = ?", (amount, id))
         self.conn.commit()
-        self.update_fans(id, change, voter_id)
-        return self.get_score(id)
-    
-    def downvote_user(self, id: int, change: int, voter_id: int) -> int:
-        user = self.get_user(id)
-        self.c.execute("UPDATE Users SET downvotes = ? WHERE id = ?", (user[3] + change, id))
-        self.conn.commit()
-        self.update_haters(id, change, voter_id)
-        return self.get_score(id)
-    
-    # ========== FANS AND HATERS ==========
 
-    def update_fans(self, id: int, change: int, voter_id: int):
-        self.c.execute("SELECT * FROM FansAndHaters WHERE user_id = ? AND fan_or_hater_id = ?", (id, voter_id))
-        result = self.c.fetchone()
-        if result is None:
-            self.c.execute("INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes) VALUES (?, ?, ?, ?)", (id, voter_id, change, 0))
+    def process_vote(self, target_id: int, target_name: Optional[str], voter_id: int, voter_name: str, message: MessageInfo, vote_type: int, added: bool) -> int:
+        '''Records one reaction being added or removed and returns the target's new score. The target's
+        stored name is left alone if target_name is None'''
+        if target_name is None:
+            self.add_user(target_id, "Unknown")
         else:
-            new_score = result[2] + change
-            self.c.execute("UPDATE FansAndHaters SET upvotes = ? WHERE user_id = ? AND fan_or_hater_id = ?", (new_score, id, voter_id))
-        self.conn.commit()
+            self.update_username(target_id, target_name)
+        self.update_username(voter_id, voter_name)
 
-    def update_haters(self, id: int, change: int, voter_id: int):
-        self.c.execute("SELECT * FROM FansAndHaters WHERE user_id = ? AND fan_or_hater_id = ?", (id, voter_id))
-        result = self.c.fetchone()
-        if result is None:
-            self.c.execute("INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes) VALUES (?, ?, ?, ?)", (id, voter_id, 0, change))
+        if added:
+            self.add_reaction(voter_id, message, vote_type, datetime.now().isoformat())
         else:
-            new_score = result[3] + change
-            self.c.execute("UPDATE FansAndHaters SET downvotes = ? WHERE user_id = ? AND fan_or_hater_id = ?", (new_score, id, voter_id))
-        self.conn.commit()
+            self.remove_reaction(voter_id, message, vote_type)
+
+        return self.get_score(target_id)
+
+    # ========== FANS AND HATERS ==========
 
     def list_fans(self) -> list[tuple[int, int, int, int]]:
-        self.c.execute("SELECT * FROM FansAndHaters")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT * FROM FansAndHaters")
+        return c.fetchall()
+
+    # ========== AGGREGATE VERIFICATION ==========
+
+    def aggregate_drift(self) -> tuple[list[tuple[int, str, int, int, int, int]], list[tuple[int, int, int, int, int, int]], list[tuple[int, int, int, int, int]]]:
+        '''Recomputes vote counters from hot and archived reactions and returns the rows that disagree with the stored ones, as
+        (user_id, username, upvotes, downvotes, expected upvotes, expected downvotes) for Users,
+        (user_id, fan_or_hater_id, upvotes, downvotes, expected upvotes, expected downvotes) for FansAndHaters and
+        (message_id, up, down, expected up, expected down) for MessageScores'''
+        c = self.cursor()
+        c.execute(f"""
+            WITH Expected AS (
+                SELECT Messages.author_id AS id, SUM(Reactions.vote_type > 0) AS upvotes, SUM(Reactions.vote_type < 0) AS downvotes
+                FROM {VOTES} AS Reactions JOIN AllMessages AS Messages ON Reactions.message_id = Messages.id
+                GROUP BY Messages.author_id
+            )
+            SELECT Users.id, Users.username, Users.upvotes, Users.downvotes, COALESCE(Expected.upvotes, 0), COALESCE(Expected.downvotes, 0)
+            FROM Users LEFT JOIN Expected ON Users.id = Expected.id
+            WHERE Users.upvotes != COALESCE(Expected.upvotes, 0) OR Users.downvotes != COALESCE(Expected.downvotes, 0)
+        """)
+        users = c.fetchall()
+
+        c.execute(f"""
+            WITH Expected AS (
+                SELECT Messages.author_id AS user_id, Reactions.voter_id AS fan_or_hater_id, SUM(Reactions.vote_type > 0) AS upvotes, SUM(Reactions.vote_type < 0) AS downvotes
+                FROM {VOTES} AS Reactions JOIN AllMessages AS Messages ON Reactions.message_id = Messages.id
+                GROUP BY Messages.author_id, Reactions.voter_id
+            )
+            SELECT FansAndHaters.user_id, FansAndHaters.fan_or_hater_id, FansAndHaters.upvotes, FansAndHaters.downvotes, COALESCE(Expected.upvotes, 0), COALESCE(Expected.downvotes, 0)
+            FROM FansAndHaters LEFT JOIN Expected USING (user_id, fan_or_hater_id)
+            WHERE FansAndHaters.upvotes != COALESCE(Expected.upvotes, 0) OR FansAndHaters.downvotes != COALESCE(Expected.downvotes, 0)
+            UNION ALL
+            SELECT Expected.user_id, Expected.fan_or_hater_id, 0, 0, Expected.upvotes, Expected.downvotes
+            FROM Expected LEFT JOIN FansAndHaters USING (user_id, fan_or_hater_id)
+            WHERE FansAndHaters.user_id IS NULL
+        """)
+        fans = c.fetchall()
+
+        c.execute(f"""
+            WITH Expected AS (
+                SELECT Messages.id AS message_id, COALESCE(SUM(Reactions.vote_type > 0), 0) AS up, COALESCE(SUM(Reactions.vote_type < 0), 0) AS down
+                FROM AllMessages AS Messages LEFT JOIN {VOTES} AS Reactions ON Messages.id = Reactions.message_id
+                GROUP BY Messages.id
+            )
+            SELECT Expected.message_id, COALESCE(MessageScores.up, 0), COALESCE(MessageScores.down, 0), Expected.up, Expected.down
+            FROM Expected LEFT JOIN MessageScores USING (message_id)
+            WHERE MessageScores.message_id IS NULL OR MessageScores.up != Expected.up OR MessageScores.down != Expected.down
+        """)
+        messages = c.fetchall()
+
+        return (users, fans, messages)
+
+    def rebuild_aggregates(self):
+        '''Recomputes every Users, FansAndHaters, MessageScores and MemberHours vote counter from the hot and archived reactions'''
+        with self.transaction():
+            self.recount_aggregates()
+
+    def recount_aggregates(self):
+        '''Does the work of rebuild_aggregates in the caller's transaction'''
+        c = self.cursor()
+        c.execute(f"INSERT OR IGNORE INTO Users (id, username, upvotes, downvotes, offset) SELECT DISTINCT Messages.author_id, 'Unknown', 0, 0, 100 FROM {VOTES} AS Reactions JOIN AllMessages AS Messages ON Reactions.message_id = Messages.id")
+        c.execute("UPDATE Users SET upvotes = 0, downvotes = 0")
+        c.execute(f"""
+            UPDATE Users SET upvotes = Totals.upvotes, downvotes = Totals.downvotes
+            FROM (
+                SELECT Messages.author_id AS id, SUM(Reactions.vote_type > 0) AS upvotes, SUM(Reactions.vote_type < 0) AS downvotes
+                FROM {VOTES} AS Reactions JOIN AllMessages AS Messages ON Reactions.message_id = Messages.id
+                GROUP BY Messages.author_id
+            ) AS Totals
+            WHERE Users.id = Totals.id
+        """)
+        c.execute("DELETE FROM FansAndHaters")
+        c.execute(f"""
+            INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes)
+            SELECT Messages.author_id, Reactions.voter_id, SUM(Reactions.vote_type > 0), SUM(Reactions.vote_type < 0)
+            FROM {VOTES} AS Reactions JOIN AllMessages AS Messages ON Reactions.message_id = Messages.id
+            GROUP BY Messages.author_id, Reactions.voter_id
+        """)
+        self.backfill_message_scores()
+        self.rebuild_member_hours()
 
     # ========== STATISTICS ==========
         
-    def leaderboard(self) -> list[tuple[int, str, int]]:
-        '''Returns users in order of score as a list of tuples (user_id, username, upvotes-downvotes)'''
-        self.c.execute("SELECT id, username, upvotes-downvotes+offset FROM Users ORDER BY upvotes-downvotes+offset DESC")
-        return self.c.fetchall()
+    def leaderboard(self, num: Optional[int] = None, guild_id: Optional[int] = None) -> list[tuple[int, str, int]]:
+        '''Returns the top num users in order of score as a list of tuples (user_id, username, upvotes-downvotes),
+        only counting current members of guild_id if it is given'''
+        return self.ranked_users("DESC", num, guild_id)
     
-    def loserboard(self) -> list[tuple[int, str, int]]:
-        '''Returns users in order of score as a list of tuples (user_id, username, downvotes-upvotes)'''
-        self.c.execute("SELECT id, username, upvotes-downvotes+offset FROM Users ORDER BY upvotes-downvotes+offset ASC")
-        return self.c.fetchall()
+    def loserboard(self, num: Optional[int] = None, guild_id: Optional[int] = None) -> list[tuple[int, str, int]]:
+        '''Returns the bottom num users in order of score as a list of tuples (user_id, username, downvotes-upvotes),
+        only counting current members of guild_id if it is given'''
+        return self.ranked_users("ASC", num, guild_id)
+
+    def ranked_users(self, order: str, num: Optional[int], guild_id: Optional[int]) -> list[tuple[int, str, int]]:
+        '''Shared query for leaderboard and loserboard'''
+        c = self.cursor()
+        query = "SELECT Users.id, Users.username, Users.upvotes-Users.downvotes+Users.offset FROM Users"
+        params = []
+        if guild_id is not None:
+            # Probing membership per user lets SQLite walk the score index and stop once num members
+            # are found, instead of joining and sorting the whole guild
+            query += " WHERE EXISTS (SELECT 1 FROM GuildMembers WHERE GuildMembers.guild_id = ? AND GuildMembers.user_id = Users.id)"
+            params.append(guild_id)
+
+        query += f" ORDER BY Users.upvotes-Users.downvotes+Users.offset {order}"
+        if num is not None:
+            query += " LIMIT ?"
+            params.append(num)
+
+        c.execute(query, params)
+        return c.fetchall()
 
     def fans(self, id: int, num: int) -> list[tuple[int, str, int]]:
         '''Returns top fans of a user as a list of tuples (user_id, username, upvotes)'''
-        self.c.execute("SELECT FansAndHaters.fan_or_hater_id, Users.username, FansAndHaters.upvotes FROM FansAndHaters JOIN Users ON FansAndHaters.fan_or_hater_id = Users.id WHERE FansAndHaters.user_id = ? ORDER BY FansAndHaters.upvotes DESC LIMIT ?", (id, num))
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT FansAndHaters.fan_or_hater_id, Users.username, FansAndHaters.upvotes FROM FansAndHaters JOIN Users ON FansAndHaters.fan_or_hater_id = Users.id WHERE FansAndHaters.user_id = ? ORDER BY FansAndHaters.upvotes DESC LIMIT ?", (id, num))
+        return c.fetchall()
     
     def haters(self, id: int, num: int) -> list[tuple[int, str, int]]:
         '''Returns top haters of a user as a list of tuples (user_id, username, downvotes)'''
-        self.c.execute("SELECT FansAndHaters.fan_or_hater_id, Users.username, FansAndHaters.downvotes FROM FansAndHaters JOIN Users ON FansAndHaters.fan_or_hater_id = Users.id WHERE FansAndHaters.user_id = ? ORDER BY FansAndHaters.downvotes DESC LIMIT ?", (id, num))
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT FansAndHaters.fan_or_hater_id, Users.username, FansAndHaters.downvotes FROM FansAndHaters JOIN Users ON FansAndHaters.fan_or_hater_id = Users.id WHERE FansAndHaters.user_id = ? ORDER BY FansAndHaters.downvotes DESC LIMIT ?", (id, num))
+        return c.fetchall()
     
     def get_score(self, id: int) -> int:
         '''Returns the score of a user'''
-        self.c.execute("SELECT upvotes-downvotes+offset FROM Users WHERE id = ?", (id,))
-        return self.c.fetchone()[0]
+        c = self.cursor()
+        c.execute("SELECT upvotes-downvotes+offset FROM Users WHERE id = ?", (id,))
+        return c.fetchone()[0]
     
     def get_score_in_guild(self, id: int, guild_id: int) -> int:
         '''Returns the score of a user just from reacts in a specific guild'''
-        self.c.execute("SELECT SUM(Reactions.vote_type) FROM Reactions JOIN Messages ON Reactions.message_id = Messages.id WHERE Messages.author_id = ? AND Messages.guild_id = ?", (id, guild_id))
-        return self.c.fetchone()[0]
+        c = self.cursor()
+        c.execute("SELECT SUM(net) FROM MessageScores WHERE author_id = ? AND guild_id = ?", (id, guild_id))
+        return c.fetchone()[0]
     
-    def get_memberotw(self, guild_id: int) -> tuple[int, str, int]:
-        '''Returns the member with the most upvotes-downvotes recieved over the past week in guid with guild_id as a tuple (id, username, upvotes-downvotes)'''
-        self.c.execute("SELECT Users.id, Users.username, SUM(Reactions.vote_type) FROM Reactions JOIN Messages ON Reactions.message_id = Messages.id JOIN Users ON Messages.author_id = Users.id WHERE Messages.guild_id = ? AND Messages.timestamp > datetime('now', '-7 day') GROUP BY Users.id ORDER BY SUM(Reactions.vote_type) DESC", (guild_id,))
-        return self.c.fetchone()
+    def get_memberotw(self, guild_id: int, window: str = "week") -> Optional[tuple[int, str, int]]:
+        '''Returns the member with the most upvotes-downvotes recieved on messages posted in the past window (a key of WINDOWS)
+        in guild with guild_id as a tuple (id, username, upvotes-downvotes), summed from the window's hourly buckets'''
+        c = self.cursor()
+        c.execute("""
+            SELECT Users.id, Users.username, SUM(MemberHours.score) FROM MemberHours JOIN Users ON MemberHours.author_id = Users.id
+            WHERE MemberHours.guild_id = ? AND MemberHours.hour > ?
+            GROUP BY MemberHours.author_id ORDER BY SUM(MemberHours.score) DESC LIMIT 1
+        """, (guild_id, int(time.time()) // 3600 - WINDOWS[window]))
+        return c.fetchone()
+
+    # ========== SLIDING WINDOWS ==========
+
+    def create_window_tables(self):
+        '''Creates MemberHours, each author's score per guild per hour their messages were posted in, with the
+        triggers that keep it current'''
+        c = self.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS MemberHours (
+                guild_id INTEGER,
+                hour INTEGER,
+                author_id INTEGER,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, hour, author_id)
+            ) WITHOUT ROWID''')
+
+        self.create_member_hour_triggers()
+        self.rebuild_member_hours()
+
+    def create_member_hour_triggers(self):
+        c = self.cursor()
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS MemberHourAdded AFTER INSERT ON Reactions {UNLESS_SUSPENDED.format("MemberHourAdded")}
+            BEGIN
+                INSERT INTO MemberHours (guild_id, hour, author_id, score)
+                    SELECT guild_id, posted / 3600, author_id, NEW.vote_type FROM MessageScores
+                    WHERE message_id = NEW.message_id AND posted > {EPOCH.format("'now'")} - {WINDOW_HORIZON}
+                    ON CONFLICT (guild_id, hour, author_id) DO UPDATE SET score = score + excluded.score;
+            END''')
+
+        # A bucket that has been pruned stays gone, the update only adjusts buckets that still exist
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS MemberHourRemoved AFTER DELETE ON Reactions {UNLESS_SUSPENDED.format("MemberHourRemoved")}
+            BEGIN
+                UPDATE MemberHours SET score = score - OLD.vote_type
+                WHERE (guild_id, hour, author_id) = (SELECT guild_id, posted / 3600, author_id FROM MessageScores WHERE message_id = OLD.message_id);
+            END''')
+
+    def rebuild_member_hours(self):
+        '''Recomputes the MemberHours buckets within the longest window from the hot and archived reactions'''
+        c = self.cursor()
+        c.execute("DELETE FROM MemberHours")
+        c.execute(f"""
+            INSERT INTO MemberHours (guild_id, hour, author_id, score)
+            SELECT MessageScores.guild_id, MessageScores.posted / 3600, MessageScores.author_id, SUM(Reactions.vote_type)
+            FROM MessageScores JOIN {VOTES} AS Reactions ON Reactions.message_id = MessageScores.message_id
+            WHERE MessageScores.posted > ?
+            GROUP BY 1, 2, 3
+        """, (int(time.time()) - WINDOW_HORIZON,))
+
+    def prune_member_hours(self) -> int:
+        '''Deletes the buckets that fell out of the longest window, returns how many were deleted'''
+        c = self.cursor()
+        c.execute("DELETE FROM MemberHours WHERE hour <= ?", ((int(time.time()) - WINDOW_HORIZON) // 3600,))
+        return c.rowcount
     
+    # ========== GUILD MEMBERS ==========
+
+    def create_guild_members_table(self):
+        '''Creates the GuildMembers table, mirroring which users are currently in which guild'''
+        c = self.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS GuildMembers (
+            guild_id INTEGER,
+            user_id INTEGER,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID
+        """)
+
+    def add_guild_member(self, guild_id: int, user_id: int):
+        c = self.cursor()
+        c.execute("INSERT OR IGNORE INTO GuildMembers (guild_id, user_id) VALUES (?, ?)", (guild_id, user_id))
+        self.conn.commit()
+
+    def remove_guild_member(self, guild_id: int, user_id: int):
+        c = self.cursor()
+        c.execute("DELETE FROM GuildMembers WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        self.conn.commit()
+
+    def set_guild_members(self, guild_id: int, user_ids: list[int]):
+        '''Replaces the stored member list of a guild in a single transaction'''
+        c = self.cursor()
+        c.execute("DELETE FROM GuildMembers WHERE guild_id = ?", (guild_id,))
+        c.executemany("INSERT OR IGNORE INTO GuildMembers (guild_id, user_id) VALUES (?, ?)", [(guild_id, user_id) for user_id in user_ids])
+        self.conn.commit()
+
     # ========== EMOJI MANAGEMENT ==========
 
     def add_guild(self, id: int) -> tuple[str, str]:
-        self.c.execute("INSERT OR IGNORE INTO Emojis (guild_id, upvote, downvote) VALUES (?, ?, ?)", (id, "👍", "👎"))
+        c = self.cursor()
+        c.execute("INSERT OR IGNORE INTO Emojis (guild_id, upvote, downvote) VALUES (?, ?, ?)", (id, "👍", "👎"))
         self.conn.commit()
         return ("👍", "👎")
 
     def get_emojis(self, id: int) -> tuple[str, str]:
-        self.c.execute("SELECT upvote, downvote FROM Emojis WHERE guild_id = ?", (id,))
-        return self.c.fetchone() or self.add_guild(id)
+        c = self.cursor()
+        c.execute("SELECT upvote, downvote FROM Emojis WHERE guild_id = ?", (id,))
+        return c.fetchone() or self.add_guild(id)
     
     def set_emojis(self, id: int, upvote: str, downvote: str):
+        c = self.cursor()
         self.add_guild(id)
-        self.c.execute("UPDATE Emojis SET upvote = ?, downvote = ? WHERE guild_id = ?", (upvote, downvote, id))
+        c.execute("UPDATE Emojis SET upvote = ?, downvote = ? WHERE guild_id = ?", (upvote, downvote, id))
         self.conn.commit()
 
     def list_emojis(self) -> list[tuple[int, str, str]]:
-        self.c.execute("SELECT * FROM Emojis")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT * FROM Emojis")
+        return c.fetchall()
+
+    # ========== GUILD CONFIG ==========
+
+    def guild_config(self, id: int) -> tuple[str, str, Optional[int], Optional[int]]:
+        '''Returns every per-guild setting as a tuple (upvote, downvote, starboard channel_id, starboard threshold)'''
+        c = self.cursor()
+        (upvote, downvote) = self.get_emojis(id)
+        c.execute("SELECT channel_id, threshold FROM StarboardChannels WHERE guild_id = ?", (id,))
+        (channel_id, threshold) = c.fetchone() or (None, None)
+        return (upvote, downvote, channel_id, threshold)
+
+    def list_guild_configs(self) -> list[tuple[int, str, str, Optional[int], Optional[int]]]:
+        '''Returns the settings of every known guild as a list of tuples (guild_id, upvote, downvote, starboard channel_id, starboard threshold)'''
+        c = self.cursor()
+        c.execute("SELECT Emojis.guild_id, Emojis.upvote, Emojis.downvote, StarboardChannels.channel_id, StarboardChannels.threshold FROM Emojis LEFT JOIN StarboardChannels ON Emojis.guild_id = StarboardChannels.guild_id")
+        return c.fetchall()
 
     # ========== REACTION MANAGEMENT ==========
 
-    def add_reaction(self, voter_id: int, message: Message, vote_type: int, timestamp: str) -> None:
-        '''Adds a reaction to the database if it doesn't exist already.'''
+    def add_reaction(self, voter_id: int, message: MessageInfo, vote_type: int, timestamp: str) -> None:
+        '''Adds a reaction to the database if it doesn't exist already, hot or archived.'''
+        c = self.cursor()
         self.add_message(message)
-        self.c.execute("INSERT OR IGNORE INTO Reactions (voter_id, message_id, vote_type, timestamp) VALUES (?, ?, ?, ?)", (voter_id, message.id, vote_type, timestamp))
-        self.conn.commit()
+        c.execute("""
+            INSERT OR IGNORE INTO Reactions (voter_id, message_id, vote_type, timestamp) SELECT ?1, ?2, ?3, ?4
+            WHERE NOT EXISTS (SELECT 1 FROM archive.Reactions WHERE voter_id = ?1 AND message_id = ?2 AND vote_type = ?3)
+        """, (voter_id, message.id, vote_type, timestamp))
+        self.queue_commit()
 
-    def remove_reaction(self, voter_id: int, message: Message, vote_type: int):
+    def remove_reaction(self, voter_id: int, message: MessageInfo, vote_type: int):
         '''Removes a reaction from the database.'''
-        self.c.execute("DELETE FROM Reactions WHERE voter_id = ? AND message_id = ? AND vote_type = ?", (voter_id, message.id, vote_type))
-        self.conn.commit()
+        c = self.cursor()
+        c.execute("DELETE FROM Reactions WHERE voter_id = ? AND message_id = ? AND vote_type = ?", (voter_id, message.id, vote_type))
+        if c.rowcount == 0:
+            self.remove_archived_reaction(voter_id, message, vote_type)
+        self.queue_commit()
+
+    def remove_archived_reaction(self, voter_id: int, message: MessageInfo, vote_type: int):
+        '''Removes a reaction from the archive. The Reactions triggers don't see archived rows, so the counters
+        they would have updated are adjusted here'''
+        c = self.cursor()
+        c.execute("DELETE FROM archive.Reactions WHERE voter_id = ? AND message_id = ? AND vote_type = ?", (voter_id, message.id, vote_type))
+        if c.rowcount == 0:
+            return
+
+        (up, down) = (int(vote_type > 0), int(vote_type < 0))
+        c.execute("UPDATE Users SET upvotes = upvotes - ?, downvotes = downvotes - ? WHERE id = ?", (up, down, message.author_id))
+        c.execute("UPDATE FansAndHaters SET upvotes = upvotes - ?, downvotes = downvotes - ? WHERE user_id = ? AND fan_or_hater_id = ?", (up, down, message.author_id, voter_id))
+        c.execute("UPDATE MessageScores SET up = up - ?, down = down - ? WHERE message_id = ?", (up, down, message.id))
+        c.execute("UPDATE MemberHours SET score = score - ? WHERE (guild_id, hour, author_id) = (SELECT guild_id, posted / 3600, author_id FROM MessageScores WHERE message_id = ?)", (vote_type, message.id))
+
+    def ingest_reactions(self, reactions: list[tuple[MessageInfo, int, int]]) -> int:
+        '''Adds a batch of (message, voter_id, vote_type) reactions in one transaction and returns how many were new.
+
+        The per-row aggregate triggers are suspended for the duration of the transaction and the Users,
+        FansAndHaters and MessageScores counters are updated once for the whole batch instead.'''
+        c = self.cursor()
+        if not reactions:
+            return 0
+
+        with self.transaction(), self.suspended_triggers(INGEST_TRIGGERS):
+            messages = {message.id: message for (message, _, _) in reactions}
+            self.add_messages(messages.values())
+            c.executemany(f"INSERT OR IGNORE INTO MessageScores (message_id, guild_id, author_id, posted) VALUES (?, ?, ?, {EPOCH.format('?')})", [(message.id, message.guild_id, message.author_id, message.timestamp) for message in messages.values()])
+
+            # Only reactions that aren't stored yet may count towards the aggregates
+            c.execute("CREATE TEMP TABLE IF NOT EXISTS IngestReactions (voter_id INTEGER, message_id INTEGER, vote_type INTEGER, timestamp TEXT, PRIMARY KEY (voter_id, message_id, vote_type)) WITHOUT ROWID")
+            c.execute("DELETE FROM temp.IngestReactions")
+            c.executemany("INSERT OR IGNORE INTO temp.IngestReactions (voter_id, message_id, vote_type, timestamp) VALUES (?, ?, ?, ?)", [(voter_id, message.id, vote_type, message.timestamp) for (message, voter_id, vote_type) in reactions])
+            c.execute("DELETE FROM temp.IngestReactions WHERE EXISTS (SELECT 1 FROM main.Reactions WHERE (Reactions.voter_id, Reactions.message_id, Reactions.vote_type) = (IngestReactions.voter_id, IngestReactions.message_id, IngestReactions.vote_type))")
+            c.execute("DELETE FROM temp.IngestReactions WHERE EXISTS (SELECT 1 FROM archive.Reactions WHERE (Reactions.voter_id, Reactions.message_id, Reactions.vote_type) = (IngestReactions.voter_id, IngestReactions.message_id, IngestReactions.vote_type))")
+            c.execute("INSERT INTO Reactions (voter_id, message_id, vote_type, timestamp) SELECT voter_id, message_id, vote_type, timestamp FROM temp.IngestReactions")
+            added = c.rowcount
+
+            c.execute("""
+                INSERT INTO Users (id, username, upvotes, downvotes, offset)
+                SELECT Messages.author_id, 'Unknown', SUM(IngestReactions.vote_type > 0), SUM(IngestReactions.vote_type < 0), 100
+                FROM temp.IngestReactions JOIN Messages ON IngestReactions.message_id = Messages.id
+                WHERE true GROUP BY Messages.author_id
+                ON CONFLICT (id) DO UPDATE SET upvotes = upvotes + excluded.upvotes, downvotes = downvotes + excluded.downvotes
+            """)
+            c.execute("""
+                INSERT INTO FansAndHaters (user_id, fan_or_hater_id, upvotes, downvotes)
+                SELECT Messages.author_id, IngestReactions.voter_id, SUM(IngestReactions.vote_type > 0), SUM(IngestReactions.vote_type < 0)
+                FROM temp.IngestReactions JOIN Messages ON IngestReactions.message_id = Messages.id
+                WHERE true GROUP BY Messages.author_id, IngestReactions.voter_id
+                ON CONFLICT (user_id, fan_or_hater_id) DO UPDATE SET upvotes = upvotes + excluded.upvotes, downvotes = downvotes + excluded.downvotes
+            """)
+            c.execute("""
+                UPDATE MessageScores SET up = MessageScores.up + Batch.up, down = MessageScores.down + Batch.down
+                FROM (SELECT message_id, SUM(vote_type > 0) AS up, SUM(vote_type < 0) AS down FROM temp.IngestReactions GROUP BY message_id) AS Batch
+                WHERE MessageScores.message_id = Batch.message_id
+            """)
+            c.execute("""
+                INSERT INTO MemberHours (guild_id, hour, author_id, score)
+                SELECT MessageScores.guild_id, MessageScores.posted / 3600, MessageScores.author_id, SUM(IngestReactions.vote_type)
+                FROM temp.IngestReactions JOIN MessageScores ON IngestReactions.message_id = MessageScores.message_id
+                WHERE MessageScores.posted > ? GROUP BY 1, 2, 3
+                ON CONFLICT (guild_id, hour, author_id) DO UPDATE SET score = score + excluded.score
+            """, (int(time.time()) - WINDOW_HORIZON,))
+
+        return added
 
     def list_reactions(self) -> list[tuple[int, int, int, int, int, int, str]]:
         '''Returns all reactions in the database as a list of tuples (voter_id, message_id, vote_type, channel_id, guild_id, author_id, timestamp)'''
-        self.c.execute("SELECT * FROM Reactions")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT * FROM AllReactions")
+        return c.fetchall()
     
-    def best_of(self, id: int, num: Optional[int] = None) -> list[tuple[int, int, int, int]]:
-        '''Returns the top num messages of a user as a list of tuples (message_id, channel_id, guild_id, SUM(vote_type))'''
-        if num is None:
-            self.c.execute("SELECT Reactions.message_id, Messages.channel_id, Messages.guild_id, SUM(Reactions.vote_type) FROM Reactions JOIN Messages on Reactions.message_id = Messages.id WHERE Messages.author_id = ? GROUP BY Reactions.message_id ORDER BY SUM(Reactions.vote_type) DESC", (id,))
-        else:
-            self.c.execute("SELECT Reactions.message_id, Messages.channel_id, Messages.guild_id, SUM(Reactions.vote_type) FROM Reactions JOIN Messages on Reactions.message_id = Messages.id WHERE Messages.author_id = ? GROUP BY Reactions.message_id ORDER BY SUM(Reactions.vote_type) DESC LIMIT ?", (id, num))
-        
-        return self.c.fetchall()
+    def keyset_page(self, query: str, where: list[str], params: list, key: tuple[str, str], limit: Optional[int], after: Optional[tuple], backwards: bool) -> list[tuple]:
+        '''Runs query ordered by the key columns descending, returning up to limit rows that come after the
+        key values in that order (or before them if backwards is set, still in descending order)'''
+        c = self.cursor()
+        where = list(where)
+        params = list(params)
+        order = "ASC" if backwards else "DESC"
+
+        if after is not None:
+            where.append(f"({key[0]}, {key[1]}) {'>' if backwards else '<'} (?, ?)")
+            params.extend(after)
+
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {key[0]} {order}, {key[1]} {order}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        c.execute(query, params)
+        rows = c.fetchall()
+        return rows[::-1] if backwards else rows
+
+    def count_message_scores(self, guild_id: Optional[int] = None, author_id: Optional[int] = None, voted_only: bool = True) -> int:
+        '''Returns the number of messages best_of (author_id), top_messages (guild_id) or get_controversial (guild_id, voted_only=False) would list'''
+        c = self.cursor()
+        where = ["up + down > 0"] if voted_only else ["1"]
+        params = []
+        if guild_id is not None:
+            where.append("guild_id = ?")
+            params.append(guild_id)
+        if author_id is not None:
+            where.append("author_id = ?")
+            params.append(author_id)
+
+        c.execute("SELECT COUNT(*) FROM MessageScores WHERE " + " AND ".join(where), params)
+        return c.fetchone()[0]
+
+    def best_of(self, id: int, num: Optional[int] = None, after: Optional[tuple[int, int]] = None, backwards: bool = False) -> list[tuple[int, int, int, int]]:
+        '''Returns the top num messages of a user as a list of tuples (message_id, channel_id, guild_id, SUM(vote_type)),
+        starting after the (score, message_id) key given in after, see keyset_page'''
+        return self.keyset_page(
+            f"SELECT MessageScores.message_id, {MESSAGE_CHANNEL}, MessageScores.guild_id, MessageScores.net FROM MessageScores",
+            ["MessageScores.author_id = ?", "MessageScores.up + MessageScores.down > 0"], [id],
+            ("MessageScores.net", "MessageScores.message_id"), num, after, backwards
+        )
     
-    def top_messages(self, guild_id: Optional[int] = None) -> list[tuple[str, int, int, int, int, str]]:
-        '''Returns the top 5 messages as a list of tuples (author_id, message_id, channel_id, guild_id, SUM(vote_type), content)'''
-        if guild_id is None:
-            self.c.execute("SELECT Messages.author_id, Reactions.message_id, Messages.channel_id, Messages.guild_id, SUM(Reactions.vote_type), Messages.content FROM Reactions JOIN Messages ON Reactions.message_id = Messages.id GROUP BY Reactions.message_id ORDER BY SUM(Reactions.vote_type) DESC")
-        else:
-            self.c.execute("SELECT Messages.author_id, Reactions.message_id, Messages.channel_id, Messages.guild_id, SUM(Reactions.vote_type), Messages.content FROM Reactions JOIN Messages ON Reactions.message_id = Messages.id WHERE guild_id = ? GROUP BY Reactions.message_id ORDER BY SUM(Reactions.vote_type) DESC", (guild_id,))
-            
-        return self.c.fetchall()
+    def top_messages(self, guild_id: Optional[int] = None, num: Optional[int] = None, after: Optional[tuple[int, int]] = None, backwards: bool = False) -> list[tuple[str, int, int, int, int, str]]:
+        '''Returns the top num messages as a list of tuples (author_id, message_id, channel_id, guild_id, SUM(vote_type), content),
+        starting after the (score, message_id) key given in after, see keyset_page'''
+        where = ["MessageScores.up + MessageScores.down > 0"]
+        params = []
+        if guild_id is not None:
+            where.append("MessageScores.guild_id = ?")
+            params.append(guild_id)
+
+        return self.keyset_page(
+            f"SELECT MessageScores.author_id, MessageScores.message_id, {MESSAGE_CHANNEL}, MessageScores.guild_id, MessageScores.net, {MESSAGE_CONTENT} FROM MessageScores",
+            where, params, ("MessageScores.net", "MessageScores.message_id"), num, after, backwards
+        )
     
-    def get_messageotw(self, guild_id: int) -> tuple[int, int, int]:
-        '''Returns highest-scoring message from the past week as a tuple (id, channel_id, score)'''
-        self.c.execute("""
-            SELECT Messages.id, Messages.channel_id, SUM(Reactions.vote_type) as votes
-            FROM Messages
-            LEFT JOIN Reactions ON Messages.id = Reactions.message_id
-            WHERE Messages.guild_id = ? AND Messages.timestamp > datetime('now', '-7 day')
-            GROUP BY Messages.id
-            ORDER BY votes DESC
-        """, (guild_id,))
-        return self.c.fetchone()
+    def get_messageotw(self, guild_id: int, window: str = "week") -> Optional[tuple[int, int, int]]:
+        '''Returns highest-scoring message posted in the past window (a key of WINDOWS) as a tuple (id, channel_id, score)'''
+        c = self.cursor()
+        c.execute(f"""
+            SELECT message_id, {MESSAGE_CHANNEL}, net FROM MessageScores
+            WHERE guild_id = ? AND posted > ?
+            ORDER BY net DESC LIMIT 1
+        """, (guild_id, int(time.time()) - WINDOWS[window] * 3600))
+        return c.fetchone()
     
-    def add_message(self, message: Message) -> None:
+    def add_message(self, message: MessageInfo) -> None:
         '''Adds a message to the database if it doesn't exist already.'''
-        if message.guild is None:
-            raise ValueError("Message must be from a guild.")
-        
-        self.c.execute("INSERT OR IGNORE INTO Messages (id, channel_id, guild_id, author_id, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)", (message.id, message.channel.id, message.guild.id, message.author.id, message.clean_content, message.created_at.isoformat()))
-        self.conn.commit()
+        self.add_messages([message])
+        self.queue_commit()
+
+    def add_messages(self, messages: Iterable[MessageInfo]):
+        '''Adds the messages that don't exist already, only their content is compressed and stored'''
+        c = self.cursor()
+        messages = {message.id: message for message in messages}
+        c.executemany("INSERT OR IGNORE INTO Messages (id, channel_id, guild_id, author_id, timestamp) VALUES (?, ?, ?, ?, ?)", [(message.id, message.channel_id, message.guild_id, message.author_id, message.timestamp) for message in messages.values()])
+        if c.rowcount == len(messages):
+            new = list(messages.values())
+        elif c.rowcount == 0:
+            new = []
+        else:
+            # Some of them were stored already, the new ones are those without content yet
+            ids = list(messages)
+            new = []
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                c.execute(f"SELECT id FROM Messages WHERE content_id IS NULL AND id IN ({', '.join('?' * len(chunk))})", chunk)
+                new.extend(messages[id] for (id,) in c.fetchall())
+        self.store_contents([(message.id, message.content) for message in new])
+
+    def store_contents(self, contents: list[tuple[int, Optional[str]]], schema: str = "main"):
+        '''Stores (message_id, content) pairs in Contents and points each message's content_id at its row,
+        messages with identical content share one row'''
+        c = self.cursor()
+        encoded = [(message_id, *encode_content(content, self.content_limit)) for (message_id, content) in contents if content is not None]
+        c.executemany("INSERT OR IGNORE INTO Contents (digest, data) VALUES (?, ?)", [(digest, data) for (_, digest, data) in encoded])
+        c.executemany(f"UPDATE {schema}.Messages SET content_id = (SELECT id FROM Contents WHERE digest = ?) WHERE id = ?", [(digest, message_id) for (message_id, digest, _) in encoded])
+
+    def create_contents(self):
+        '''Creates Contents and moves the content column of hot and archived Messages into it'''
+        c = self.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS Contents (id INTEGER PRIMARY KEY, digest BLOB NOT NULL UNIQUE, data)")
+
+        for schema in ("main", "archive"):
+            c.execute("SELECT name FROM pragma_table_info('Messages', ?)", (schema,))
+            columns = {name for (name,) in c.fetchall()}
+            if "content" not in columns:
+                continue
+            if "content_id" not in columns:
+                c.execute(f"ALTER TABLE {schema}.Messages ADD COLUMN content_id INTEGER")
+
+            last = 0
+            while True:
+                c.execute(f"SELECT id, content FROM {schema}.Messages WHERE id > ? ORDER BY id LIMIT 10000", (last,))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                self.store_contents(rows, schema)
+                last = rows[-1][0]
+            c.execute(f"ALTER TABLE {schema}.Messages DROP COLUMN content")
+
+    def drop_message_indexes(self):
+        '''Drops the Messages indexes the per-message and per-member stats used before they moved to MessageScores
+        and MemberHours, which every message insert still paid for'''
+        c = self.cursor()
+        c.execute("DROP INDEX IF EXISTS idx_Messages_guild_timestamp")
+        c.execute("DROP INDEX IF EXISTS idx_Messages_author_guild")
 
     def list_messages(self) -> list[tuple[int, int, int, int, str, str]]:
         '''Returns all messages in the database as a list of tuples (id, channel_id, guild_id, author_id, content, timestamp)'''
-        self.c.execute("SELECT * FROM Messages")
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute(f"SELECT id, channel_id, guild_id, author_id, {CONTENT.format('content_id')}, timestamp FROM AllMessages")
+        return c.fetchall()
     
-    def get_message(self, id: int) -> tuple[int, int, int, int, str, str]:
-        '''Returns a message from the database as a tuple (id, channel_id, guild_id, author_id, content, timestamp)'''
-        self.c.execute("SELECT * FROM Messages WHERE id = ?", (id,))
-        return self.c.fetchone()
-
-    def get_controversial(self, guild_id: int) -> list[tuple[int, int, int, int, int, int, str, float]]:
-        '''Returns the most controversial messages in a guild as a list of tuples (author_id, message_id, channel_id, guild_id, SUM(positive votes), SUM(negative votes), content, Controversial score)'''
-        self.c.execute("""
-            SELECT
-                Messages.author_id, 
-                Messages.id, 
-                Messages.channel_id, 
-                Messages.guild_id, 
-                SUM(CASE WHEN Reactions.vote_type > 0 THEN 1 ELSE 0 END) AS positive_votes, 
-                SUM(CASE WHEN Reactions.vote_type < 0 THEN 1 ELSE 0 END) AS negative_votes,
-                Messages.content, 
-                CASE
-                    WHEN
-                        SUM(CASE WHEN Reactions.vote_type > 0 THEN 1 ELSE 0 END) = 0
-                        OR
-                        SUM(CASE WHEN Reactions.vote_type < 0 THEN 1 ELSE 0 END) = 0
-                    THEN 0.0
-                    ELSE
-                        POW(
-                            SUM(CASE WHEN Reactions.vote_type > 0 THEN 1 ELSE 0 END)
-                            +
-                            SUM(CASE WHEN Reactions.vote_type < 0 THEN 1 ELSE 0 END),
-                            MIN(
-                                CAST(
-                                    SUM(CASE WHEN Reactions.vote_type > 0 THEN 1 ELSE 0 END) AS REAL
-                                ) / SUM(CASE WHEN Reactions.vote_type > 0 THEN 1 ELSE 0 END),
-                                CAST(
-                                    SUM(CASE WHEN Reactions.vote_type < 0 THEN 1 ELSE 0 END) AS REAL
-                                ) / SUM(CASE WHEN Reactions.vote_type < 0 THEN 1 ELSE 0 END)
-                            )
-                        )
-                END AS controversial_score
-            FROM 
-                Messages
-            LEFT JOIN 
-                Reactions ON Messages.id = Reactions.message_id
-            WHERE 
-                Messages.guild_id = ?
-            GROUP BY 
-                Messages.id, Messages.author_id, Messages.channel_id, Messages.guild_id, Messages.content
-            ORDER BY 
-                controversial_score DESC;
-        """, (guild_id,))
-        return self.c.fetchall()
+    def get_message(self, id: int) -> Optional[MessageInfo]:
+        '''Returns a message from the database as a MessageInfo (id, channel_id, guild_id, author_id, content, timestamp)'''
+        c = self.cursor()
+        c.execute(f"SELECT id, channel_id, guild_id, author_id, {CONTENT.format('content_id')}, timestamp FROM AllMessages WHERE id = ?", (id,))
+        result = c.fetchone()
+        return MessageInfo(*result) if result else None
+
+    def get_controversial(self, guild_id: int, num: Optional[int] = None, after: Optional[tuple[float, int]] = None, backwards: bool = False) -> list[tuple[int, int, int, int, int, int, str, float]]:
+        '''Returns the most controversial messages in a guild as a list of tuples (author_id, message_id, channel_id, guild_id, SUM(positive votes), SUM(negative votes), content, Controversial score),
+        starting after the (controversy, message_id) key given in after, see keyset_page'''
+        return self.keyset_page(
+            f"SELECT MessageScores.author_id, MessageScores.message_id, {MESSAGE_CHANNEL}, MessageScores.guild_id, MessageScores.up, MessageScores.down, {MESSAGE_CONTENT}, MessageScores.controversy FROM MessageScores",
+            ["MessageScores.guild_id = ?"], [guild_id],
+            ("MessageScores.controversy", "MessageScores.message_id"), num, after, backwards
+        )
     
-    def reset_for_scan(self):
-        '''Resets the database for a new scan'''
-        self.c.execute("DROP TABLE Users")
-        self.c.execute("DROP TABLE FansAndHaters")
-        self.c.execute("DROP TABLE Reactions")
+    # ========== SCAN PROGRESS ==========
+
+    def create_scan_progress_table(self):
+        '''Creates the ScanProgress table, holding the last message scanned in each channel'''
+        c = self.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS ScanProgress (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            scanned INTEGER NOT NULL DEFAULT 0,
+            updated TEXT NOT NULL
+        )
+        """)
+
+    def save_scan_cursor(self, channel_id: int, guild_id: int, last_message_id: int, scanned: int):
+        '''Moves a channel's scan cursor forward, scanned is the number of messages scanned since the last save.
+        Queued like the reactions before it, so the cursor is never committed ahead of them.'''
+        c = self.cursor()
+        c.execute("""
+        INSERT INTO ScanProgress (channel_id, guild_id, last_message_id, scanned, updated) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (channel_id) DO UPDATE
+        SET last_message_id = MAX(last_message_id, excluded.last_message_id), scanned = scanned + excluded.scanned, updated = excluded.updated
+        """, (channel_id, guild_id, last_message_id, scanned, datetime.now().isoformat()))
+        self.queue_commit()
+
+    def list_scan_progress(self, guild_id: Optional[int] = None) -> list[tuple[int, int, int, int, str]]:
+        '''Returns scan cursors as a list of tuples (channel_id, guild_id, last_message_id, scanned, updated)'''
+        c = self.cursor()
+        if guild_id is None:
+            c.execute("SELECT * FROM ScanProgress")
+        else:
+            c.execute("SELECT * FROM ScanProgress WHERE guild_id = ?", (guild_id,))
+        return c.fetchall()
+
+    # ========== REBUILD ==========
+
+    def start_rebuild(self):
+        '''Starts a full rescan that collects reactions into RebuildReactions while Reactions keeps serving reads.
+        Live votes made until finish_rebuild are logged to RebuildDelta so they can be replayed onto the rescan.'''
+        c = self.cursor()
+        c.execute("DROP TABLE IF EXISTS RebuildReactions")
+        c.execute("DROP TABLE IF EXISTS RebuildDelta")
+        c.execute('''
+            CREATE TABLE RebuildReactions (
+                voter_id INTEGER,
+                message_id INTEGER,
+                vote_type INTEGER,
+                timestamp TEXT,
+                PRIMARY KEY (voter_id, message_id, vote_type),
+                FOREIGN KEY (voter_id) REFERENCES Users(id),
+                FOREIGN KEY (message_id) REFERENCES Messages(id)
+            )''')
+
+        c.execute('''
+            CREATE TABLE RebuildDelta (
+                seq INTEGER PRIMARY KEY,
+                voter_id INTEGER,
+                message_id INTEGER,
+                vote_type INTEGER,
+                timestamp TEXT,
+                added INTEGER
+            )''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS RebuildReactionAdded AFTER INSERT ON Reactions
+            BEGIN
+                INSERT INTO RebuildDelta (voter_id, message_id, vote_type, timestamp, added) VALUES (NEW.voter_id, NEW.message_id, NEW.vote_type, NEW.timestamp, 1);
+            END''')
+
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS RebuildReactionRemoved AFTER DELETE ON Reactions
+            BEGIN
+                INSERT INTO RebuildDelta (voter_id, message_id, vote_type, timestamp, added) VALUES (OLD.voter_id, OLD.message_id, OLD.vote_type, OLD.timestamp, 0);
+            END''')
+
+        c.execute("DELETE FROM ScanProgress")
         self.conn.commit()
-        self.create_tables()
+
+    def rebuild_in_progress(self) -> bool:
+        '''Returns whether a rebuild was started and not finished yet'''
+        c = self.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'RebuildReactions'")
+        return c.fetchone() is not None
+
+    def ingest_rebuild_reactions(self, reactions: list[tuple[MessageInfo, int, int]]) -> int:
+        '''Adds a batch of (message, voter_id, vote_type) reactions found by the rescan to RebuildReactions'''
+        c = self.cursor()
+        self.add_messages({message.id: message for (message, _, _) in reactions}.values())
+        c.executemany("INSERT OR IGNORE INTO RebuildReactions (voter_id, message_id, vote_type, timestamp) VALUES (?, ?, ?, ?)", [(voter_id, message.id, vote_type, message.timestamp) for (message, voter_id, vote_type) in reactions])
+        added = c.rowcount
+        self.flush()
+        return added
+
+    def finish_rebuild(self) -> int:
+        '''Replays the live votes logged during the rebuild onto RebuildReactions, swaps it in as Reactions and
+        recomputes every vote counter, all in one transaction. Returns the number of logged votes.'''
+        c = self.cursor()
+        with self.transaction():
+            c.execute("DROP TRIGGER RebuildReactionAdded")
+            c.execute("DROP TRIGGER RebuildReactionRemoved")
+            c.execute("SELECT COUNT(*) FROM RebuildDelta")
+            logged = c.fetchone()[0]
+
+            # Only the last logged change to each reaction matters, the rescan may or may not have seen the earlier ones
+            c.execute("""
+                WITH Latest AS (
+                    SELECT voter_id, message_id, vote_type, timestamp, added FROM RebuildDelta
+                    WHERE seq IN (SELECT MAX(seq) FROM RebuildDelta GROUP BY voter_id, message_id, vote_type)
+                )
+                DELETE FROM RebuildReactions WHERE (voter_id, message_id, vote_type) IN (SELECT voter_id, message_id, vote_type FROM Latest WHERE added = 0)
+            """)
+            c.execute("""
+                INSERT OR IGNORE INTO RebuildReactions (voter_id, message_id, vote_type, timestamp)
+                SELECT voter_id, message_id, vote_type, timestamp FROM RebuildDelta
+                WHERE seq IN (SELECT MAX(seq) FROM RebuildDelta GROUP BY voter_id, message_id, vote_type) AND added = 1
+            """)
+
+            # Dropping Reactions drops its triggers and indexes too, so they are recreated on the new table
+            c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'Reactions'")
+            triggers = [sql for (sql,) in c.fetchall()]
+            # The rename is refused while a view still refers to the dropped table
+            self.drop_archive_views()
+            c.execute("DROP TABLE Reactions")
+            c.execute("ALTER TABLE RebuildReactions RENAME TO Reactions")
+            for sql in triggers:
+                c.execute(sql)
+            for name, table, columns in INDEXES:
+                if table == "Reactions":
+                    c.execute(f"CREATE INDEX {name} ON {table} ({columns})")
+            c.execute("DROP TABLE RebuildDelta")
+            self.create_archive_views()
+
+            # The rescan found the archived reactions again, they are archived anew by the next archive run
+            c.execute("DELETE FROM archive.Reactions")
+
+            self.recount_aggregates()
+        return logged
+
+    # ========== RETENTION ==========
+
+    def archive_before(self, message_id: int) -> tuple[int, int]:
+        '''Moves messages older than message_id (a snowflake, so older means smaller) and their reactions to the
+        archive database. Vote counters and MessageScores are totals over both partitions, so they are left as
+        they are. Returns the number of (messages, reactions) moved.'''
+        c = self.cursor()
+        if self.rebuild_in_progress():
+            return (0, 0)
+
+        with self.transaction():
+            c.execute("CREATE TEMP TABLE IF NOT EXISTS ArchiveMessageIds (id INTEGER PRIMARY KEY)")
+            c.execute("DELETE FROM temp.ArchiveMessageIds")
+            c.execute("INSERT INTO temp.ArchiveMessageIds SELECT id FROM main.Messages WHERE id < ?", (message_id,))
+            moved = c.rowcount
+
+            c.execute("INSERT OR REPLACE INTO archive.Messages (id, channel_id, guild_id, author_id, timestamp, content_id) SELECT id, channel_id, guild_id, author_id, timestamp, content_id FROM main.Messages WHERE id IN temp.ArchiveMessageIds")
+            c.execute("INSERT OR IGNORE INTO archive.Reactions (voter_id, message_id, vote_type, timestamp) SELECT voter_id, message_id, vote_type, timestamp FROM main.Reactions WHERE message_id IN temp.ArchiveMessageIds")
+
+            # Moving a reaction isn't taking it back, so the triggers that would uncount it are suspended
+            with self.suspended_triggers(ARCHIVE_TRIGGERS):
+                c.execute("DELETE FROM main.Reactions WHERE message_id IN temp.ArchiveMessageIds")
+                archived = c.rowcount
+                c.execute("DELETE FROM main.Messages WHERE id IN temp.ArchiveMessageIds")
+
+        return (moved, archived)
 
     # ========== GAMBLING ==========
 
     def create_gambling(self):
         '''Creates the Gambling tables'''
+        c = self.cursor()
 
-        self.c.execute("""
+        c.execute("""
         CREATE TABLE IF NOT EXISTS Transactions (
             user_id INTEGER NOT NULL,
             amount INTEGER NOT NULL,
@@ -320,41 +1309,54 @@ class Database:
             timestamp TEXT NOT NULL
         )
         """)
-        
-        self.conn.commit()
+
+    def create_transaction_trigger(self):
+        c = self.cursor()
+        # Transactions are the source of truth for gambling, each one is applied to the user's offset
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS TransactionAdded AFTER INSERT ON Transactions
+        BEGIN
+            UPDATE Users SET offset = offset + NEW.amount WHERE id = NEW.user_id;
+        END
+        """)
 
     def add_transaction(self, user_id: int, amount: int, game: str):
         '''Adds a transaction to the database'''
+        c = self.cursor()
 
-        # Add transaction to database
-        self.c.execute("INSERT INTO Transactions (user_id, amount, game, timestamp) VALUES (?, ?, ?, ?)", (user_id, amount, game, datetime.now().isoformat()))
-
-        # Modify user's offset in Users table
-        self.c.execute("SELECT offset FROM Users WHERE id = ?", (user_id,))
-        offset = self.c.fetchone()[0]
-        self.c.execute("UPDATE Users SET offset = ? WHERE id = ?", (offset + amount, user_id))
-
+        # Add transaction to database, the TransactionAdded trigger applies it to the user's offset
+        c.execute("INSERT INTO Transactions (user_id, amount, game, timestamp) VALUES (?, ?, ?, ?)", (user_id, amount, game, datetime.now().isoformat()))
         self.conn.commit()
 
-    def is_valid_bet(self, user_id: int, amount: int) -> bool:
-        '''Checks if the user has enough score to place a bet'''
-        score = self.get_score(user_id)
-        return score >= amount and amount > 0
-
-    def place_bet(self, user_id: int, amount: int, game: str):
-        '''Places a bet on a game'''
-        self.add_transaction(user_id, -amount, game)
+    def place_bet(self, user_id: int, amount: int, game: str) -> bool:
+        '''Places a bet on a game if the user has enough score to cover it, returns whether it was placed.
+        The check and the transaction are one statement on the writer, so two bets can't both spend the same points.'''
+        c = self.cursor()
+        c.execute("""
+            INSERT INTO Transactions (user_id, amount, game, timestamp)
+            SELECT id, -?2, ?3, ?4 FROM Users WHERE id = ?1 AND upvotes-downvotes+offset >= ?2 AND ?2 > 0
+        """, (user_id, amount, game, datetime.now().isoformat()))
+        self.conn.commit()
+        return c.rowcount == 1
 
     def win_bet(self, user_id: int, amount: int, game: str):
         '''Wins a bet on a game'''
         self.add_transaction(user_id, amount, game)
 
+    def reset_gambling(self):
+        '''Undoes all gambling, resetting every offset to 100 and deleting every transaction'''
+        c = self.cursor()
+        c.execute("UPDATE Users SET offset = 100")
+        c.execute("DELETE FROM Transactions")
+        self.conn.commit()
+
     def gambling_stats(self, user_id: int) -> tuple[int, int]:
         '''Returns the total amount won and lost by a user'''
-        self.c.execute("SELECT SUM(amount) FROM Transactions WHERE user_id = ? AND amount > 0", (user_id,))
-        won = self.c.fetchone()[0] or 0
-        self.c.execute("SELECT SUM(amount) FROM Transactions WHERE user_id = ? AND amount < 0", (user_id,))
-        lost = self.c.fetchone()[0] or 0
+        c = self.cursor()
+        c.execute("SELECT SUM(amount) FROM Transactions WHERE user_id = ? AND amount > 0", (user_id,))
+        won = c.fetchone()[0] or 0
+        c.execute("SELECT SUM(amount) FROM Transactions WHERE user_id = ? AND amount < 0", (user_id,))
+        lost = c.fetchone()[0] or 0
         return (won, -lost)
 
     # ========== GACHA ==========
@@ -364,8 +1366,9 @@ class Database:
 
     def create_gacha(self):
         '''Creates the Gacha tables'''
-        self.c.execute("""
-        CREATE TABLE GachaInventory (
+        c = self.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS GachaInventory (
             user_id INTEGER NOT NULL,
             card_id INTEGER NOT NULL,
             quantity INTEGER NOT NULL,
@@ -373,35 +1376,37 @@ class Database:
             FOREIGN KEY(user_id) REFERENCES Users(id)
         )
         """)
-        
-        self.conn.commit()
 
     def pull(self) -> tuple[int, str, int, int, int]:
         '''Pulls a character from the gacha (Return random user from Users table)'''
-        self.c.execute("SELECT * FROM Users ORDER BY RANDOM() LIMIT 1")
-        card = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT * FROM Users ORDER BY RANDOM() LIMIT 1")
+        card = c.fetchone()
         return card
     
     def add_card_to_inv(self, user_id: int, card_id: int):
         '''Adds a card to a user's inventory'''
-        self.c.execute("SELECT * FROM GachaInventory WHERE user_id = ? AND card_id = ?", (user_id, card_id))
-        result = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT * FROM GachaInventory WHERE user_id = ? AND card_id = ?", (user_id, card_id))
+        result = c.fetchone()
         if result is None:
-            self.c.execute("INSERT INTO GachaInventory (user_id, card_id, quantity) VALUES (?, ?, ?)", (user_id, card_id, 1))
+            c.execute("INSERT INTO GachaInventory (user_id, card_id, quantity) VALUES (?, ?, ?)", (user_id, card_id, 1))
         else:
-            self.c.execute("UPDATE GachaInventory SET quantity = ? WHERE user_id = ? AND card_id = ?", (result[2] + 1, user_id, card_id))
+            c.execute("UPDATE GachaInventory SET quantity = ? WHERE user_id = ? AND card_id = ?", (result[2] + 1, user_id, card_id))
         self.conn.commit()
     
     def list_inventory(self, user_id: int) -> list[tuple[int, str, int]]:
         '''Lists all cards in a user's inventory'''
-        self.c.execute("SELECT GachaInventory.card_id, Users.username, GachaInventory.quantity FROM GachaInventory JOIN Users ON GachaInventory.card_id = Users.id WHERE user_id = ?", (user_id,))
-        return self.c.fetchall()
+        c = self.cursor()
+        c.execute("SELECT GachaInventory.card_id, Users.username, GachaInventory.quantity FROM GachaInventory JOIN Users ON GachaInventory.card_id = Users.id WHERE user_id = ?", (user_id,))
+        return c.fetchall()
     
     # ========== STARBOARD ==========
     def create_starboard_tables(self):
         '''Initializes the starboard tables'''
+        c = self.cursor()
 
-        self.c.execute("""
+        c.execute("""
         CREATE TABLE IF NOT EXISTS StarboardChannels (
             guild_id INTEGER PRIMARY KEY,
             channel_id INTEGER,
@@ -409,7 +1414,7 @@ class Database:
         )
         """)
  
-        self.c.execute("""
+        c.execute("""
         CREATE TABLE IF NOT EXISTS StarboardMessages (
             original_message_id INTEGER PRIMARY KEY,
             starboard_message_id INTEGER,
@@ -417,18 +1422,18 @@ class Database:
         )
         """)
 
-        self.conn.commit()
-
     def reset_starboard_tables(self):
         '''Resets the starboard tables'''
-        self.c.execute("DROP TABLE StarboardChannels")
-        self.c.execute("DROP TABLE StarboardMessages")
+        c = self.cursor()
+        c.execute("DROP TABLE StarboardChannels")
+        c.execute("DROP TABLE StarboardMessages")
         self.conn.commit()
         self.create_starboard_tables()
 
     def set_starboard_channel(self, guild_id: int, channel_id: int, threshold: int):
         '''Sets the starboard channel for a guild'''
-        self.c.execute(
+        c = self.cursor()
+        c.execute(
             """
             INSERT OR REPLACE INTO StarboardChannels (
                 guild_id,
@@ -442,7 +1447,8 @@ class Database:
 
     def get_starboard_channel(self, guild_id: int) -> Optional[int]:
         '''Gets the starboard channel for a guild'''
-        self.c.execute(
+        c = self.cursor()
+        c.execute(
             """
             SELECT channel_id
             FROM StarboardChannels
@@ -450,71 +1456,74 @@ class Database:
             """,
             (guild_id,)
         )
-        result = self.c.fetchone()
+        result = c.fetchone()
         return result[0] if result else None
 
     def get_starboard_threshold(self, guild_id: int) -> Optional[int]:
         '''Gets the starboard threshold for a guild'''
-        self.c.execute("SELECT threshold FROM StarboardChannels WHERE guild_id = ?", (guild_id,))
-        result = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT threshold FROM StarboardChannels WHERE guild_id = ?", (guild_id,))
+        result = c.fetchone()
         return result[0] if result else None
     
     def add_starboard_message(self, original_message_id: int, starboard_message_id: int, starboard_channel_id: int):
         '''Adds a message to the starboard'''
-        self.c.execute("INSERT INTO StarboardMessages (original_message_id, starboard_message_id, starboard_channel_id) VALUES (?, ?, ?)", (original_message_id, starboard_message_id, starboard_channel_id))
+        c = self.cursor()
+        c.execute("INSERT INTO StarboardMessages (original_message_id, starboard_message_id, starboard_channel_id) VALUES (?, ?, ?)", (original_message_id, starboard_message_id, starboard_channel_id))
         self.conn.commit()
 
     def get_starboard_message(self, original_message_id: int) -> tuple[int, int]:
         '''Gets the starboard message for a message'''
-        self.c.execute("SELECT starboard_message_id, starboard_channel_id FROM StarboardMessages WHERE original_message_id = ?", (original_message_id,))
-        return self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT starboard_message_id, starboard_channel_id FROM StarboardMessages WHERE original_message_id = ?", (original_message_id,))
+        return c.fetchone()
     
     def message_is_starboarded(self, message_id: int) -> bool:
         '''Checks if a message has been posted to the starboard'''
-        self.c.execute("SELECT * FROM StarboardMessages WHERE original_message_id = ?", (message_id,))
-        result = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT * FROM StarboardMessages WHERE original_message_id = ?", (message_id,))
+        result = c.fetchone()
         return result is not None
 
 
     # ========== LOTTERY ==========
     def create_lottery_tables(self):
         '''Initializes the lottery tables'''
+        c = self.cursor()
 
-        self.c.execute("""
+        c.execute("""
         CREATE TABLE IF NOT EXISTS LotteryTickets (
             user_id INTEGER PRIMARY KEY,
             ticket_reward INTEGER
         )
         """)
 
-        self.c.execute("""
+        c.execute("""
         CREATE TABLE IF NOT EXISTS LotteryCooldowns (
             user_id INTEGER PRIMARY KEY,
             last_played TEXT NOT NULL
         )
         """)
 
-        self.conn.commit()
-
     def give_lottery_reward(self, user_id: int, reward: int):
         '''Gives a user a lottery reward'''
+        c = self.cursor()
         
         # Log the reward in LotteryTickets table
-        self.c.execute("INSERT OR REPLACE INTO LotteryTickets (user_id, ticket_reward) VALUES (?, ?)", (user_id, reward))
+        c.execute("INSERT OR REPLACE INTO LotteryTickets (user_id, ticket_reward) VALUES (?, ?)", (user_id, reward))
 
-        # Modify add reward to user's offset in Users table
-        self.c.execute("SELECT offset FROM Users WHERE id = ?", (user_id,))
-        offset = self.c.fetchone()[0]
-        self.c.execute("UPDATE Users SET offset = ? WHERE id = ?", (offset + reward, user_id))
+        # Add reward to user's offset in Users table
+        c.execute("UPDATE Users SET offset = offset + ? WHERE id = ?", (reward, user_id))
 
         # Log the time the user last played the lottery
-        self.c.execute("INSERT OR REPLACE INTO LotteryCooldowns (user_id, last_played) VALUES (?, ?)", (user_id, datetime.now().isoformat()))
+        c.execute("INSERT OR REPLACE INTO LotteryCooldowns (user_id, last_played) VALUES (?, ?)", (user_id, datetime.now().isoformat()))
 
         self.conn.commit()
 
     def get_lottery_cooldown(self, user_id: int) -> Optional[datetime]:
         '''Returns the last time the user last played the lottery, or None if they haven't played yet.'''
-        self.c.execute("SELECT last_played FROM LotteryCooldowns WHERE user_id = ?", (user_id,))
-        result = self.c.fetchone()
+        c = self.cursor()
+        c.execute("SELECT last_played FROM LotteryCooldowns WHERE user_id = ?", (user_id,))
+        result = c.fetchone()
 
         return datetime.fromisoformat(result[0]) if result else None
\ No newline at end of file
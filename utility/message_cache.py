@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import discord
+
+class MessageInfo(NamedTuple):
+    '''The parts of a message the bot stores, in the same order as a row of the Messages table'''
+    id: int
+    channel_id: int
+    guild_id: int
+    author_id: int
+    content: str
+    timestamp: str
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "MessageInfo":
+        if message.guild is None:
+            raise ValueError("Message must be from a guild.")
+        return cls(message.id, message.channel.id, message.guild.id, message.author.id, message.clean_content, message.created_at.isoformat())
+
+class MessageCache:
+    '''Bounded LRU of MessageInfo by message id, so reactions can be processed without fetching the message'''
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.messages: OrderedDict[int, MessageInfo] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id: int) -> Optional[MessageInfo]:
+        info = self.messages.get(message_id)
+        if info is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.messages.move_to_end(message_id)
+        return info
+
+    def put(self, info: MessageInfo):
+        self.messages[info.id] = info
+        self.messages.move_to_end(info.id)
+        if len(self.messages) > self.maxsize:
+            self.messages.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.messages)
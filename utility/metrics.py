@@ -0,0 +1,271 @@
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import CodeType
+from typing import Callable, Iterator, Optional
+import aiohttp
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+logger = logging.getLogger("client.metrics")
+
+PREFIX = "minisigma"
+# Histogram bucket upper bounds in seconds, roughly three per decade from 10µs to 10s
+BOUNDS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Snowflakes and tokens in REST paths, so requests to the same route share a label
+ROUTE_IDS = re.compile(r"/(\d{15,}|[\w-]{60,})")
+
+# Name of the listener or command the running task was started for, e.g. "Voting.on_raw_reaction_add" or "/leaderboard".
+# Tasks inherit it from the task that created them, so work a handler spawns is attributed to it too.
+current_handler: ContextVar[Optional[str]] = ContextVar("current_handler", default=None)
+# The same names keyed by the code object of each handler, for naming the handler in a stack captured from another thread
+handler_names: dict[CodeType, str] = {}
+
+class Histogram:
+    '''Call count, total time and bucketed latencies of one instrumented function'''
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        '''Returns the upper bound of the bucket holding the q-quantile, inf if it is past the last bound'''
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    '''Process-wide latency histograms, counters and exported gauges, rendered as Prometheus text.
+
+    Histograms and counters are keyed by (family, name), e.g. ("db", "process_vote") or ("rest", "GET /channels/{id}").
+    Exports are read from a callback when the metrics are rendered, for counters other classes already keep.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.counters: dict[tuple[str, str], int] = {}
+        self.exports: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def observe(self, family: str, name: str, seconds: float):
+        '''Records one call of name taking seconds'''
+        with self.lock:
+            histogram = self.histograms.get((family, name))
+            if histogram is None:
+                histogram = self.histograms[(family, name)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, family: str, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[(family, name)] = self.counters.get((family, name), 0) + amount
+
+    def export(self, name: str, callback: Callable[[], float], kind: str = "gauge"):
+        '''Exposes callback's value as a gauge or counter, replacing any export with the same name'''
+        self.exports[name] = (kind, callback)
+
+    @contextmanager
+    def timer(self, family: str, name: str) -> Iterator[None]:
+        '''Context manager recording the time spent in its body, whether or not it raises'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(family, name, time.perf_counter() - start)
+
+    def timed(self, family: str, name: Optional[str] = None, handler: bool = False) -> Callable:
+        '''Decorator recording every call of a function or coroutine function, name defaults to its qualified name.
+        With handler set, a coroutine function also becomes the current_handler while it runs.'''
+        def decorator(function: Callable) -> Callable:
+            label = name or function.__qualname__
+
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    token = current_handler.set(label) if handler else None
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    except Exception:
+                        self.increment(f"{family}_errors", label)
+                        raise
+                    finally:
+                        self.observe(family, label, time.perf_counter() - start)
+                        if token is not None:
+                            current_handler.reset(token)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return function(*args, **kwargs)
+                    except Exception:
+                        self.increment(f"{family}_errors", label)
+                        raise
+                    finally:
+                        self.observe(family, label, time.perf_counter() - start)
+
+            return wrapper
+        return decorator
+
+    def summary(self, family: Optional[str] = None) -> list[tuple[str, str, int, float, float, float]]:
+        '''Returns (family, name, calls, total seconds, p50, p99) of every histogram, most total time first'''
+        with self.lock:
+            rows = [
+                (hist_family, name, histogram.count, histogram.sum, histogram.quantile(0.5), histogram.quantile(0.99))
+                for ((hist_family, name), histogram) in self.histograms.items()
+                if family is None or hist_family == family
+            ]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def prometheus(self) -> str:
+        '''Renders every metric in the Prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            histograms = sorted((key, list(h.counts), h.count, h.sum) for (key, h) in self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        family = None
+        for ((hist_family, name), counts, count, total) in histograms:
+            metric = f"{PREFIX}_{hist_family}_seconds"
+            if hist_family != family:
+                family = hist_family
+                lines.append(f"# TYPE {metric} histogram")
+            label = escape_label(name)
+            cumulative = 0
+            for (bound, bucket) in zip(BOUNDS, counts):
+                cumulative += bucket
+                lines.append(f'{metric}_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{name="{label}",le="+Inf"}} {count}')
+            lines.append(f'{metric}_sum{{name="{label}"}} {total}')
+            lines.append(f'{metric}_count{{name="{label}"}} {count}')
+
+        family = None
+        for ((counter_family, name), value) in counters:
+            metric = f"{PREFIX}_{counter_family}_total"
+            if counter_family != family:
+                family = counter_family
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f'{metric}{{name="{escape_label(name)}"}} {value}')
+
+        for (name, (kind, callback)) in sorted(self.exports.items()):
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Metric export {name} failed: {e}")
+                continue
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            lines.append(f"{PREFIX}_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        '''Writes the Prometheus text to path, replacing it atomically so a collector never reads half a file'''
+        temp = f"{path}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(temp, path)
+
+    async def write_periodically(self, path: str, interval: float):
+        '''Rewrites path every interval seconds, for node_exporter's textfile collector or similar'''
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.write, path)
+            except OSError as e:
+                logger.warning(f"Failed to write metrics to {path}: {e}")
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+# ========== DISCORD HOOKS ==========
+
+def instrument_cog(cog: commands.Cog):
+    '''Wraps a cog's listeners and text commands in timers and registers all its handlers in handler_names,
+    before the cog is added to the bot'''
+    cog_name = type(cog).__name__
+    for (_, listener) in cog.get_listeners():
+        name = listener.__name__
+        handler_names[listener.__func__.__code__] = f"{cog_name}.{name}"
+        setattr(cog, name, metrics.timed("listener", f"{cog_name}.{name}", handler=True)(listener))
+
+    for command in cog.walk_commands():
+        handler_names[command.callback.__code__] = f"!{command.qualified_name}"
+        command.callback = metrics.timed("command", f"!{command.qualified_name}", handler=True)(command.callback)
+
+    for command in cog.walk_app_commands():
+        if isinstance(command, app_commands.Command):
+            handler_names[command.callback.__code__] = f"/{command.qualified_name}"
+
+class InstrumentedTree(app_commands.CommandTree):
+    '''Command tree that times app commands from the interaction arriving to the handler returning'''
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["metrics_start"] = time.perf_counter()
+        if interaction.command is not None:
+            current_handler.set(f"/{interaction.command.qualified_name}")
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        record_app_command(interaction, failed=True)
+        await super().on_error(interaction, error)
+
+def record_app_command(interaction: discord.Interaction, failed: bool = False):
+    '''Records the latency of the app command interaction ran, call from on_app_command_completion and on_error'''
+    start = interaction.extras.pop("metrics_start", None)
+    if start is None or interaction.command is None:
+        return
+    name = f"/{interaction.command.qualified_name}"
+    metrics.observe("command", name, time.perf_counter() - start)
+    if failed:
+        metrics.increment("command_errors", name)
+
+def rest_trace() -> aiohttp.TraceConfig:
+    '''Returns an aiohttp trace config timing every REST request by route, pass it to the client as http_trace'''
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params: aiohttp.TraceRequestStartParams):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+        route = f"{params.method} {ROUTE_IDS.sub('/{id}', params.url.path)}"
+        metrics.observe("rest", route, time.perf_counter() - context.start)
+        if params.response.status >= 400:
+            metrics.increment("rest_errors", f"{route} {params.response.status}")
+
+    async def on_request_exception(session, context, params: aiohttp.TraceRequestExceptionParams):
+        route = f"{params.method} {ROUTE_IDS.sub('/{id}', params.url.path)}"
+        metrics.increment("rest_errors", f"{route} {type(params.exception).__name__}")
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
@@ -0,0 +1,123 @@
+import argparse
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger("client.migrations")
+
+# Schema migrations as (version, description, Database method), applied in order by apply_migrations.
+# Migration 1 is the schema of the bot before versioning, a new database is built up by all of them in turn.
+# Each method runs in one transaction with the recording of its version, so it is applied whole or not at all.
+# The methods must not commit themselves.
+MIGRATIONS = [
+    (1, "Baseline schema", "create_tables"),
+    (2, "Gacha inventory table", "create_gacha"),
+    (3, "Vote counters and gambling offsets kept by triggers", "create_vote_triggers"),
+    (4, "Per-message vote totals", "create_message_scores"),
+    (5, "Guild member lists", "create_guild_members_table"),
+    (6, "Channel scan progress", "create_scan_progress_table"),
+    (7, "Compressed, deduplicated message content", "create_contents"),
+    (8, "Hourly score buckets for the sliding window stats", "create_window_tables"),
+    (9, "Drop the Messages indexes the stats no longer use", "drop_message_indexes"),
+]
+
+# Secondary indexes as (name, table, columns), apply_migrations builds any that don't exist yet
+INDEXES = [
+    ("idx_Users_score", "Users", "upvotes-downvotes+offset"),
+    ("idx_FansAndHaters_upvotes", "FansAndHaters", "user_id, upvotes"),
+    ("idx_FansAndHaters_downvotes", "FansAndHaters", "user_id, downvotes"),
+    ("idx_Reactions_message_vote", "Reactions", "message_id, vote_type"),
+    ("idx_Transactions_user_amount", "Transactions", "user_id, amount"),
+    ("idx_MessageScores_net", "MessageScores", "net"),
+    ("idx_MessageScores_guild_net", "MessageScores", "guild_id, net"),
+    ("idx_MessageScores_guild_controversy", "MessageScores", "guild_id, controversy"),
+    ("idx_MessageScores_author_net", "MessageScores", "author_id, net"),
+    ("idx_MessageScores_guild_posted", "MessageScores", "guild_id, posted"),
+]
+
+def schema_version(db) -> int:
+    '''Returns the version of the last migration applied to db, 0 if it has never been migrated'''
+    c = db.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+    if c.fetchone() is None:
+        return 0
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return c.fetchone()[0]
+
+def pending_migrations(db) -> list[tuple[int, str, str]]:
+    version = schema_version(db)
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+def missing_indexes(db) -> list[tuple[str, str, str]]:
+    c = db.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = {name for (name,) in c.fetchall()}
+    return [index for index in INDEXES if index[0] not in existing]
+
+def record_version(db, version: int, description: str):
+    c = db.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied TEXT NOT NULL)")
+    c.execute("INSERT INTO schema_version (version, description, applied) VALUES (?, ?, ?)", (version, description, datetime.now().isoformat()))
+
+def build_index(db, name: str, table: str, columns: str):
+    '''Builds one index in a transaction of its own. With WAL, readers keep being served while it builds
+    and writers only wait for this index rather than for the whole migration.'''
+    db.flush()
+    db.cursor().execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    db.conn.commit()
+
+def apply_migrations(db, dry_run: bool = False) -> list[str]:
+    '''Applies pending migrations and builds missing indexes on db. Returns a description of every step,
+    with dry_run set nothing is changed and the steps that would run are returned'''
+    steps = []
+    for (version, description, method) in pending_migrations(db):
+        steps.append(f"migration {version}: {description}")
+        if dry_run:
+            continue
+
+        start = time.perf_counter()
+        # sqlite3 doesn't open a transaction for DDL by itself, so without BEGIN every CREATE and ALTER would be
+        # committed on the spot and a failed migration would leave half its schema behind
+        db.flush()
+        db.cursor().execute("BEGIN")
+        try:
+            getattr(db, method)()
+            record_version(db, version, description)
+        except BaseException:
+            db.conn.rollback()
+            raise
+        db.conn.commit()
+        logger.info(f"Applied migration {version} ({description}) in {time.perf_counter() - start:.2f}s")
+
+    for (name, table, columns) in missing_indexes(db):
+        steps.append(f"index {name} ON {table} ({columns})")
+        if dry_run:
+            continue
+
+        start = time.perf_counter()
+        build_index(db, name, table, columns)
+        logger.info(f"Built index {name} in {time.perf_counter() - start:.2f}s")
+
+    return steps
+
+if __name__ == "__main__":
+    from utility.database import Database
+
+    parser = argparse.ArgumentParser(description="Brings a MiniSigma database up to the current schema")
+    parser.add_argument("path", nargs="?", default="database.db")
+    parser.add_argument("--dry-run", action="store_true", help="only list the steps that would run")
+    parser.add_argument("--vacuum", action="store_true", help="rewrite the database files afterwards, returning the space freed by migrations to the OS")
+    args = parser.parse_args()
+
+    db = Database(args.path, migrate=False)
+    print(f"Schema version: {schema_version(db)}, latest: {MIGRATIONS[-1][0]}")
+    steps = apply_migrations(db, args.dry_run)
+    for step in steps:
+        print(f"{'Would run' if args.dry_run else 'Ran'} {step}")
+    if not steps:
+        print("Schema is up to date")
+    if args.vacuum and not args.dry_run:
+        for schema in ("main", "archive"):
+            db.cursor().execute(f"VACUUM {schema}")
+        print("Vacuumed database and archive")
+    db.close()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import discord
+from utility.utils import nick_update, render_nick
+
+logger = logging.getLogger("client.nicknames")
+
+class NicknameScheduler:
+    '''Coalesces nickname updates so a burst of score changes costs each member a single edit.
+
+    schedule() only records a member's latest score. Each guild gets a worker task which waits `delay`
+    seconds for the burst to settle, then edits its pending members one at a time, at most one edit
+    every `interval` seconds, since member edits share a per-guild rate limit bucket.
+    '''
+
+    def __init__(self, delay: float = 2.0, interval: float = 1.0, max_pending: int = 10000):
+        self.delay = delay
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: dict[int, dict[int, tuple[discord.Member, int]]] = {}
+        self.workers: dict[int, asyncio.Task] = {}
+        self.queue_depth = 0
+        self.scheduled = 0
+        self.merged = 0
+        self.skipped = 0
+        self.edited = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def schedule(self, member: discord.abc.User, score: int):
+        '''Queues a nickname update for member, replacing any update still waiting for them'''
+        if not isinstance(member, discord.Member):
+            return
+
+        guild_id = member.guild.id
+        guild_pending = self.pending.get(guild_id, {})
+        if member.id in guild_pending:
+            self.merged += 1
+        elif self.queue_depth >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Nickname queue full, dropped update for {member.name} ({score})")
+            return
+        else:
+            self.queue_depth += 1
+
+        self.scheduled += 1
+        # Reassigning an existing key keeps its place in line
+        guild_pending[member.id] = (member, score)
+        self.pending[guild_id] = guild_pending
+
+        if guild_id not in self.workers:
+            self.workers[guild_id] = asyncio.create_task(self.run_guild(guild_id))
+
+    async def run_guild(self, guild_id: int):
+        try:
+            await asyncio.sleep(self.delay)
+            guild_pending = self.pending[guild_id]
+            while guild_pending:
+                member_id = next(iter(guild_pending))
+                member, score = guild_pending.pop(member_id)
+                self.queue_depth -= 1
+
+                if render_nick(member, score) == member.nick:
+                    self.skipped += 1
+                    continue
+
+                if await nick_update(member, score):
+                    self.edited += 1
+                else:
+                    self.failed += 1
+                await asyncio.sleep(self.interval)
+        finally:
+            del self.workers[guild_id]
+            self.queue_depth -= len(self.pending.pop(guild_id, {}))
+
+    def close(self):
+        '''Cancels the guild workers, pending updates are dropped'''
+        if self.queue_depth:
+            logger.info(f"Dropping {self.queue_depth} pending nickname updates")
+        for worker in list(self.workers.values()):
+            worker.cancel()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from types import FrameType
+from typing import NamedTuple, Optional
+import utility.metrics
+from utility.metrics import handler_names, metrics
+
+logger = logging.getLogger("client.profiler")
+
+# Directory of the bot's own code, a stall is blamed on the innermost frame in it outside the instrumentation
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INSTRUMENTATION = (__file__, utility.metrics.__file__)
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse(frame: Optional[FrameType]) -> str:
+    '''Returns a stack as one line of semicolon separated frames, outermost first'''
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+def sample_stacks(thread_id: int, duration: float, interval: float = 0.005) -> Counter[str]:
+    '''Samples the stack of the thread with id thread_id every interval seconds for duration seconds, returns the
+    number of times each collapsed stack was seen. Run it on another thread than the one being sampled.'''
+    samples: Counter[str] = Counter()
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        samples[collapse(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return samples
+
+def collapsed_lines(samples: Counter[str]) -> list[str]:
+    '''Formats samples in the collapsed stack format flamegraph.pl and speedscope read, most frequent first'''
+    return [f"{stack} {count}" for (stack, count) in samples.most_common()]
+
+def idle_share(samples: Counter[str]) -> float:
+    '''Returns the share of samples where an asyncio loop was waiting for events rather than running code'''
+    total = sum(samples.values())
+    idle = sum(count for (stack, count) in samples.items() if stack.rsplit(";", 1)[-1].startswith(("select (selectors.py", "poll (selectors.py")))
+    return idle / total if total else 0.0
+
+class Stall(NamedTuple):
+    timestamp: datetime
+    seconds: float
+    handler: str
+    location: str
+    stack: str
+
+def attribute(frame: Optional[FrameType]) -> tuple[str, str]:
+    '''Returns the innermost handler in handler_names and the innermost frame of the bot's own code on a stack'''
+    handler = location = None
+    while frame is not None and (handler is None or location is None):
+        code = frame.f_code
+        if handler is None:
+            handler = handler_names.get(code)
+        if location is None and code.co_filename.startswith(ROOT) and "site-packages" not in code.co_filename and code.co_filename not in INSTRUMENTATION:
+            location = f"{code.co_name} ({os.path.relpath(code.co_filename, ROOT)}:{frame.f_lineno})"
+        frame = frame.f_back
+    return (handler or "unknown", location or "unknown")
+
+class LoopMonitor:
+    '''Measures how late the event loop runs a task that wakes up every `interval` seconds.
+
+    A watchdog thread notices when the loop has been stuck for longer than `threshold`, and captures the loop
+    thread's stack while the blocking call is still running. Once the loop is back the stall is logged and
+    counted against the handler and line it was blocked in, see offenders().
+    '''
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: deque[Stall] = deque(maxlen=100)
+        self.worst: Optional[Stall] = None
+        self.last_beat = time.perf_counter()
+        self.captured: Optional[tuple[str, str, str]] = None
+        self.loop_thread = threading.get_ident()
+        self.heartbeat: Optional[asyncio.Task] = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        '''Starts monitoring the running loop'''
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.stopped.clear()
+        self.heartbeat = asyncio.create_task(self.beat())
+        threading.Thread(target=self.watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+
+    async def beat(self):
+        while True:
+            self.last_beat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - self.last_beat - self.interval)
+            metrics.observe("loop_lag", "event_loop", lag)
+            if lag >= self.threshold:
+                self.record(lag)
+            self.captured = None
+
+    def watch(self):
+        '''Runs on the watchdog thread, captures the loop thread's stack once per stall'''
+        while not self.stopped.wait(self.interval):
+            if self.captured is None and time.perf_counter() - self.last_beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                (handler, location) = attribute(frame)
+                self.captured = (handler, location, collapse(frame))
+                del frame
+
+    def record(self, lag: float):
+        # Without a capture the watchdog didn't get to run during the stall, e.g. because the GIL was held throughout
+        (handler, location, stack) = self.captured or ("unknown", "unknown", "")
+        stall = Stall(datetime.now(), lag, handler, location, stack)
+        self.stalls.append(stall)
+        if self.worst is None or lag > self.worst.seconds:
+            self.worst = stall
+        metrics.increment("loop_stalls", handler)
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms by {handler} in {location}")
+
+    def offenders(self) -> list[tuple[str, str, int, float, float]]:
+        '''Returns (handler, location, stalls, total seconds, worst seconds) of the recent stalls, most total time first'''
+        totals: dict[tuple[str, str], list] = {}
+        for stall in self.stalls:
+            total = totals.setdefault((stall.handler, stall.location), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += stall.seconds
+            total[2] = max(total[2], stall.seconds)
+        return sorted(((handler, location, *total) for ((handler, location), total) in totals.items()), key=lambda row: row[3], reverse=True)
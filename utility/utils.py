@@ -57,32 +57,41 @@ def strip_score(nick: str) -> str:
     """
     return re.sub(r"\s*\([^)]*\)$", "", nick)
 
-async def nick_update(member: discord.Member, score: int) -> None:
+def render_nick(member: discord.Member, score: int) -> str:
+    """Builds the nickname a member should have for a given score.
+
+    Args:
+        member: The member whose nickname is being rendered
+        score: The score to append to the member's nickname
+
+    Returns:
+        The member's nickname with any old score replaced by the new one
+    """
+    current_nick: str = getattr(member, "nick", None) or member.name
+    return f"{strip_score(current_nick)} ({score} {POINTS_NAME})"
+
+async def nick_update(member: discord.Member, score: int) -> bool:
     """Updates a member's nickname with their new score.
 
     If the member's nickname already contains a score, it is replaced.
     If the member's nickname does not contain a score, one is appended.
-    If the member's nickname is too long, the score is not appended.
+    Errors are logged rather than raised, most callers should go through
+    NicknameScheduler.schedule instead of calling this directly.
 
     Args:
         member: The member whose nickname should be updated
         score: The new score to append to the member's nickname
 
-    Raises:
-        discord.errors.Forbidden: When bot lacks permission to change nicknames
-        discord.errors.HTTPException: When the new nickname is too long
+    Returns:
+        Whether the nickname was changed
     """
-    try:
-        current_nick: str = member.nick or member.name
-    except AttributeError:
-        current_nick = member.name
-        
-    nick_sans_score: str = strip_score(current_nick)
-    new_nick: str = f"{nick_sans_score} ({score} {POINTS_NAME})"
+    nick_sans_score: str = strip_score(getattr(member, "nick", None) or member.name)
+    new_nick: str = render_nick(member, score)
 
     try:
         await member.edit(nick=new_nick)
         logger.info(f"Successfully updated {nick_sans_score}'s nickname to: {new_nick}")
+        return True
     except discord.errors.Forbidden:
         logger.warning(
             f"Permission denied: Unable to update {nick_sans_score}'s nickname. "
@@ -92,4 +101,5 @@ async def nick_update(member: discord.Member, score: int) -> None:
         logger.warning(
             f"Nickname too long: Failed to update {nick_sans_score}'s nickname. "
             f"New score is {score}"
-        )
\ No newline at end of file
+        )
+    return False